@@ -17,7 +17,12 @@ setup(
     entry_points={
         'console_scripts': [
             'temper-poll = temperusb.cli:main',
-            'temper-snmp = temperusb.snmp:main'
+            'temper-snmp = temperusb.snmp:main',
+            'temper-capture = temperusb.capture:main',
+            'temper-shm = temperusb.shm:main',
+            'temper-agentx = temperusb.agentx:main',
+            'temper-federation = temperusb.federation:main',
+            'temper-calibrate = temperusb.calibration:main',
         ]
     },
     classifiers=[
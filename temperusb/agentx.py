@@ -0,0 +1,595 @@
+# encoding: utf-8
+#
+# Serve temperatures via SNMP as an AgentX (RFC 2741) subagent.
+#
+# Copyright 2012-2020 Philipp Adelt <info@philipp.adelt.net> and contributors.
+#
+# This code is licensed under the GNU public license (GPL). See LICENSE.md for
+# details.
+#
+# Unlike the pass_persist module in snmp.py, the subagent connects to the
+# master agent (snmpd with "master agentx") over a Unix socket, answers
+# requests from cached readings in a binary protocol and simply leaves out
+# values that are unavailable, so snmpd reports noSuchInstance instead of a
+# fake temperature.
+#
+# Only what a read-only subagent needs is implemented: Open, Register, Close,
+# Get, GetNext, GetBulk and Response PDUs, in the default context.
+
+from __future__ import print_function, absolute_import
+import argparse
+import bisect
+import collections
+import logging
+import socket
+import struct
+import threading
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_SOCKET = '/var/agentx/master'
+AGENTX_VERSION = 1
+HEADER = struct.Struct('>BBBBIIII')
+
+# PDU types
+PDU_OPEN = 1
+PDU_CLOSE = 2
+PDU_REGISTER = 3
+PDU_UNREGISTER = 4
+PDU_GET = 5
+PDU_GETNEXT = 6
+PDU_GETBULK = 7
+PDU_TESTSET = 8
+PDU_COMMITSET = 9
+PDU_UNDOSET = 10
+PDU_CLEANUPSET = 11
+PDU_PING = 13
+PDU_RESPONSE = 18
+
+# Header flags
+FLAG_NON_DEFAULT_CONTEXT = 0x08
+FLAG_NETWORK_BYTE_ORDER = 0x10
+
+# Varbind types
+TYPE_INTEGER = 2
+TYPE_OCTET_STRING = 4
+TYPE_NULL = 5
+TYPE_OBJECT_IDENTIFIER = 6
+TYPE_IP_ADDRESS = 64
+TYPE_COUNTER32 = 65
+TYPE_GAUGE32 = 66
+TYPE_TIME_TICKS = 67
+TYPE_OPAQUE = 68
+TYPE_COUNTER64 = 70
+TYPE_NO_SUCH_OBJECT = 128
+TYPE_NO_SUCH_INSTANCE = 129
+TYPE_END_OF_MIB_VIEW = 130
+
+# Response errors
+ERROR_NONE = 0
+ERROR_NOT_WRITABLE = 17
+ERROR_PROCESSING = 268
+
+# Close reasons
+CLOSE_SHUTDOWN = 5
+
+# The OIDs also served by snmp.py
+APC_OID = (1, 3, 6, 1, 4, 1, 318, 1, 1, 1, 2, 2, 2, 0)
+APC_SUBTREE = APC_OID[:-1]
+CISCO_SUBTREE = (1, 3, 6, 1, 4, 1, 9, 9, 13, 1, 3)
+CISCO_TEMPERATURE = CISCO_SUBTREE + (1, 3)
+
+PDU = collections.namedtuple('PDU', [
+    'type', 'flags', 'session_id', 'transaction_id', 'packet_id', 'payload',
+])
+
+
+def parse_oid(text):
+    """
+    Convert a dotted OID string to a tuple of integers.
+    """
+    return tuple(int(part) for part in text.strip('.').split('.') if part)
+
+
+def format_oid(oid):
+    return '.' + '.'.join(str(part) for part in oid)
+
+
+def _byteorder(flags):
+    return '>' if flags & FLAG_NETWORK_BYTE_ORDER else '<'
+
+
+def encode_oid(oid, include=False, bo='>'):
+    """
+    Encode an OID, using the 1.3.6.1.x prefix compression.
+    """
+    oid = tuple(oid)
+    prefix = 0
+    if len(oid) > 4 and oid[:4] == (1, 3, 6, 1) and 0 < oid[4] < 256:
+        prefix = oid[4]
+        oid = oid[5:]
+    return struct.pack(bo + 'BBBB', len(oid), prefix, int(include), 0) + \
+        struct.pack(bo + '%dI' % len(oid), *oid)
+
+
+def decode_oid(data, offset, bo='>'):
+    """
+    Decode an OID at <offset>. Returns the OID, its include flag and the
+    offset after it.
+    """
+    count, prefix, include, _ = struct.unpack_from(bo + 'BBBB', data, offset)
+    subids = struct.unpack_from(bo + '%dI' % count, data, offset + 4)
+    if prefix:
+        subids = (1, 3, 6, 1, prefix) + subids
+    return subids, bool(include), offset + 4 + 4 * count
+
+
+def encode_octets(value, bo='>'):
+    if not isinstance(value, bytes):
+        value = str(value).encode('utf-8')
+    padding = (4 - len(value) % 4) % 4
+    return struct.pack(bo + 'I', len(value)) + value + b'\x00' * padding
+
+
+def decode_octets(data, offset, bo='>'):
+    length, = struct.unpack_from(bo + 'I', data, offset)
+    start = offset + 4
+    return data[start:start + length], start + length + (4 - length % 4) % 4
+
+
+def encode_varbind(oid, type, value=None, bo='>'):
+    data = struct.pack(bo + 'HH', type, 0) + encode_oid(oid, bo=bo)
+    if type == TYPE_INTEGER:
+        data += struct.pack(bo + 'i', value)
+    elif type in (TYPE_COUNTER32, TYPE_GAUGE32, TYPE_TIME_TICKS):
+        data += struct.pack(bo + 'I', value)
+    elif type == TYPE_COUNTER64:
+        data += struct.pack(bo + 'Q', value)
+    elif type in (TYPE_OCTET_STRING, TYPE_IP_ADDRESS, TYPE_OPAQUE):
+        data += encode_octets(value, bo)
+    elif type == TYPE_OBJECT_IDENTIFIER:
+        data += encode_oid(value, bo=bo)
+    return data
+
+
+def decode_varbind(data, offset, bo='>'):
+    """
+    Decode a varbind at <offset>. Returns (oid, type, value) and the offset
+    after it.
+    """
+    type, _ = struct.unpack_from(bo + 'HH', data, offset)
+    oid, _, offset = decode_oid(data, offset + 4, bo)
+    value = None
+    if type == TYPE_INTEGER:
+        value, = struct.unpack_from(bo + 'i', data, offset)
+        offset += 4
+    elif type in (TYPE_COUNTER32, TYPE_GAUGE32, TYPE_TIME_TICKS):
+        value, = struct.unpack_from(bo + 'I', data, offset)
+        offset += 4
+    elif type == TYPE_COUNTER64:
+        value, = struct.unpack_from(bo + 'Q', data, offset)
+        offset += 8
+    elif type in (TYPE_OCTET_STRING, TYPE_IP_ADDRESS, TYPE_OPAQUE):
+        value, offset = decode_octets(data, offset, bo)
+    elif type == TYPE_OBJECT_IDENTIFIER:
+        value, _, offset = decode_oid(data, offset, bo)
+    return (oid, type, value), offset
+
+
+def decode_search_ranges(data, offset, bo='>'):
+    """
+    Decode a SearchRangeList. Returns a list of (start, include, end).
+    """
+    ranges = []
+    while offset < len(data):
+        start, include, offset = decode_oid(data, offset, bo)
+        end, _, offset = decode_oid(data, offset, bo)
+        ranges.append((start, include, end))
+    return ranges
+
+
+def encode_pdu(type, payload, session_id=0, transaction_id=0, packet_id=0,
+               flags=FLAG_NETWORK_BYTE_ORDER):
+    return HEADER.pack(AGENTX_VERSION, type, flags, 0, session_id,
+                       transaction_id, packet_id, len(payload)) + payload
+
+
+def _recv_exact(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise EOFError('AgentX connection closed')
+        data += chunk
+    return data
+
+
+def read_pdu(sock):
+    """
+    Read one PDU from a socket. Header fields are converted according to
+    the byte order flag of the PDU.
+    """
+    header = _recv_exact(sock, HEADER.size)
+    flags = header[2]
+    bo = _byteorder(flags)
+    version, type, flags, _, session_id, transaction_id, packet_id, length = \
+        struct.unpack(bo + 'BBBBIIII', header)
+    if version != AGENTX_VERSION:
+        raise ValueError('Unsupported AgentX version %d' % version)
+    return PDU(type, flags, session_id, transaction_id, packet_id,
+               _recv_exact(sock, length))
+
+
+def encode_response(request, varbinds=(), error=ERROR_NONE, index=0, uptime=0):
+    """
+    Encode a Response PDU answering <request>.
+    """
+    payload = struct.pack('>IHH', uptime, error, index) + b''.join(
+        encode_varbind(oid, type, value) for oid, type, value in varbinds)
+    return encode_pdu(PDU_RESPONSE, payload, request.session_id,
+                      request.transaction_id, request.packet_id)
+
+
+class MibView(object):
+    """
+    The cached values of a subagent: a dictionary and a sorted index of OIDs,
+    replaced atomically on every update.
+    """
+    def __init__(self, subtrees):
+        self.subtrees = [tuple(s) for s in subtrees]
+        self._values = {}
+        self._index = []
+
+    def update(self, values):
+        """
+        Replace all values with a dictionary mapping OID tuples to
+        (type, value). OIDs left out are unavailable.
+        """
+        values = dict(values)
+        index = sorted(values)
+        self._values, self._index = values, index
+
+    def in_subtree(self, oid):
+        return any(oid[:len(s)] == s for s in self.subtrees)
+
+    def get(self, oid):
+        values = self._values
+        if oid in values:
+            return (oid,) + values[oid]
+        if self.in_subtree(oid):
+            return (oid, TYPE_NO_SUCH_INSTANCE, None)
+        return (oid, TYPE_NO_SUCH_OBJECT, None)
+
+    def get_next(self, start, include=False, end=()):
+        values, index = self._values, self._index
+        if include:
+            position = bisect.bisect_left(index, start)
+        else:
+            position = bisect.bisect_right(index, start)
+        if position < len(index) and (not end or index[position] < end):
+            oid = index[position]
+            return (oid,) + values[oid]
+        return (start, TYPE_END_OF_MIB_VIEW, None)
+
+
+class SubAgent(object):
+    """
+    AgentX subagent serving the values of a MibView.
+    """
+    def __init__(self, mib, socket_path=DEFAULT_SOCKET, timeout=5,
+                 description='temperusb'):
+        self.mib = mib
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.description = description
+        self.session_id = None
+        self._sock = None
+        self._packet_id = 0
+        self._started = time.monotonic()
+        self._stop = threading.Event()
+        self.stats = {'requests': 0}
+
+    def _uptime(self):
+        return int((time.monotonic() - self._started) * 100) & 0xffffffff
+
+    def _request(self, type, payload):
+        """
+        Send a PDU from the subagent to the master and wait for its
+        Response.
+        """
+        self._packet_id += 1
+        self._sock.sendall(encode_pdu(
+            type, payload, self.session_id or 0, 0, self._packet_id))
+        while True:
+            pdu = read_pdu(self._sock)
+            if pdu.type == PDU_RESPONSE and pdu.packet_id == self._packet_id:
+                break
+            self._handle(pdu)
+        bo = _byteorder(pdu.flags)
+        _, error, _ = struct.unpack_from(bo + 'IHH', pdu.payload, 0)
+        if error != ERROR_NONE:
+            raise RuntimeError('AgentX master refused PDU type %d: error %d' % (type, error))
+        return pdu
+
+    def connect(self):
+        """
+        Open a session with the master and register the MIB subtrees.
+        """
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.connect(self.socket_path)
+        self.session_id = None
+        pdu = self._request(PDU_OPEN, struct.pack('>B3x', self.timeout) +
+                            encode_oid(()) + encode_octets(self.description))
+        self.session_id = pdu.session_id
+        for subtree in self.mib.subtrees:
+            self._request(PDU_REGISTER, struct.pack('>BBBx', self.timeout, 127, 0) +
+                          encode_oid(subtree))
+        LOGGER.info('AgentX session %d registered %d subtrees',
+                    self.session_id, len(self.mib.subtrees))
+
+    def close(self):
+        """
+        Close the session and the connection.
+        """
+        if self._sock is None:
+            return
+        try:
+            self._packet_id += 1
+            self._sock.sendall(encode_pdu(
+                PDU_CLOSE, struct.pack('>B3x', CLOSE_SHUTDOWN),
+                self.session_id or 0, 0, self._packet_id))
+        except OSError:
+            pass
+        self._sock.close()
+        self._sock = None
+
+    def _varbinds(self, pdu):
+        """
+        Look up the varbinds answering a Get, GetNext or GetBulk PDU. Raises
+        struct.error if the PDU cannot be decoded.
+        """
+        bo = _byteorder(pdu.flags)
+        payload = pdu.payload
+        offset = 0
+        if pdu.flags & FLAG_NON_DEFAULT_CONTEXT:
+            _, offset = decode_octets(payload, offset, bo)
+
+        if pdu.type == PDU_GET:
+            varbinds = [self.mib.get(start)
+                        for start, _, _ in decode_search_ranges(payload, offset, bo)]
+        elif pdu.type == PDU_GETNEXT:
+            varbinds = [self.mib.get_next(start, include, end)
+                        for start, include, end in decode_search_ranges(payload, offset, bo)]
+        elif pdu.type == PDU_GETBULK:
+            non_repeaters, max_repetitions = struct.unpack_from(bo + 'HH', payload, offset)
+            ranges = decode_search_ranges(payload, offset + 4, bo)
+            varbinds = [self.mib.get_next(start, include, end)
+                        for start, include, end in ranges[:non_repeaters]]
+            repeaters = list(ranges[non_repeaters:])
+            for _ in range(max_repetitions):
+                if not repeaters:
+                    break
+                row = [self.mib.get_next(start, include, end)
+                       for start, include, end in repeaters]
+                varbinds.extend(row)
+                if all(v[1] == TYPE_END_OF_MIB_VIEW for v in row):
+                    break
+                repeaters = [(v[0], False, r[2]) for v, r in zip(row, repeaters)]
+        return varbinds
+
+    def _handle(self, pdu):
+        """
+        Answer a PDU from the master. Returns False if the master closed
+        the session.
+        """
+        self.stats['requests'] += 1
+        if pdu.type in (PDU_GET, PDU_GETNEXT, PDU_GETBULK):
+            try:
+                varbinds = self._varbinds(pdu)
+            except struct.error as e:
+                LOGGER.warning('Malformed AgentX PDU type %d: %s', pdu.type, e)
+                self._sock.sendall(encode_response(
+                    pdu, error=ERROR_PROCESSING, uptime=self._uptime()))
+                return True
+        elif pdu.type == PDU_TESTSET:
+            self._sock.sendall(encode_response(
+                pdu, error=ERROR_NOT_WRITABLE, index=1, uptime=self._uptime()))
+            return True
+        elif pdu.type in (PDU_COMMITSET, PDU_UNDOSET, PDU_CLEANUPSET):
+            # Nothing to do after refusing TestSet; CleanupSet gets no answer
+            if pdu.type != PDU_CLEANUPSET:
+                self._sock.sendall(encode_response(pdu, uptime=self._uptime()))
+            return True
+        elif pdu.type == PDU_CLOSE:
+            LOGGER.info('AgentX master closed session %d', pdu.session_id)
+            return False
+        else:
+            LOGGER.debug('Ignoring AgentX PDU type %d', pdu.type)
+            return True
+        self._sock.sendall(encode_response(pdu, varbinds, uptime=self._uptime()))
+        return True
+
+    def serve(self):
+        """
+        Answer requests until the master closes the session or the
+        connection is lost.
+        """
+        while not self._stop.is_set():
+            if not self._handle(read_pdu(self._sock)):
+                break
+
+    def run(self, retry_interval=5.0):
+        """
+        Connect, serve and reconnect after errors until stop() is called.
+        """
+        while not self._stop.is_set():
+            try:
+                self.connect()
+                self.serve()
+            except (OSError, EOFError, RuntimeError, ValueError, struct.error) as e:
+                if self._stop.is_set():
+                    break
+                LOGGER.warning('AgentX connection to %s failed: %s', self.socket_path, e)
+            finally:
+                self.close()
+            self._stop.wait(retry_interval)
+
+    def stop(self):
+        self._stop.set()
+        if self._sock is not None:
+            try:
+                self._sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+def temperature_values(devices, readings, table_oid=None):
+    """
+    Compute the MIB values from the latest readings.
+
+    Params:
+    - devices: the devices in handler order
+    - readings: dictionary mapping devices to their latest readings as
+      returned by TemperDevice.get_readings(); devices without current
+      readings are left out instead of reporting a fake value
+    - table_oid: optional OID tuple of a table with all sensors:
+      <table_oid>.1.<n> temperature in millidegrees celsius and
+      <table_oid>.2.<n> relative humidity in 0.1 %, n counting all
+      sensors of all devices from 1
+    """
+    values = {}
+    temperatures = []
+    for i, dev in enumerate(devices):
+        reading = readings.get(dev, {}).get(0)
+        if reading is None:
+            continue
+        temperature = int(reading['temperature_c'])
+        temperatures.append(temperature)
+        if i < 3: # use max. first 3 devices
+            values[CISCO_TEMPERATURE + (i + 1,)] = (TYPE_INTEGER, temperature)
+    if temperatures:
+        values[APC_OID] = (TYPE_INTEGER, max(temperatures))
+
+    if table_oid is not None:
+        n = 0
+        for dev in devices:
+            for sensor in range(dev.get_sensor_count()):
+                n += 1
+                reading = readings.get(dev, {}).get(sensor)
+                if reading is None:
+                    continue
+                values[table_oid + (1, n)] = (
+                    TYPE_INTEGER, int(round(reading['temperature_c'] * 1000)))
+                if reading.get('humidity_pc') is not None:
+                    values[table_oid + (2, n)] = (
+                        TYPE_INTEGER, int(round(reading['humidity_pc'] * 10)))
+    return values
+
+
+class ReadingsCache(object):
+    """
+    Keeps the latest readings of a TemperHandler's devices up to date via
+    TemperHandler.subscribe() and refreshes a MibView from them. Readings
+    older than <max_age> seconds are dropped, which makes their values
+    unavailable, and devices without readings for that long are set up
+    again with TemperHandler.rescan(), e.g. after they were replugged.
+    """
+    def __init__(self, handler, mib, refresh=5.0, max_age=None, table_oid=None):
+        self._handler = handler
+        self._mib = mib
+        self._table_oid = table_oid
+        self.max_age = max_age if max_age is not None else 3 * refresh
+        self._readings = {}
+        # Time of the last readings of a device, or when it was first seen
+        # or set up again
+        self._times = {}
+        self._lock = threading.Lock()
+        self._subscription = handler.subscribe(
+            self._received, min_interval=refresh, policy='coalesce')
+
+    def _received(self, device, readings):
+        with self._lock:
+            self._readings[device] = readings
+            self._times[device] = time.monotonic()
+        self.refresh()
+
+    def refresh(self):
+        """
+        Drop outdated readings, rescan devices without current readings and
+        update the MibView.
+        """
+        now = time.monotonic()
+        devices = self._handler.get_devices()
+        failing = []
+        with self._lock:
+            for device in list(self._times):
+                if device not in devices:
+                    del self._times[device]
+                    self._readings.pop(device, None)
+            for device in devices:
+                if now - self._times.setdefault(device, now) > self.max_age:
+                    LOGGER.warning('No current readings of device %r', device)
+                    self._readings.pop(device, None)
+                    self._times[device] = now
+                    failing.append(device)
+            readings = dict(self._readings)
+        if failing:
+            try:
+                devices = self._handler.rescan(replace=failing)
+            except Exception as e:
+                LOGGER.warning('Exception while reinitializing devices: %s', e)
+        self._mib.update(temperature_values(devices, readings, self._table_oid))
+
+    def close(self):
+        self._subscription.unsubscribe()
+
+
+def parse_args():
+    descr = "Serve TEMPer temperatures via SNMP as an AgentX subagent."
+
+    parser = argparse.ArgumentParser(description=descr)
+    parser.add_argument("--socket", default=DEFAULT_SOCKET,
+                        help="AgentX master socket (default: %(default)s)")
+    parser.add_argument("--refresh", type=float, default=5.0,
+                        help="Seconds between readings (default: %(default)s)")
+    parser.add_argument("--table-oid",
+                        help="Also serve a table of all sensors below this OID")
+    parser.add_argument("-v", "--verbose", action='store_true',
+                        help="Verbose: display all debug information")
+    return parser.parse_args()
+
+
+def main():
+    from .temper import TemperHandler
+
+    args = parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING)
+
+    table_oid = parse_oid(args.table_oid) if args.table_oid else None
+    subtrees = [APC_SUBTREE, CISCO_SUBTREE]
+    if table_oid is not None:
+        subtrees.append(table_oid)
+    mib = MibView(subtrees)
+    cache = ReadingsCache(TemperHandler(), mib, args.refresh, table_oid=table_oid)
+    agent = SubAgent(mib, args.socket)
+
+    def expire():
+        # Outdated readings must also disappear when no new ones arrive
+        while not agent._stop.wait(args.refresh):
+            cache.refresh()
+
+    expiry = threading.Thread(target=expire, name='temper-agentx-expiry')
+    expiry.daemon = True
+    expiry.start()
+    try:
+        agent.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        agent.stop()
+        cache.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,240 @@
+# encoding: utf-8
+#
+# Per-sensor calibration curves and fitting them to reference measurements.
+#
+# Copyright 2012-2020 Philipp Adelt <info@philipp.adelt.net> and contributors.
+#
+# This code is licensed under the GNU public license (GPL). See LICENSE.md for
+# details.
+#
+# Curves are given in /etc/temper.conf as
+#
+#   1-4.3 sensor 0 temperature: points = 0.4:0.0, 24.6:25.0, 98.1:100.0
+#   1-4.3 sensor 0 humidity: poly = 1.2, 0.97, 0.0002
+#
+# "points" are raw:reference pairs interpolated linearly (and extrapolated
+# with the outer segments), "poly" are polynomial coefficients from the
+# constant term up. Both are compiled once so applying them per reading is a
+# bisection plus one multiply-add, or a Horner evaluation.
+
+from __future__ import print_function, absolute_import
+import argparse
+import bisect
+import csv
+import re
+
+QUANTITIES = ('temperature', 'humidity')
+CURVE_KINDS = ('points', 'poly')
+
+
+def _format(value, digits):
+    return repr(value) if digits is None else '%.*g' % (digits, value)
+
+
+class PiecewiseLinear(object):
+    """
+    Calibration curve interpolating linearly between (raw, reference)
+    points. A single point is a constant offset.
+    """
+    def __init__(self, points):
+        points = sorted((float(x), float(y)) for x, y in points)
+        if not points:
+            raise ValueError('A calibration curve needs at least one point')
+        xs = [x for x, _ in points]
+        if len(set(xs)) != len(xs):
+            raise ValueError('Calibration points need distinct raw values')
+        self.points = points
+        if len(points) == 1:
+            x, y = points[0]
+            points = [(x, y), (x + 1.0, y + 1.0)]
+        # Segment i covers raw values from xs[i] on; the first and last
+        # segments extend to infinity.
+        self._xs = [x for x, _ in points[1:-1]]
+        self._slopes = []
+        self._intercepts = []
+        for (x0, y0), (x1, y1) in zip(points, points[1:]):
+            slope = (y1 - y0) / (x1 - x0)
+            self._slopes.append(slope)
+            self._intercepts.append(y0 - slope * x0)
+
+    def __call__(self, x):
+        i = bisect.bisect_right(self._xs, x)
+        return self._slopes[i] * x + self._intercepts[i]
+
+    def __repr__(self):
+        return '<PiecewiseLinear %s>' % self.describe()
+
+    def describe(self, digits=None):
+        """
+        Get the curve in the syntax of /etc/temper.conf, exact or rounded
+        to <digits> significant digits.
+        """
+        return 'points = ' + ', '.join(
+            '%s:%s' % (_format(x, digits), _format(y, digits)) for x, y in self.points)
+
+
+class Polynomial(object):
+    """
+    Calibration curve c0 + c1 * x + c2 * x**2 + ..., evaluated with Horner's
+    scheme.
+    """
+    def __init__(self, coefficients):
+        self.coefficients = [float(c) for c in coefficients]
+        if not self.coefficients:
+            raise ValueError('A polynomial needs at least one coefficient')
+        self._reversed = tuple(reversed(self.coefficients))
+
+    def __call__(self, x):
+        result = 0.0
+        for c in self._reversed:
+            result = result * x + c
+        return result
+
+    def __repr__(self):
+        return '<Polynomial %s>' % self.describe()
+
+    def describe(self, digits=None):
+        """
+        Get the curve in the syntax of /etc/temper.conf, exact or rounded
+        to <digits> significant digits.
+        """
+        return 'poly = ' + ', '.join(_format(c, digits) for c in self.coefficients)
+
+
+def parse_curve(text):
+    """
+    Compile a curve given as "points = x:y, ..." or "poly = c0, c1, ...".
+    """
+    match = re.match(r'^\s*(points|poly)\s*=\s*(.*?)\s*$', text)
+    if not match:
+        raise ValueError('Invalid calibration curve %r' % text)
+    kind, values = match.groups()
+    items = [item.strip() for item in values.split(',') if item.strip()]
+    try:
+        if kind == 'points':
+            return PiecewiseLinear([item.split(':') for item in items])
+        return Polynomial(items)
+    except (TypeError, ValueError) as e:
+        raise ValueError('Invalid calibration curve %r: %s' % (text, e))
+
+
+def _solve(matrix, vector):
+    """
+    Solve a linear system by Gaussian elimination with partial pivoting.
+    """
+    n = len(vector)
+    rows = [list(row) + [value] for row, value in zip(matrix, vector)]
+    for col in range(n):
+        pivot = max(range(col, n), key=lambda r: abs(rows[r][col]))
+        if rows[pivot][col] == 0:
+            raise ValueError('Not enough distinct raw values for this degree')
+        rows[col], rows[pivot] = rows[pivot], rows[col]
+        for r in range(col + 1, n):
+            factor = rows[r][col] / rows[col][col]
+            for c in range(col, n + 1):
+                rows[r][c] -= factor * rows[col][c]
+    solution = [0.0] * n
+    for r in reversed(range(n)):
+        solution[r] = (rows[r][n] - sum(
+            rows[r][c] * solution[c] for c in range(r + 1, n))) / rows[r][r]
+    return solution
+
+
+def fit_polynomial(raw, reference, degree=1):
+    """
+    Least squares fit of a Polynomial mapping raw to reference values.
+    """
+    if len(raw) != len(reference):
+        raise ValueError('raw and reference values must be paired')
+    if len(set(raw)) <= degree:
+        raise ValueError('A polynomial of degree %d needs at least %d distinct raw values' % (
+            degree, degree + 1))
+    # Scale raw values to [-1, 1] to keep the normal equations well
+    # conditioned.
+    scale = max(abs(x) for x in raw) or 1.0
+    xs = [x / scale for x in raw]
+    powers = [[x ** k for k in range(degree + 1)] for x in xs]
+    matrix = [[sum(p[i] * p[j] for p in powers) for j in range(degree + 1)]
+              for i in range(degree + 1)]
+    vector = [sum(p[i] * y for p, y in zip(powers, reference))
+              for i in range(degree + 1)]
+    scaled = _solve(matrix, vector)
+    return Polynomial([c / scale ** k for k, c in enumerate(scaled)])
+
+
+def fit_points(raw, reference):
+    """
+    Build a PiecewiseLinear curve through the measurements, averaging the
+    reference values of repeated raw values.
+    """
+    if len(raw) != len(reference):
+        raise ValueError('raw and reference values must be paired')
+    groups = {}
+    for x, y in zip(raw, reference):
+        groups.setdefault(x, []).append(y)
+    return PiecewiseLinear((x, sum(ys) / len(ys)) for x, ys in groups.items())
+
+
+def residuals(curve, raw, reference):
+    return [curve(x) - y for x, y in zip(raw, reference)]
+
+
+def read_measurements(f):
+    """
+    Read raw,reference pairs from a CSV file. Lines that do not start with
+    two numbers (like a header) are skipped.
+    """
+    raw, reference = [], []
+    for row in csv.reader(f):
+        if len(row) < 2:
+            continue
+        try:
+            x, y = float(row[0]), float(row[1])
+        except ValueError:
+            continue
+        raw.append(x)
+        reference.append(y)
+    return raw, reference
+
+
+def parse_args():
+    descr = "Fit a calibration curve to reference measurements and print " \
+            "the line to add to /etc/temper.conf."
+
+    parser = argparse.ArgumentParser(description=descr)
+    parser.add_argument("file", type=argparse.FileType('r'),
+                        help="CSV file of uncalibrated,reference value pairs ('-' for stdin)")
+    parser.add_argument("-d", "--device", default='1-1',
+                        help="Bus and ports of the device, e.g. 1-4.3 (default: %(default)s)")
+    parser.add_argument("-s", "--sensor", type=int, default=0,
+                        help="Sensor number (default: %(default)s)")
+    parser.add_argument("-q", "--quantity", choices=QUANTITIES, default='temperature',
+                        help="Calibrated quantity (default: %(default)s)")
+    parser.add_argument("-k", "--kind", choices=CURVE_KINDS, default='poly',
+                        help="Curve kind (default: %(default)s)")
+    parser.add_argument("--degree", type=int, default=1,
+                        help="Polynomial degree (default: %(default)s)")
+    parser.add_argument("--digits", type=int, default=6,
+                        help="Significant digits of the printed curve (default: %(default)s)")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    with args.file:
+        raw, reference = read_measurements(args.file)
+    if not raw:
+        raise SystemExit('No measurements found')
+    if args.kind == 'points':
+        curve = fit_points(raw, reference)
+    else:
+        curve = fit_polynomial(raw, reference, args.degree)
+    errors = residuals(curve, raw, reference)
+    print('%s sensor %i %s: %s' % (args.device, args.sensor, args.quantity, curve.describe(args.digits)))
+    print('# %i measurements, max. residual %.4f, rms residual %.4f' % (
+        len(errors), max(abs(e) for e in errors),
+        (sum(e * e for e in errors) / len(errors)) ** 0.5))
+
+
+if __name__ == '__main__':
+    main()
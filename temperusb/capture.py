@@ -0,0 +1,291 @@
+# encoding: utf-8
+#
+# Capture raw reports from TEMPer devices and replay them through the
+# decoding of temper.py.
+#
+# Copyright 2012-2020 Philipp Adelt <info@philipp.adelt.net> and contributors.
+#
+# This code is licensed under the GNU public license (GPL). See LICENSE.md for
+# details.
+#
+# File format (all integers little endian):
+#   b'TEMPCAP1'
+#   followed by records starting with a one byte tag:
+#   b'D' device:  id (H), scale (d), offset (d), then product, bus and ports
+#                 as strings of length (H) and UTF-8 bytes
+#   b'C' curve:   device id (H), sensor (B), then quantity and the curve in
+#                 the syntax of /etc/temper.conf as strings, following the
+#                 device record for each calibration curve of the device
+#   b'R' report:  device id (H), time since the epoch (d), flags (B),
+#                 length (B) and the raw report bytes
+
+from __future__ import print_function, absolute_import
+import argparse
+import collections
+import logging
+import struct
+import time
+
+import usb
+
+from .calibration import parse_curve
+from .temper import TemperDevice, TemperHandler
+
+MAGIC = b'TEMPCAP1'
+DEVICE_HEADER = struct.Struct('<Hdd')
+CURVE_HEADER = struct.Struct('<HB')
+REPORT_HEADER = struct.Struct('<HdBB')
+STRING_HEADER = struct.Struct('<H')
+# Report flags
+FLAG_WARMUP = 0x01
+
+CapturedDevice = collections.namedtuple(
+    'CapturedDevice', ['id', 'product', 'bus', 'ports', 'scale', 'offset', 'curves'])
+CapturedReport = collections.namedtuple(
+    'CapturedReport', ['device', 'timestamp', 'flags', 'data'])
+
+
+def _pack_string(value):
+    data = str(value).encode('utf-8')
+    return STRING_HEADER.pack(len(data)) + data
+
+
+class CaptureWriter(object):
+    """
+    Record the raw reports of TemperDevices to a capture file.
+    """
+    def __init__(self, f):
+        self._file = f
+        self._devices = {}
+        self._file.write(MAGIC)
+
+    def attach(self, device):
+        """
+        Record all reports <device> reads from now on.
+        """
+        device_id = len(self._devices)
+        self._devices[device_id] = device
+        self._file.write(b'D' + DEVICE_HEADER.pack(
+            device_id, device._scale, device._offset))
+        for value in (device.get_product(), device.get_bus(), device.get_ports()):
+            self._file.write(_pack_string(value))
+        for (quantity, sensor), curve in sorted(device._curves.items()):
+            self._file.write(b'C' + CURVE_HEADER.pack(device_id, sensor) +
+                             _pack_string(quantity) + _pack_string(curve.describe()))
+
+        interrupt_read = device._interrupt_read
+        open_session = device._open_session
+        state = {'flags': 0}
+
+        def recording_open_session(*args, **kwargs):
+            # Reads while opening the session are warm-up reads
+            state['flags'] = FLAG_WARMUP
+            try:
+                return open_session(*args, **kwargs)
+            finally:
+                state['flags'] = 0
+
+        def recording_interrupt_read():
+            data = interrupt_read()
+            self.write_report(device_id, bytes(data), state['flags'])
+            return data
+
+        device._open_session = recording_open_session
+        device._interrupt_read = recording_interrupt_read
+        return device_id
+
+    def write_report(self, device_id, data, flags=0, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        self._file.write(b'R' + REPORT_HEADER.pack(
+            device_id, timestamp, flags, len(data)) + data)
+
+    def flush(self):
+        self._file.flush()
+
+
+def _read_exact(f, size):
+    data = f.read(size)
+    if len(data) != size:
+        raise ValueError('Truncated capture file')
+    return data
+
+
+def _read_string(f):
+    length, = STRING_HEADER.unpack(_read_exact(f, STRING_HEADER.size))
+    return _read_exact(f, length).decode('utf-8')
+
+
+def read_capture(f):
+    """
+    Read a capture file. Returns a dictionary of CapturedDevices by id and
+    the list of CapturedReports in recording order.
+    """
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError('Not a temperusb capture file')
+    devices = {}
+    reports = []
+    while True:
+        tag = f.read(1)
+        if not tag:
+            return devices, reports
+        if tag == b'D':
+            device_id, scale, offset = DEVICE_HEADER.unpack(
+                _read_exact(f, DEVICE_HEADER.size))
+            strings = [_read_string(f) for _ in range(3)]
+            devices[device_id] = CapturedDevice(
+                device_id, strings[0], strings[1], strings[2], scale, offset, {})
+        elif tag == b'C':
+            device_id, sensor = CURVE_HEADER.unpack(_read_exact(f, CURVE_HEADER.size))
+            quantity = _read_string(f)
+            devices[device_id].curves[(quantity, sensor)] = parse_curve(_read_string(f))
+        elif tag == b'R':
+            device_id, timestamp, flags, length = REPORT_HEADER.unpack(
+                _read_exact(f, REPORT_HEADER.size))
+            reports.append(CapturedReport(
+                device_id, timestamp, flags, _read_exact(f, length)))
+        else:
+            raise ValueError('Unknown record %r in capture file' % tag)
+
+
+class _ReplayUSBDevice(object):
+    """
+    The attributes of a usb.core.Device that TemperDevice looks at.
+    """
+    def __init__(self, captured):
+        self.product = captured.product
+        self.bus = int(captured.bus) if captured.bus.isdigit() else captured.bus
+        self.port_number = captured.ports
+        self.address = captured.id
+
+
+class ReplayDevice(TemperDevice):
+    """
+    A TemperDevice reading captured reports instead of talking to USB.
+    Reports are queued with feed().
+    """
+    def __init__(self, captured):
+        self._reports = collections.deque()
+        super(ReplayDevice, self).__init__(_ReplayUSBDevice(captured))
+        self.set_calibration_data(captured.scale, captured.offset, captured.curves)
+
+    def feed(self, data):
+        self._reports.append(data)
+
+    def _open_session(self, reset_device=False):
+        pass
+
+    def _close_session(self):
+        pass
+
+    def _control_transfer(self, data):
+        pass
+
+    def _interrupt_read(self):
+        if not self._reports:
+            raise usb.USBError('No more captured reports')
+        return self._reports.popleft()
+
+
+def replay(f, pace=False, callback=None):
+    """
+    Decode all reports of a capture file with ReplayDevices.
+
+    Params:
+    - pace: if True, keep the original time between reports, otherwise
+      decode as fast as possible
+    - callback: called with the (last) CapturedReport, the ReplayDevice and
+      the result of get_readings() for each reading
+
+    Returns a dictionary with the number of decoded 'reports', the elapsed
+    'seconds' and the resulting 'reports_per_second'.
+    """
+    captured, reports = read_capture(f)
+    devices = dict((i, ReplayDevice(c)) for i, c in captured.items())
+
+    count = 0
+    first = None
+    start = time.monotonic()
+    for report in reports:
+        if report.flags & FLAG_WARMUP:
+            continue
+        if pace:
+            if first is None:
+                first = report.timestamp
+            delay = report.timestamp - first - (time.monotonic() - start)
+            if delay > 0:
+                time.sleep(delay)
+        device = devices[report.device]
+        device.feed(report.data)
+        count += 1
+        # Devices spreading their values over several reports need all of
+        # them for one reading
+        if len(device._reports) < len(device.commands):
+            continue
+        readings = device.get_readings()
+        if callback is not None:
+            callback(report, device, readings)
+    elapsed = time.monotonic() - start
+    return {
+        'reports': count,
+        'seconds': elapsed,
+        'reports_per_second': count / elapsed if elapsed > 0 else float('inf'),
+    }
+
+
+def parse_args():
+    descr = "Capture raw reports of TEMPer devices or replay a capture."
+
+    parser = argparse.ArgumentParser(description=descr)
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    record = subparsers.add_parser('record', help="Capture reports of all devices")
+    record.add_argument("file", help="Capture file to write")
+    record.add_argument("-n", "--count", type=int, default=10,
+                        help="Number of readings per device")
+    record.add_argument("-i", "--interval", type=float, default=1.0,
+                        help="Seconds between readings")
+    play = subparsers.add_parser('replay', help="Decode a capture file")
+    play.add_argument("file", help="Capture file to read")
+    play.add_argument("--pace", action='store_true',
+                      help="Keep the original time between reports")
+    play.add_argument("-q", "--quiet", action='store_true',
+                      help="Only print the throughput")
+    parser.add_argument("-v", "--verbose", action='store_true',
+                        help="Verbose: display all debug information")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING)
+
+    if args.command == 'record':
+        devs = TemperHandler().get_devices()
+        with open(args.file, 'wb') as f:
+            writer = CaptureWriter(f)
+            for dev in devs:
+                writer.attach(dev)
+            for i in range(args.count):
+                if i:
+                    time.sleep(args.interval)
+                for dev in devs:
+                    dev.get_readings()
+                writer.flush()
+        print("Captured %i readings of %i devices" % (args.count, len(devs)))
+    else:
+        def show(report, device, readings):
+            for sensor in sorted(readings):
+                print('%.6f device %i sensor %i: %s' % (
+                    report.timestamp, report.device, sensor,
+                    ' '.join('%s=%s' % (k, readings[sensor][k]) for k in (
+                        'temperature_c', 'humidity_pc') if k in readings[sensor])))
+
+        with open(args.file, 'rb') as f:
+            stats = replay(f, pace=args.pace, callback=None if args.quiet else show)
+        print("Replayed %(reports)i reports in %(seconds).3fs "
+              "(%(reports_per_second).0f reports/s)" % stats)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,7 +3,7 @@ from __future__ import print_function, absolute_import
 import argparse
 import logging
 
-from .temper import TemperHandler
+from .temper import TemperHandler, MAX_SENSOR_COUNT
 
 
 def parse_args():
@@ -19,7 +19,8 @@ def parse_args():
                        help="Quiet: just degrees fahrenheit as decimal")
     units.add_argument("-H", "--humidity", action='store_true',
                        help="Quiet: just percentage relative humidity as decimal")
-    parser.add_argument("-s", "--sensor_ids", choices=['0', '1', 'all'],
+    parser.add_argument("-s", "--sensor_ids",
+                        choices=[str(i) for i in range(MAX_SENSOR_COUNT)] + ['all'],
                         help="IDs of sensors to use on the device " +
                         "(multisensor devices only)", default='0')
     parser.add_argument("-S", "--sensor_count", type=int,
@@ -56,17 +57,8 @@ def main():
         else:
             sensors = [int(args.sensor_ids)]
 
-        temperatures = dev.get_temperatures(sensors=sensors)
-        humidities = dev.get_humidity(sensors=sensors)
-        combinations = {}
-        for k, v in temperatures.items():
-            c = v.copy()
-            try:
-                c.update(humidities[k])
-            except:
-                pass
-            combinations[k] = c
-        readings.append(combinations)
+        # Temperatures and humidities of all sensors from one USB session
+        readings.append(dev.get_readings(sensors=sensors))
 
     for i, reading in enumerate(readings):
         output = ''
@@ -16,15 +16,38 @@ class TemperType(Enum):
     SI7021 = 1
 
 class TemperConfig:
+    """
+    Describes where a device reports its sensor values.
+
+    Params:
+    - temp_sens_offsets: byte offset of each temperature sensor's value
+    - hum_sens_offsets: byte offset of each humidity sensor's value, if any
+    - type: the encoding of the values
+    - commands: names of the commands (see temper.COMMANDS) sent before
+      each report read per reading; None means no command is sent and the
+      next report is read straight away. Defaults to a single 'temp'
+      command and report.
+    - temp_sens_reports, hum_sens_reports: index into <commands> of the
+      report each sensor's value is in, defaults to the first report
+    """
     def __init__(
         self,
         temp_sens_offsets: list,
         hum_sens_offsets: list = None,
         type: TemperType = TemperType.FM75,
+        commands: list = None,
+        temp_sens_reports: list = None,
+        hum_sens_reports: list = None,
     ):
         self.temp_sens_offsets = temp_sens_offsets
         self.hum_sens_offsets = hum_sens_offsets
         self.type = type
+        self.commands = commands or ['temp']
+        self.temp_sens_reports = temp_sens_reports or [0] * len(temp_sens_offsets)
+        if hum_sens_offsets:
+            self.hum_sens_reports = hum_sens_reports or [0] * len(hum_sens_offsets)
+        else:
+            self.hum_sens_reports = None
 
 
 DEVICE_LIBRARY = {
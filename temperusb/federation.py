@@ -0,0 +1,479 @@
+# encoding: utf-8
+#
+# Serve readings over HTTP and collect them from many hosts.
+#
+# Copyright 2012-2020 Philipp Adelt <info@philipp.adelt.net> and contributors.
+#
+# This code is licensed under the GNU public license (GPL). See LICENSE.md for
+# details.
+#
+# Every host runs a ReadingsServer, which keeps the latest readings of its
+# devices cached and answers GET /readings with a JSON document:
+#
+#   {"name": "<host name>",
+#    "devices": [{"bus": 1, "ports": "1.2", "product": "...",
+#                 "sensor_count": 2, "age": 1.5, "error": null,
+#                 "readings": {"0": {"temperature_c": 21.5, ...}, ...}}]}
+#
+# "age" is the number of seconds since the readings were taken, so the
+# collector needs no synchronized clocks. A Collector fetches all hosts in
+# parallel over kept-alive HTTP/1.1 connections and provides the merged
+# readings through the same read methods as TemperHandler and TemperDevice.
+
+from __future__ import print_function, absolute_import
+import argparse
+import http.client
+import json
+import logging
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .proxy import ProxyDevice, device_info
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_PORT = 7301
+READINGS_PATH = '/readings'
+DEVICE_KEYS = ('bus', 'ports', 'product', 'sensor_count', 'age', 'error', 'readings')
+
+
+class _HTTPServer(ThreadingHTTPServer):
+    """
+    HTTP server that can also close the kept-alive connections it serves.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, readings_server):
+        self.readings_server = readings_server
+        self.connections = set()
+        self.connections_lock = threading.Lock()
+        ThreadingHTTPServer.__init__(self, address, _RequestHandler)
+
+    def close_connections(self):
+        with self.connections_lock:
+            for conn in self.connections:
+                try:
+                    conn.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        with self.server.connections_lock:
+            self.server.connections.add(self.request)
+
+    def finish(self):
+        with self.server.connections_lock:
+            self.server.connections.discard(self.request)
+        BaseHTTPRequestHandler.finish(self)
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != READINGS_PATH:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = json.dumps(self.server.readings_server.snapshot()).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        LOGGER.debug('%s - %s', self.address_string(), format % args)
+
+
+class ReadingsServer(object):
+    """
+    Serve the latest readings of a TemperHandler's devices over HTTP.
+    Readings are taken every <refresh> seconds via
+    TemperHandler.subscribe(), so requests never wait for USB.
+
+    Params:
+    - address: (host, port) to listen on, port 0 picks a free port
+    - name: name reported to collectors (default: the host name)
+    - max_age: seconds after which the readings of a device are served with
+      an error, e.g. while reading it fails (default: three refreshes)
+    """
+    def __init__(self, handler, address=('', DEFAULT_PORT), refresh=5.0, name=None,
+                 max_age=None):
+        self.name = name or socket.gethostname()
+        self.max_age = max_age if max_age is not None else 3 * refresh
+        self._handler = handler
+        self._readings = {}
+        self._times = {}
+        self._lock = threading.Lock()
+        self._httpd = _HTTPServer(address, self)
+        self._thread = None
+        self._subscription = handler.subscribe(
+            self._received, min_interval=refresh, policy='coalesce')
+
+    @property
+    def address(self):
+        return self._httpd.server_address
+
+    def _received(self, device, readings):
+        with self._lock:
+            self._readings[device] = readings
+            self._times[device] = time.monotonic()
+
+    def snapshot(self):
+        """
+        Get the document served on /readings.
+        """
+        now = time.monotonic()
+        devices = []
+        with self._lock:
+            for dev in self._handler.get_devices():
+                info = device_info(dev)
+                readings = self._readings.get(dev)
+                info['readings'] = dict(
+                    (str(sensor), reading) for sensor, reading in (readings or {}).items())
+                info['age'] = now - self._times[dev] if dev in self._times else None
+                if readings is None:
+                    info['error'] = 'No readings yet'
+                elif info['age'] > self.max_age:
+                    info['error'] = 'No current readings for %.0f seconds' % info['age']
+                else:
+                    info['error'] = None
+                devices.append(info)
+        return {'name': self.name, 'devices': devices}
+
+    def serve_forever(self):
+        self._httpd.serve_forever()
+
+    def start(self):
+        """
+        Serve requests in a background thread.
+        """
+        self._thread = threading.Thread(target=self.serve_forever, name='temper-readings-server')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        self._subscription.unsubscribe()
+        if self._thread is not None:
+            self._httpd.shutdown()
+            self._thread.join()
+            self._thread = None
+        self._httpd.server_close()
+        self._httpd.close_connections()
+
+
+def _parse_host(host):
+    if isinstance(host, tuple):
+        return host
+    name, _, port = host.rpartition(':')
+    if not name:
+        return host, DEFAULT_PORT
+    return name, int(port)
+
+
+def _parse_devices(document):
+    """
+    Check the shape of a /readings document and return its devices with
+    the sensor numbers converted back to integers. Raises ValueError if it
+    is not a readings document.
+    """
+    try:
+        devices = []
+        for info in document['devices']:
+            info = dict(info)
+            missing = [key for key in DEVICE_KEYS if key not in info]
+            if missing:
+                raise KeyError(', '.join(missing))
+            info['readings'] = dict(
+                (int(sensor), dict(reading)) for sensor, reading in info['readings'].items())
+            devices.append(info)
+        return devices
+    except (KeyError, TypeError, AttributeError, ValueError) as e:
+        raise ValueError('Not a readings document (%s: %s)' % (e.__class__.__name__, e))
+
+
+class _Host(object):
+    """
+    Connection and last result of one remote host.
+    """
+    def __init__(self, host):
+        self.address = _parse_host(host)
+        self.key = '%s:%d' % self.address
+        self.name = None
+        self.conn = None
+        self.lock = threading.Lock()
+        self.devices = []
+        self.fetched = None
+        self.error = None
+
+
+class RemoteDevice(ProxyDevice):
+    """
+    Stand-in for a TemperDevice of a remote host, serving the readings of
+    the Collector's last fetch.
+    """
+    def __init__(self, collector, host, info):
+        super(RemoteDevice, self).__init__(info)
+        self._collector = collector
+        self._host = host
+
+    def __repr__(self):
+        return '<RemoteDevice %s bus %s ports %s>' % ((self._host,) + self._key)
+
+    def get_host(self):
+        return self._host
+
+    def _read(self):
+        """
+        Get the readings of the last fetch. Raises RuntimeError if the
+        readings of the host are stale.
+        """
+        return self._collector._device_readings(self._host, *self._key)
+
+
+class Collector(object):
+    """
+    Collect readings from many ReadingsServers.
+
+    All hosts are fetched in parallel, reusing one HTTP connection per
+    host. The readings of a host are stale when its last successful fetch
+    is more than <max_age> seconds old, the readings of a device when they
+    were taken more than <max_age> seconds ago.
+
+    Params:
+    - hosts: list of "host:port" strings or (host, port) tuples
+    - timeout: seconds a fetch may take
+    - max_age: seconds after which readings are stale
+    - max_workers: maximum number of hosts fetched at the same time
+    """
+    def __init__(self, hosts, timeout=5.0, max_age=30.0, max_workers=32):
+        self._hosts = dict((h.key, h) for h in (_Host(host) for host in hosts))
+        self.timeout = timeout
+        self.max_age = max_age
+        self._executor = ThreadPoolExecutor(
+            max_workers=max(1, min(max_workers, len(self._hosts))))
+        self._stop = threading.Event()
+        self._thread = None
+        self.stats = {'fetches': 0, 'errors': 0, 'connects': 0}
+
+    def _request(self, host):
+        """
+        GET /readings from a host, reconnecting once if a kept-alive
+        connection was closed by the server meanwhile.
+        """
+        for attempt in range(2):
+            reused = host.conn is not None
+            if not reused:
+                host.conn = http.client.HTTPConnection(*host.address, timeout=self.timeout)
+                self.stats['connects'] += 1
+            try:
+                host.conn.request('GET', READINGS_PATH)
+                response = host.conn.getresponse()
+                body = response.read()
+            except (OSError, http.client.HTTPException):
+                host.conn.close()
+                host.conn = None
+                if reused and not attempt:
+                    continue
+                raise
+            if response.status != 200:
+                raise RuntimeError('HTTP status %d' % response.status)
+            return json.loads(body.decode('utf-8'))
+
+    def _fetch(self, host):
+        with host.lock:
+            try:
+                document = self._request(host)
+            except (OSError, http.client.HTTPException, RuntimeError, ValueError) as e:
+                LOGGER.warning('Fetching readings from %s failed: %s', host.key, e)
+                host.error = str(e)
+                self.stats['errors'] += 1
+                return False
+            fetched = time.monotonic()
+            try:
+                devices = _parse_devices(document)
+            except ValueError as e:
+                LOGGER.warning('Unexpected readings from %s: %s', host.key, e)
+                host.error = str(e)
+                self.stats['errors'] += 1
+                return False
+            host.name = document.get('name')
+            host.devices = devices
+            host.fetched = fetched
+            host.error = None
+            self.stats['fetches'] += 1
+            return True
+
+    def refresh(self):
+        """
+        Fetch all hosts in parallel. Returns the number of hosts fetched
+        successfully.
+        """
+        return sum(self._executor.map(self._fetch, list(self._hosts.values())))
+
+    def start(self, interval=5.0):
+        """
+        Refresh all hosts every <interval> seconds in a background thread.
+        """
+        def loop():
+            while True:
+                try:
+                    self.refresh()
+                except Exception:
+                    LOGGER.exception('Exception refreshing hosts')
+                if self._stop.wait(interval):
+                    return
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=loop, name='temper-collector')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def close(self):
+        self.stop()
+        self._executor.shutdown()
+        for host in self._hosts.values():
+            with host.lock:
+                if host.conn is not None:
+                    host.conn.close()
+                    host.conn = None
+
+    def _is_stale(self, host, now):
+        return host.fetched is None or now - host.fetched > self.max_age
+
+    def host_status(self):
+        """
+        Get a dictionary of the state of every host: its name, the seconds
+        since its last successful fetch (None if never), whether its
+        readings are stale and the error of the last fetch.
+        """
+        now = time.monotonic()
+        return dict((key, {
+            'name': host.name,
+            'age': None if host.fetched is None else now - host.fetched,
+            'stale': self._is_stale(host, now),
+            'error': host.error,
+        }) for key, host in self._hosts.items())
+
+    def get_readings(self, include_stale=False):
+        """
+        Get the merged readings of all hosts as a dictionary keyed by
+        (host, bus, ports, sensor). Each reading has an additional 'age'
+        in seconds since it was taken on its host.
+        """
+        now = time.monotonic()
+        merged = {}
+        for key, host in self._hosts.items():
+            if self._is_stale(host, now) and not include_stale:
+                continue
+            since_fetch = now - host.fetched if host.fetched is not None else 0.0
+            for info in host.devices:
+                if info['age'] is None:
+                    continue
+                age = info['age'] + since_fetch
+                if age > self.max_age and not include_stale:
+                    continue
+                for sensor, reading in info['readings'].items():
+                    reading = dict(reading)
+                    reading['age'] = age
+                    merged[(key, info['bus'], info['ports'], sensor)] = reading
+        return merged
+
+    def _device_readings(self, key, bus, ports):
+        host = self._hosts[key]
+        now = time.monotonic()
+        if self._is_stale(host, now):
+            raise RuntimeError('Readings of %s are stale: %s' % (key, host.error))
+        for info in host.devices:
+            if info['bus'] == bus and info['ports'] == ports:
+                if info['error']:
+                    raise RuntimeError('%s bus %s ports %s: %s' % (key, bus, ports, info['error']))
+                age = info['age'] + now - host.fetched
+                if age > self.max_age:
+                    raise RuntimeError('Readings of %s bus %s ports %s are %.0f seconds old' % (
+                        key, bus, ports, age))
+                return dict((sensor, dict(reading))
+                            for sensor, reading in info['readings'].items())
+        raise RuntimeError('%s has no device on bus %s ports %s' % (key, bus, ports))
+
+    def get_devices(self):
+        """
+        Get a list of the devices of all hosts as of the last fetch.
+        """
+        return [RemoteDevice(self, key, info)
+                for key, host in sorted(self._hosts.items())
+                for info in host.devices]
+
+    def rescan(self, replace=None):
+        """
+        Fetch all hosts again and return the devices found.
+        """
+        self.refresh()
+        return self.get_devices()
+
+
+def parse_args():
+    descr = "Serve readings of TEMPer devices over HTTP or collect them from many hosts."
+
+    parser = argparse.ArgumentParser(description=descr)
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    serve = subparsers.add_parser('serve', help="Serve the readings of all local devices")
+    serve.add_argument("-b", "--bind", default='',
+                       help="Address to listen on (default: all)")
+    serve.add_argument("-p", "--port", type=int, default=DEFAULT_PORT,
+                       help="Port to listen on (default: %(default)s)")
+    serve.add_argument("--refresh", type=float, default=5.0,
+                       help="Seconds between readings (default: %(default)s)")
+    collect = subparsers.add_parser('collect', help="Print the readings of remote hosts")
+    collect.add_argument("hosts", nargs='+', help="host:port of each server")
+    collect.add_argument("--timeout", type=float, default=5.0,
+                         help="Seconds a fetch may take (default: %(default)s)")
+    parser.add_argument("-v", "--verbose", action='store_true',
+                        help="Verbose: display all debug information")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING)
+
+    if args.command == 'serve':
+        from .temper import TemperHandler
+        server = ReadingsServer(TemperHandler(), (args.bind, args.port), args.refresh)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+    else:
+        collector = Collector(args.hosts, timeout=args.timeout)
+        try:
+            collector.refresh()
+            for key, status in sorted(collector.host_status().items()):
+                if status['error']:
+                    print('%s: %s' % (key, status['error']))
+            for (host, bus, ports, sensor), reading in sorted(collector.get_readings().items()):
+                print('%s bus %s ports %s sensor %i: %s' % (
+                    host, bus, ports, sensor,
+                    ' '.join('%s=%s' % (k, reading[k]) for k in (
+                        'temperature_c', 'humidity_pc') if k in reading)))
+        finally:
+            collector.close()
+
+
+if __name__ == '__main__':
+    main()
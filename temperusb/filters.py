@@ -0,0 +1,125 @@
+# encoding: utf-8
+#
+# Filters reducing the readings passed on downstream.
+#
+# Copyright 2012-2020 Philipp Adelt <info@philipp.adelt.net> and contributors.
+#
+# This code is licensed under the GNU public license (GPL). See LICENSE.md for
+# details.
+
+import time
+
+# Reading keys of the quantities a deadband applies to.
+QUANTITIES = {
+    'temperature': 'temperature_c',
+    'humidity': 'humidity_pc',
+}
+
+
+class Deadband(object):
+    """
+    A band around the last emitted value in which changes are ignored, given
+    either in absolute units or in percent of the last emitted value.
+    """
+    def __init__(self, absolute=None, percent=None):
+        if (absolute is None) == (percent is None):
+            raise ValueError('Give either absolute or percent')
+        self.absolute = absolute
+        self.percent = percent
+
+    def exceeded(self, last, value):
+        """
+        Check whether <value> moved out of the band around <last>.
+        """
+        if self.absolute is not None:
+            return abs(value - last) > self.absolute
+        return abs(value - last) > abs(last) * self.percent / 100.0
+
+
+def reading_key(reading):
+    """
+    Identify the sensor a reading belongs to.
+    """
+    return (reading.get('bus', ''), reading.get('ports', ''), reading.get('sensor', 0))
+
+
+class DeadbandFilter(object):
+    """
+    Pass on a sensor's reading only when its temperature or humidity moved
+    beyond the deadband since the last reading passed on, or when
+    <heartbeat> seconds have elapsed since then.
+
+    Params:
+    - temperature, humidity: default Deadband for all sensors (None passes
+      every change)
+    - heartbeat: seconds after which a reading is passed on regardless
+      (None to disable)
+    - sensors: optional dictionary mapping (bus, ports, sensor) to a
+      dictionary with 'temperature' and/or 'humidity' Deadbands overriding
+      the defaults for that sensor
+    """
+    def __init__(self, temperature=None, humidity=None, heartbeat=None,
+                 sensors=None):
+        self.defaults = {'temperature': temperature, 'humidity': humidity}
+        self.heartbeat = heartbeat
+        self.sensors = dict(sensors or {})
+        self._last = {}
+        self.stats = {'emitted': 0, 'suppressed': 0}
+
+    def _deadband(self, key, quantity):
+        return self.sensors.get(key, {}).get(quantity, self.defaults[quantity])
+
+    def _changed(self, key, reading, last):
+        for quantity, field in QUANTITIES.items():
+            value = reading.get(field)
+            if value is None:
+                continue
+            previous = last['reading'].get(field)
+            if previous is None:
+                return True
+            deadband = self._deadband(key, quantity)
+            if deadband is None:
+                if value != previous:
+                    return True
+            elif deadband.exceeded(previous, value):
+                return True
+        return False
+
+    def filter(self, readings, now=None):
+        """
+        Return the readings from an iterable that should be passed on.
+        <now> is a monotonic timestamp and defaults to the current time.
+        """
+        if now is None:
+            now = time.monotonic()
+        emitted = []
+        for reading in readings:
+            key = reading_key(reading)
+            last = self._last.get(key)
+            if (last is None
+                    or (self.heartbeat is not None
+                        and now - last['time'] >= self.heartbeat)
+                    or self._changed(key, reading, last)):
+                self._last[key] = {'reading': reading, 'time': now}
+                emitted.append(reading)
+            else:
+                self.stats['suppressed'] += 1
+        self.stats['emitted'] += len(emitted)
+        return emitted
+
+    def poll(self, handler):
+        """
+        Read all devices of a TemperHandler once and return the readings
+        that should be passed on.
+        """
+        readings = []
+        for dev in handler.get_devices():
+            readings.extend(dev.get_readings().values())
+        return self.filter(readings)
+
+    def reset(self):
+        """
+        Forget the last readings, so the next reading of every sensor is
+        passed on.
+        """
+        self._last.clear()
@@ -0,0 +1,81 @@
+# encoding: utf-8
+#
+# Stand-ins for TemperDevices whose readings come from elsewhere.
+#
+# Copyright 2012-2020 Philipp Adelt <info@philipp.adelt.net> and contributors.
+#
+# This code is licensed under the GNU public license (GPL). See LICENSE.md for
+# details.
+
+
+def device_info(device):
+    """
+    Get the description of a device that proxies are built from.
+    """
+    return {
+        'bus': device.get_bus(),
+        'ports': device.get_ports(),
+        'product': device.get_product(),
+        'sensor_count': device.get_sensor_count(),
+    }
+
+
+class ProxyDevice(object):
+    """
+    Base class for stand-ins of a TemperDevice, described by a dictionary
+    as returned by device_info() and identified by its bus and ports.
+
+    Subclasses implement _read().
+    """
+    def __init__(self, info):
+        self._info = info
+        self._key = (info['bus'], info['ports'])
+
+    def _read(self):
+        """
+        Get the readings of all sensors of the device.
+        """
+        raise NotImplementedError
+
+    def get_bus(self):
+        return self._info['bus']
+
+    def get_ports(self):
+        return self._info['ports']
+
+    def get_product(self):
+        return self._info['product']
+
+    def get_sensor_count(self):
+        return self._info['sensor_count']
+
+    def get_readings(self, sensors=None):
+        """
+        Get temperature and humidity readings of all or the given sensors.
+        """
+        readings = self._read()
+        if sensors is None:
+            return readings
+        return dict((sensor, readings[sensor]) for sensor in sensors)
+
+    def get_temperatures(self, sensors=None):
+        return self.get_readings(sensors)
+
+    def get_temperature(self, format='celsius', sensor=0):
+        reading = self.get_readings([sensor])[sensor]
+        if format == 'celsius':
+            return reading['temperature_c']
+        elif format == 'fahrenheit':
+            return reading['temperature_f']
+        elif format == 'millicelsius':
+            return reading['temperature_mc']
+        else:
+            raise ValueError("Unknown format")
+
+    def get_humidity(self, sensors=None):
+        readings = self.get_readings(sensors)
+        return dict((sensor, reading) for sensor, reading in readings.items()
+                    if 'humidity_pc' in reading)
+
+    def close(self):
+        pass
@@ -0,0 +1,209 @@
+# encoding: utf-8
+#
+# In-process publish/subscribe of readings from one poll loop.
+#
+# Copyright 2012-2020 Philipp Adelt <info@philipp.adelt.net> and contributors.
+#
+# This code is licensed under the GNU public license (GPL). See LICENSE.md for
+# details.
+
+import collections
+import logging
+import threading
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+POLICIES = ('drop_oldest', 'coalesce')
+# Seconds by which scheduled read times may differ from the exact interval
+# due to floating point rounding.
+INTERVAL_TOLERANCE = 1e-6
+
+
+def _device_key(device):
+    return (device.get_bus(), device.get_ports())
+
+
+class Subscription(object):
+    """
+    A subscriber's bounded queue of readings, delivered to its callback from
+    its own thread so a slow subscriber cannot stall the poll loop.
+
+    When the queue is full, 'drop_oldest' discards the oldest queued
+    reading, while 'coalesce' keeps only the newest reading per device.
+
+    Devices are matched by bus and ports, so a subscription to some devices
+    keeps receiving them after TemperHandler.rescan() set them up again.
+    """
+    def __init__(self, publisher, callback, devices, sensors, min_interval,
+                 queue_size, policy):
+        if policy not in POLICIES:
+            raise ValueError('Unknown policy %r, use one of %s' % (policy, POLICIES))
+        if queue_size < 1:
+            raise ValueError('queue_size must be at least 1')
+        self._publisher = publisher
+        self._callback = callback
+        self.devices = None if devices is None else set(_device_key(d) for d in devices)
+        self.sensors = sensors
+        self.min_interval = min_interval
+        self.policy = policy
+        self.queue_size = queue_size
+        self.dropped = 0
+        self._queue = collections.OrderedDict()
+        self._seq = 0
+        self._last = {}
+        self._cond = threading.Condition()
+        self._active = True
+        self._thread = threading.Thread(target=self._deliver, name='temper-subscriber')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def wants(self, device):
+        return self.devices is None or _device_key(device) in self.devices
+
+    def _offer(self, device, readings, now):
+        """
+        Queue the readings of a device unless min_interval has not passed
+        since the last readings of it were queued. <now> is the time the
+        read was scheduled for.
+        """
+        last = self._last.get(device)
+        if last is not None and now - last < self.min_interval - INTERVAL_TOLERANCE:
+            return
+        if self.sensors is not None:
+            readings = dict((s, r) for s, r in readings.items() if s in self.sensors)
+            if not readings:
+                return
+        self._last[device] = now
+        with self._cond:
+            if self.policy == 'coalesce':
+                key = device
+                if key in self._queue:
+                    # Replace the waiting readings, keeping their position
+                    self._queue[key] = (device, readings)
+                    self.dropped += 1
+                    return
+            else:
+                self._seq += 1
+                key = self._seq
+            if len(self._queue) >= self.queue_size:
+                self._queue.popitem(last=False)
+                self.dropped += 1
+            self._queue[key] = (device, readings)
+            self._cond.notify()
+
+    def _deliver(self):
+        while True:
+            with self._cond:
+                while self._active and not self._queue:
+                    self._cond.wait()
+                if not self._active:
+                    return
+                _, (device, readings) = self._queue.popitem(last=False)
+            try:
+                self._callback(device, readings)
+            except Exception:
+                LOGGER.exception('Exception in subscriber %r', self._callback)
+
+    def unsubscribe(self):
+        """
+        Stop delivering readings. Devices nobody else subscribed to are not
+        polled anymore.
+        """
+        with self._cond:
+            if not self._active:
+                return
+            self._active = False
+            self._cond.notify()
+        self._publisher._remove(self)
+        if threading.current_thread() is not self._thread:
+            self._thread.join()
+
+
+class Publisher(object):
+    """
+    Poll loop of a TemperHandler serving all its subscriptions. Each device
+    is read once per the shortest min_interval of its subscribers and the
+    readings are offered to all of them. The loop runs only while there are
+    subscriptions.
+    """
+    def __init__(self, handler):
+        self._handler = handler
+        self._subscriptions = []
+        self._cond = threading.Condition()
+        self._thread = None
+        self._next_due = {}
+        self.stats = {'reads': 0, 'errors': 0}
+
+    def subscribe(self, callback, devices=None, sensors=None, min_interval=5.0,
+                  queue_size=16, policy='drop_oldest'):
+        subscription = Subscription(
+            self, callback, devices,
+            None if sensors is None else set(sensors), min_interval,
+            queue_size, policy)
+        with self._cond:
+            self._subscriptions.append(subscription)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._poll, name='temper-publisher')
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify()
+        return subscription
+
+    def devices_changed(self):
+        """
+        Wake up the poll loop after the handler's devices changed, so new
+        devices are polled right away.
+        """
+        with self._cond:
+            self._cond.notify()
+
+    def _remove(self, subscription):
+        with self._cond:
+            self._subscriptions.remove(subscription)
+            self._cond.notify()
+
+    def _intervals(self):
+        """
+        Get the poll interval of every device somebody subscribed to.
+        """
+        intervals = {}
+        for device in self._handler.get_devices():
+            wanted = [s.min_interval for s in self._subscriptions if s.wants(device)]
+            if wanted:
+                intervals[device] = min(wanted)
+        return intervals
+
+    def _poll(self):
+        while True:
+            with self._cond:
+                if not self._subscriptions:
+                    self._thread = None
+                    self._next_due = {}
+                    return
+                intervals = self._intervals()
+                now = time.monotonic()
+                for device in list(self._next_due):
+                    if device not in intervals:
+                        del self._next_due[device]
+                due = [(self._next_due.setdefault(device, now), device)
+                       for device in intervals]
+                if not due:
+                    self._cond.wait()
+                    continue
+                when, device = min(due, key=lambda d: d[0])
+                if when > now:
+                    self._cond.wait(when - now)
+                    continue
+                self._next_due[device] = max(when + intervals[device], now)
+                subscriptions = [s for s in self._subscriptions if s.wants(device)]
+
+            try:
+                readings = device.get_readings()
+                self.stats['reads'] += 1
+            except Exception as e:
+                LOGGER.warning('Exception reading device %r: %s', device, e)
+                self.stats['errors'] += 1
+                continue
+            for subscription in subscriptions:
+                subscription._offer(device, readings, when)
@@ -0,0 +1,271 @@
+# encoding: utf-8
+#
+# Fixed-cadence sampling and poll scheduling of TEMPer devices.
+#
+# Copyright 2012-2020 Philipp Adelt <info@philipp.adelt.net> and contributors.
+#
+# This code is licensed under the GNU public license (GPL). See LICENSE.md for
+# details.
+
+import heapq
+import logging
+import threading
+import time
+from collections import namedtuple
+
+LOGGER = logging.getLogger(__name__)
+
+# One acquisition of a device.
+# - device: index of the device in the list given to the sampler
+# - tick: index of the tick on the sampler's grid this sample belongs to
+# - timestamp: monotonic time at the midpoint of the transfer
+# - walltime: timestamp converted to seconds since the epoch
+# - duration: seconds the transfer took
+# - missed: ticks skipped since the previous sample because reads overran
+# - readings: result of the read function (None on error)
+# - error: exception raised by the read function (None on success)
+Sample = namedtuple('Sample', [
+    'device', 'tick', 'timestamp', 'walltime', 'duration', 'missed',
+    'readings', 'error',
+])
+
+
+def read_device(device):
+    """
+    Default read function: one report with temperature and humidity.
+    """
+    return device.get_readings()
+
+
+def measure_max_rate(device, samples=20, read=read_device):
+    """
+    Measure the maximum sustainable sample rate of a device in samples per
+    second by reading it <samples> times back to back.
+    """
+    if samples < 1:
+        raise ValueError('samples must be at least 1')
+    start = time.monotonic()
+    for _ in range(samples):
+        read(device)
+    elapsed = time.monotonic() - start
+    if elapsed <= 0:
+        return float('inf')
+    return samples / elapsed
+
+
+class _SamplerBase(object):
+    """
+    Common handling of sampling threads, samples and statistics.
+    Subclasses implement _targets().
+
+    The clock and the way to wait can be replaced, e.g. to simulate time:
+    - clock: function returning the current monotonic time
+    - wait: function waiting for the given number of seconds and returning
+      True if sampling should stop (default: wait for stop())
+    """
+
+    def __init__(self, devices, callback, read=read_device, clock=time.monotonic,
+                 wait=None):
+        self._devices = list(devices)
+        self._callback = callback
+        self._read = read
+        self._clock = clock
+        self._stop = threading.Event()
+        self._wait = wait or self._stop.wait
+        self._threads = []
+        self._start = None
+        self._wall_offset = None
+        self.stats = [
+            {'samples': 0, 'missed': 0, 'errors': 0} for _ in self._devices
+        ]
+
+    def _targets(self):
+        """
+        Return a list of (name, function, args) to run in sampling threads.
+        """
+        raise NotImplementedError
+
+    def start(self):
+        """
+        Start sampling all devices. The first tick is now.
+        """
+        if self._threads:
+            raise RuntimeError('Sampler already started')
+        self._stop.clear()
+        self._start = self._clock()
+        self._wall_offset = time.time() - self._start
+        for name, target, args in self._targets():
+            thread = threading.Thread(target=target, args=args, name=name)
+            thread.daemon = True
+            self._threads.append(thread)
+            thread.start()
+
+    def stop(self):
+        """
+        Stop sampling and wait for running reads to finish.
+        """
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def run(self, duration):
+        """
+        Sample for <duration> seconds, blocking the caller.
+        """
+        self.start()
+        try:
+            self._stop.wait(duration)
+        finally:
+            self.stop()
+
+    def _wait_until(self, due):
+        """
+        Wait until monotonic time <due>. Returns True if sampling was
+        stopped meanwhile.
+        """
+        return self._wait(max(due - self._clock(), 0))
+
+    def _sample(self, index, tick, missed):
+        """
+        Read a device and pass the Sample on to the callback.
+        """
+        stats = self.stats[index]
+        readings = error = None
+        before = self._clock()
+        try:
+            readings = self._read(self._devices[index])
+        except Exception as e:
+            LOGGER.warning('Error sampling device #%d: %s', index, e)
+            error = e
+            stats['errors'] += 1
+        after = self._clock()
+
+        timestamp = (before + after) / 2
+        sample = Sample(
+            device=index,
+            tick=tick,
+            timestamp=timestamp,
+            walltime=timestamp + self._wall_offset,
+            duration=after - before,
+            missed=missed,
+            readings=readings,
+            error=error,
+        )
+        stats['samples'] += 1
+        try:
+            self._callback(sample)
+        except Exception:
+            LOGGER.exception('Exception in sample callback %r', self._callback)
+
+    def _next_tick(self, index, tick, phase, interval):
+        """
+        Get the first tick on the grid of a device that has not passed yet,
+        and the number of ticks skipped to get there.
+        """
+        elapsed = self._clock() - self._start - phase
+        next_tick = max(int(elapsed // interval) + 1, tick + 1)
+        missed = next_tick - tick - 1
+        if missed:
+            LOGGER.debug('Device #%d missed %d ticks', index, missed)
+            self.stats[index]['missed'] += missed
+        return next_tick, missed
+
+
+class FixedRateSampler(_SamplerBase):
+    """
+    Sample a list of devices at a fixed cadence.
+
+    Every device is read in its own thread on a common grid of ticks spaced
+    <interval> seconds apart on the monotonic clock, so readings of different
+    devices are correlated in time. The next tick is computed from the grid
+    rather than by sleeping after a read, so variable read durations do not
+    cause drift. Ticks that have already passed when a read finishes are
+    skipped and reported as missed.
+
+    Every sample is passed to <callback> as a Sample from the sampling
+    thread of its device. <clock> and <wait> can replace the monotonic clock
+    and waiting, see _SamplerBase.
+    """
+
+    def __init__(self, devices, interval, callback, read=read_device,
+                 clock=time.monotonic, wait=None):
+        if interval <= 0:
+            raise ValueError('interval must be positive')
+        super(FixedRateSampler, self).__init__(devices, callback, read, clock, wait)
+        self._interval = float(interval)
+
+    def _targets(self):
+        return [('temper-sampler-%d' % index, self._sample_device, (index,))
+                for index in range(len(self._devices))]
+
+    def _sample_device(self, index):
+        tick = 0
+        missed = 0
+        while not self._wait_until(self._start + tick * self._interval):
+            self._sample(index, tick, missed)
+            tick, missed = self._next_tick(index, tick, 0, self._interval)
+
+
+def hub_key(device):
+    """
+    Identify the hub a device is plugged into by its bus and the port chain
+    up to its own port.
+    """
+    ports = str(device.get_ports())
+    return (device.get_bus(), ports.rsplit('.', 1)[0] if '.' in ports else '')
+
+
+class PollScheduler(_SamplerBase):
+    """
+    Poll many devices with the reads spread evenly over their intervals.
+
+    Devices are grouped by hub (see hub_key()). Each group is polled by its
+    own thread, so groups on different buses or hubs are read in parallel,
+    while devices on the same hub are never read at the same time. Within a
+    group, the n-th of N devices is read at n/N of its interval, so bus load
+    stays flat instead of peaking once per interval.
+
+    Params:
+    - interval: default seconds between reads of a device
+    - intervals: optional dictionary mapping device indices to their own
+      interval
+    - group: function returning the group key of a device
+    - clock, wait: replacements of the monotonic clock and waiting, see
+      _SamplerBase
+
+    Samples are passed to <callback> like with FixedRateSampler, with ticks
+    counted per device.
+    """
+
+    def __init__(self, devices, interval, callback, intervals=None,
+                 read=read_device, group=hub_key, clock=time.monotonic, wait=None):
+        super(PollScheduler, self).__init__(devices, callback, read, clock, wait)
+        self._intervals = [float((intervals or {}).get(index, interval))
+                           for index in range(len(self._devices))]
+        if min(self._intervals or [interval]) <= 0:
+            raise ValueError('intervals must be positive')
+        self.groups = {}
+        for index, device in enumerate(self._devices):
+            self.groups.setdefault(group(device), []).append(index)
+
+    def _targets(self):
+        return [('temper-poll-%s' % (key,), self._poll_group, (indices,))
+                for key, indices in sorted(self.groups.items(), key=lambda g: str(g[0]))]
+
+    def _poll_group(self, indices):
+        # Queue of (due time, device index, tick, missed ticks, phase)
+        queue = []
+        for position, index in enumerate(indices):
+            phase = self._intervals[index] * position / len(indices)
+            heapq.heappush(queue, (self._start + phase, index, 0, 0, phase))
+
+        while True:
+            due, index, tick, missed, phase = heapq.heappop(queue)
+            if self._wait_until(due):
+                return
+            self._sample(index, tick, missed)
+            interval = self._intervals[index]
+            tick, missed = self._next_tick(index, tick, phase, interval)
+            heapq.heappush(queue, (
+                self._start + phase + tick * interval, index, tick, missed, phase))
@@ -0,0 +1,251 @@
+# encoding: utf-8
+#
+# Publish the latest readings into a memory-mapped file for local readers.
+#
+# Copyright 2012-2020 Philipp Adelt <info@philipp.adelt.net> and contributors.
+#
+# This code is licensed under the GNU public license (GPL). See LICENSE.md for
+# details.
+#
+# Layout (all little endian):
+#   header: magic (8s), layout version (I), number of slots (I),
+#           number of used slots (I), padding, sequence counter (Q)
+#   slots:  bus (i), ports (24s), sensor (B), flags (B), padding,
+#           temperature in degrees celsius (d), relative humidity (d),
+#           time of the reading in seconds since the epoch (d)
+#
+# The single writer makes the sequence counter odd while it updates the
+# slots and even again afterwards (a seqlock). Readers copy the slots and
+# retry if the counter was odd or changed meanwhile, so they never block the
+# writer. A publisher started with more slots grows the file, but never
+# shrinks it, and readers map it again when the number of slots changes.
+
+from __future__ import print_function, absolute_import
+import argparse
+import logging
+import mmap
+import os
+import struct
+import time
+
+from .temper import TemperHandler
+
+MAGIC = b'TEMPSHM1'
+LAYOUT_VERSION = 1
+HEADER = struct.Struct('<8sIII4xQ')
+SLOTS_OFFSET = 12
+COUNT_OFFSET = 16
+SEQ_OFFSET = 24
+SEQ = struct.Struct('<Q')
+SLOT = struct.Struct('<i24sBB2xddd')
+FLAG_TEMPERATURE = 0x01
+FLAG_HUMIDITY = 0x02
+DEFAULT_PATH = '/dev/shm/temperusb'
+DEFAULT_SLOTS = 64
+LOGGER = logging.getLogger(__name__)
+
+
+def segment_size(slots):
+    return HEADER.size + slots * SLOT.size
+
+
+class ShmPublisher(object):
+    """
+    Writer of the shared memory segment. There must only be one per file.
+    """
+    def __init__(self, path=DEFAULT_PATH, slots=DEFAULT_SLOTS):
+        self.path = path
+        self.slots = slots
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            # Readers may still map the size of an earlier publisher
+            if os.fstat(fd).st_size < segment_size(slots):
+                os.ftruncate(fd, segment_size(slots))
+            self._mm = mmap.mmap(fd, segment_size(slots))
+        finally:
+            os.close(fd)
+        self._seq = 0
+        HEADER.pack_into(self._mm, 0, MAGIC, LAYOUT_VERSION, slots, 0, self._seq)
+
+    def publish(self, readings, timestamp=None):
+        """
+        Replace the published readings with an iterable of readings as
+        returned per sensor by TemperDevice.get_readings().
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        slots = []
+        for reading in readings:
+            flags = 0
+            temperature = reading.get('temperature_c')
+            humidity = reading.get('humidity_pc')
+            if temperature is not None:
+                flags |= FLAG_TEMPERATURE
+            if humidity is not None:
+                flags |= FLAG_HUMIDITY
+            bus = reading.get('bus')
+            slots.append(SLOT.pack(
+                bus if isinstance(bus, int) else -1,
+                str(reading.get('ports', '')).encode('ascii'),
+                reading.get('sensor', 0),
+                flags,
+                temperature if temperature is not None else float('nan'),
+                humidity if humidity is not None else float('nan'),
+                timestamp,
+            ))
+        if len(slots) > self.slots:
+            LOGGER.warning('Only %d of %d readings fit into %s',
+                           self.slots, len(slots), self.path)
+            slots = slots[:self.slots]
+
+        data = b''.join(slots)
+        self._seq += 1
+        SEQ.pack_into(self._mm, SEQ_OFFSET, self._seq)
+        self._mm[HEADER.size:HEADER.size + len(data)] = data
+        struct.pack_into('<I', self._mm, COUNT_OFFSET, len(slots))
+        self._seq += 1
+        SEQ.pack_into(self._mm, SEQ_OFFSET, self._seq)
+
+    def poll(self, handler):
+        """
+        Read all devices of a TemperHandler once and publish the readings.
+        """
+        readings = []
+        for dev in handler.get_devices():
+            try:
+                readings.extend(dev.get_readings().values())
+            except Exception as e:
+                LOGGER.warning('Exception reading device %r: %s', dev, e)
+        self.publish(readings)
+
+    def close(self):
+        self._mm.close()
+
+
+class ShmReader(object):
+    """
+    Reader of the shared memory segment. Lookups only touch the mapped
+    memory.
+    """
+    def __init__(self, path=DEFAULT_PATH, retries=10000):
+        self.path = path
+        self.retries = retries
+        self._mm = None
+        self._map()
+
+    def _map(self):
+        """
+        Map the file as it is now, e.g. again after a publisher with a
+        different number of slots started.
+        """
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            mm = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+        magic, version, slots, _, _ = HEADER.unpack_from(mm, 0)
+        if magic != MAGIC or version != LAYOUT_VERSION:
+            mm.close()
+            raise ValueError('%s is not a temperusb shared memory segment' % self.path)
+        if self._mm is not None:
+            self._mm.close()
+        self._mm = mm
+        # The file may already be larger, but not smaller
+        self.slots = min(slots, (len(mm) - HEADER.size) // SLOT.size)
+
+    def _snapshot(self):
+        """
+        Copy a consistent state of the used slots.
+        """
+        for _ in range(self.retries):
+            seq, = SEQ.unpack_from(self._mm, SEQ_OFFSET)
+            if seq % 2 == 0:
+                slots, count = struct.unpack_from('<II', self._mm, SLOTS_OFFSET)
+                if slots != self.slots:
+                    self._map()
+                    continue
+                count = min(count, self.slots)
+                data = self._mm[HEADER.size:HEADER.size + count * SLOT.size]
+                if SEQ.unpack_from(self._mm, SEQ_OFFSET)[0] == seq:
+                    return seq, count, data
+            # Let a writer in the same process finish its update
+            time.sleep(0)
+        raise RuntimeError('No consistent state of %s after %d attempts' % (
+            self.path, self.retries))
+
+    def version(self):
+        """
+        Get the sequence counter, which changes with every publication.
+        """
+        return SEQ.unpack_from(self._mm, SEQ_OFFSET)[0]
+
+    def read(self):
+        """
+        Get all published readings as a list of dictionaries.
+        """
+        _, count, data = self._snapshot()
+        readings = []
+        for i in range(count):
+            bus, ports, sensor, flags, temperature, humidity, timestamp = \
+                SLOT.unpack_from(data, i * SLOT.size)
+            reading = {
+                'bus': bus if bus >= 0 else '',
+                'ports': ports.rstrip(b'\x00').decode('ascii'),
+                'sensor': sensor,
+                'timestamp': timestamp,
+            }
+            if flags & FLAG_TEMPERATURE:
+                reading['temperature_c'] = temperature
+            if flags & FLAG_HUMIDITY:
+                reading['humidity_pc'] = humidity
+            readings.append(reading)
+        return readings
+
+    def get(self, bus, ports, sensor=0):
+        """
+        Get the published reading of one sensor, or None if there is none.
+        """
+        for reading in self.read():
+            if (reading['bus'] == bus and reading['ports'] == str(ports)
+                    and reading['sensor'] == sensor):
+                return reading
+        return None
+
+    def close(self):
+        self._mm.close()
+
+
+def parse_args():
+    descr = "Publish readings of all TEMPer devices into shared memory."
+
+    parser = argparse.ArgumentParser(description=descr)
+    parser.add_argument("--path", default=DEFAULT_PATH,
+                        help="File to map (default: %(default)s)")
+    parser.add_argument("-i", "--interval", type=float, default=5.0,
+                        help="Seconds between readings (default: %(default)s)")
+    parser.add_argument("--slots", type=int, default=DEFAULT_SLOTS,
+                        help="Maximum number of sensors (default: %(default)s)")
+    parser.add_argument("-v", "--verbose", action='store_true',
+                        help="Verbose: display all debug information")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING)
+
+    th = TemperHandler()
+    publisher = ShmPublisher(args.path, args.slots)
+    try:
+        while True:
+            start = time.monotonic()
+            publisher.poll(th)
+            time.sleep(max(0, args.interval - (time.monotonic() - start)))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        publisher.close()
+
+
+if __name__ == '__main__':
+    main()
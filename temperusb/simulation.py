@@ -0,0 +1,99 @@
+# encoding: utf-8
+#
+# Simulated TEMPer devices for load tests and tests without USB devices.
+#
+# Copyright 2012-2020 Philipp Adelt <info@philipp.adelt.net> and contributors.
+#
+# This code is licensed under the GNU public license (GPL). See LICENSE.md for
+# details.
+
+import random
+import time
+
+from .proxy import ProxyDevice
+from .pubsub import Publisher
+
+
+class SimulatedDevice(ProxyDevice):
+    """
+    A simulated TEMPer device. Sensor n reads <temperature> + n degrees
+    celsius, sensor 0 also <humidity> if given.
+
+    Params:
+    - latency: seconds every read takes
+    - error_rate: probability of a read failing with IOError
+    - sleep: function to wait the latency with
+
+    Reads always fail while the attribute fail is set. The attribute reads
+    counts all reads.
+    """
+    def __init__(self, bus=1, ports='1', temperature=20.0, humidity=None,
+                 sensor_count=1, product='TEMPerSimulated', latency=0.0,
+                 error_rate=0.0, sleep=time.sleep):
+        super(SimulatedDevice, self).__init__({
+            'bus': bus,
+            'ports': ports,
+            'product': product,
+            'sensor_count': sensor_count,
+        })
+        self.temperature = temperature
+        self.humidity = humidity
+        self.latency = latency
+        self.error_rate = error_rate
+        self._sleep = sleep
+        self.fail = False
+        self.opened = False
+        self.reads = 0
+
+    def __repr__(self):
+        return '<SimulatedDevice bus %s ports %s>' % self._key
+
+    def _read(self):
+        self.reads += 1
+        if self.latency:
+            self._sleep(self.latency)
+        if self.fail or (self.error_rate and random.random() < self.error_rate):
+            raise IOError('Simulated error on bus %s ports %s' % self._key)
+        readings = {}
+        for sensor in range(self.get_sensor_count()):
+            celsius = self.temperature + sensor
+            readings[sensor] = {
+                'bus': self.get_bus(),
+                'ports': self.get_ports(),
+                'sensor': sensor,
+                'temperature_c': celsius,
+                'temperature_f': celsius * 1.8 + 32.0,
+                'temperature_mc': celsius * 1000.0,
+            }
+        if self.humidity is not None:
+            readings[0]['humidity_pc'] = self.humidity
+        return readings
+
+    def open(self):
+        self.opened = True
+
+    def close(self):
+        self.opened = False
+
+
+class SimulatedHandler(object):
+    """
+    Stands in for TemperHandler with a list of simulated devices, which may
+    be changed through the attribute devices.
+    """
+    def __init__(self, devices):
+        self.devices = list(devices)
+        self._publisher = Publisher(self)
+
+    def get_devices(self):
+        return list(self.devices)
+
+    def subscribe(self, callback, sensors=None, min_interval=5.0, devices=None,
+                  queue_size=16, policy='drop_oldest'):
+        return self._publisher.subscribe(
+            callback, devices=devices, sensors=sensors,
+            min_interval=min_interval, queue_size=queue_size, policy=policy)
+
+    def rescan(self, replace=None):
+        self._publisher.devices_changed()
+        return self.get_devices()
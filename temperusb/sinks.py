@@ -0,0 +1,363 @@
+# encoding: utf-8
+#
+# Buffered output sinks pushing readings to time-series backends.
+#
+# Copyright 2012-2020 Philipp Adelt <info@philipp.adelt.net> and contributors.
+#
+# This code is licensed under the GNU public license (GPL). See LICENSE.md for
+# details.
+
+import collections
+import logging
+import os
+import socket
+import threading
+import time
+import urllib.request
+
+LOGGER = logging.getLogger(__name__)
+
+# Reading keys pushed as values, in this order.
+FIELDS = ('temperature_c', 'humidity_pc')
+
+
+def _escape_tag(value):
+    """
+    Escape a tag key or value for the InfluxDB line protocol.
+    """
+    return str(value).replace('\\', '\\\\').replace(',', '\\,') \
+        .replace('=', '\\=').replace(' ', '\\ ')
+
+
+def influx_line(reading, timestamp, measurement='temper'):
+    """
+    Format a reading as a single InfluxDB line protocol line with a
+    nanosecond timestamp, or None if the reading has no values.
+    """
+    tags = ','.join('%s=%s' % (key, _escape_tag(reading[key]))
+                    for key in ('bus', 'ports', 'sensor')
+                    if reading.get(key, '') != '')
+    fields = ','.join('%s=%r' % (key, float(reading[key]))
+                      for key in FIELDS if reading.get(key) is not None)
+    if not fields:
+        return None
+    if tags:
+        measurement = '%s,%s' % (_escape_tag(measurement), tags)
+    return '%s %s %d' % (measurement, fields, int(timestamp * 1e9))
+
+
+def graphite_lines(reading, timestamp, prefix='temper'):
+    """
+    Format a reading as Graphite plaintext lines, one per value.
+    """
+    path = '%s.bus%s.port%s.sensor%s' % (
+        prefix,
+        reading.get('bus', ''),
+        str(reading.get('ports', '')).replace('.', '_'),
+        reading.get('sensor', 0),
+    )
+    return ['%s.%s %r %d' % (path, key, float(reading[key]), int(timestamp))
+            for key in FIELDS if reading.get(key) is not None]
+
+
+class BufferedSink(object):
+    """
+    Base class for sinks sending batches of readings from a background
+    thread.
+
+    Formatted lines are kept in a buffer of at most <max_buffer> lines (the
+    oldest lines are dropped when it overflows) and sent when <batch_size>
+    lines are waiting or <flush_interval> seconds have passed. Batches that
+    cannot be sent are appended to a spool file in <spool_dir> (if given, up
+    to <max_spool_bytes>), which is drained before new data once the
+    endpoint is reachable again. Without a spool file, they are put back
+    into the buffer and sent on the next flush.
+
+    Subclasses implement format() and _send().
+    """
+
+    def __init__(self, batch_size=500, flush_interval=10.0, max_buffer=10000,
+                 spool_dir=None, max_spool_bytes=10 * 1024 * 1024):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_spool_bytes = max_spool_bytes
+        self._buffer = collections.deque(maxlen=max_buffer)
+        self._cond = threading.Condition()
+        self._send_lock = threading.Lock()
+        self._thread = None
+        self._stopping = False
+        self.spool_path = None
+        if spool_dir is not None:
+            self.spool_path = os.path.join(
+                spool_dir, '%s.spool' % self.__class__.__name__.lower())
+        self.stats = {'sent': 0, 'dropped': 0, 'spooled': 0, 'errors': 0}
+
+    def format(self, reading, timestamp):
+        """
+        Return the list of lines representing a reading.
+        """
+        raise NotImplementedError
+
+    def _send(self, lines):
+        """
+        Send a list of lines to the endpoint. Raise on failure.
+        """
+        raise NotImplementedError
+
+    def write(self, readings, timestamp=None):
+        """
+        Queue an iterable of readings as returned per sensor by
+        TemperDevice.get_readings(). <timestamp> defaults to now.
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        lines = []
+        for reading in readings:
+            lines.extend(self.format(reading, timestamp))
+        with self._cond:
+            overflow = len(self._buffer) + len(lines) - self._buffer.maxlen
+            if overflow > 0:
+                LOGGER.warning('Sink buffer full, dropping %d lines', overflow)
+                self.stats['dropped'] += min(overflow, self._buffer.maxlen)
+            self._buffer.extend(lines)
+            if len(self._buffer) >= self.batch_size:
+                self._cond.notify()
+
+    def poll(self, handler):
+        """
+        Read all devices of a TemperHandler once and queue their readings.
+        """
+        for dev in handler.get_devices():
+            self.write(dev.get_readings().values())
+
+    def start(self):
+        """
+        Start sending in a background thread.
+        """
+        if self._thread is not None:
+            raise RuntimeError('Sink already started')
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name='temper-sink')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop the background thread after a final flush.
+        """
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.close()
+
+    def close(self):
+        """
+        Release connections held by the sink.
+        """
+        pass
+
+    def _take_batch(self):
+        with self._cond:
+            count = min(len(self._buffer), self.batch_size)
+            return [self._buffer.popleft() for _ in range(count)]
+
+    def flush(self):
+        """
+        Send the spooled backlog and everything buffered now. Returns True if
+        all of it was delivered.
+        """
+        with self._send_lock:
+            if not self._drain_spool():
+                while self._buffer:
+                    self._spool(self._take_batch())
+                return False
+            while True:
+                batch = self._take_batch()
+                if not batch:
+                    return True
+                if not self._send_batch(batch):
+                    if self.spool_path is None:
+                        self._requeue(batch)
+                        return False
+                    self._spool(batch)
+                    while self._buffer:
+                        self._spool(self._take_batch())
+                    return False
+
+    def _requeue(self, lines):
+        """
+        Put lines that could not be sent back at the front of the buffer,
+        dropping the oldest of them if it overflows.
+        """
+        with self._cond:
+            room = self._buffer.maxlen - len(self._buffer)
+            if len(lines) > room:
+                overflow = len(lines) - room
+                LOGGER.warning('Sink buffer full, dropping %d lines', overflow)
+                self.stats['dropped'] += overflow
+                lines = lines[overflow:]
+            self._buffer.extendleft(reversed(lines))
+
+    def _run(self):
+        delivered = True
+        while True:
+            with self._cond:
+                # After a failure, wait before retrying even if a full batch
+                # is waiting
+                if not self._stopping and (
+                        not delivered or len(self._buffer) < self.batch_size):
+                    self._cond.wait(self.flush_interval)
+                stopping = self._stopping
+            delivered = self.flush()
+            if stopping:
+                return
+
+    def _send_batch(self, lines):
+        try:
+            self._send(lines)
+        except Exception as e:
+            LOGGER.warning('Sending %d lines failed: %s', len(lines), e)
+            self.stats['errors'] += 1
+            return False
+        self.stats['sent'] += len(lines)
+        return True
+
+    def _spool(self, lines):
+        """
+        Append lines to the spool file, or drop them if there is none or it
+        is full.
+        """
+        if not lines:
+            return
+        if self.spool_path is None:
+            self.stats['dropped'] += len(lines)
+            return
+        data = ''.join(line + '\n' for line in lines).encode('utf-8')
+        try:
+            size = os.path.getsize(self.spool_path)
+        except OSError:
+            size = 0
+        if size + len(data) > self.max_spool_bytes:
+            LOGGER.warning('Spool file %s full, dropping %d lines',
+                           self.spool_path, len(lines))
+            self.stats['dropped'] += len(lines)
+            return
+        with open(self.spool_path, 'ab') as f:
+            f.write(data)
+        self.stats['spooled'] += len(lines)
+
+    def _drain_spool(self):
+        """
+        Send the spooled backlog in batches. Returns True if the spool is
+        empty afterwards.
+        """
+        if self.spool_path is None or not os.path.exists(self.spool_path):
+            return True
+        with open(self.spool_path, 'rb') as f:
+            lines = f.read().decode('utf-8').splitlines()
+        for start in range(0, len(lines), self.batch_size):
+            if not self._send_batch(lines[start:start + self.batch_size]):
+                # Keep what could not be sent for the next attempt
+                tmp_path = self.spool_path + '.tmp'
+                with open(tmp_path, 'wb') as f:
+                    f.write(''.join(
+                        line + '\n' for line in lines[start:]).encode('utf-8'))
+                os.replace(tmp_path, self.spool_path)
+                return False
+        os.remove(self.spool_path)
+        LOGGER.info('Drained %d spooled lines', len(lines))
+        return True
+
+
+class InfluxHTTPSink(BufferedSink):
+    """
+    Send InfluxDB line protocol over HTTP, e.g. to
+    http://influxdb:8086/write?db=temper&precision=ns
+    """
+
+    def __init__(self, url, measurement='temper', headers=None, timeout=10,
+                 **kwargs):
+        super(InfluxHTTPSink, self).__init__(**kwargs)
+        self.url = url
+        self.measurement = measurement
+        self.headers = dict(headers or {})
+        self.timeout = timeout
+
+    def format(self, reading, timestamp):
+        line = influx_line(reading, timestamp, self.measurement)
+        return [line] if line else []
+
+    def _send(self, lines):
+        body = '\n'.join(lines).encode('utf-8')
+        request = urllib.request.Request(self.url, data=body, method='POST',
+                                         headers=self.headers)
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            response.read()
+
+
+class InfluxUDPSink(BufferedSink):
+    """
+    Send InfluxDB line protocol as UDP datagrams of at most
+    <max_datagram> bytes.
+    """
+
+    def __init__(self, host, port=8089, measurement='temper',
+                 max_datagram=1400, **kwargs):
+        super(InfluxUDPSink, self).__init__(**kwargs)
+        self.address = (host, port)
+        self.measurement = measurement
+        self.max_datagram = max_datagram
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def format(self, reading, timestamp):
+        line = influx_line(reading, timestamp, self.measurement)
+        return [line] if line else []
+
+    def _send(self, lines):
+        datagram = b''
+        for line in lines:
+            data = line.encode('utf-8') + b'\n'
+            if datagram and len(datagram) + len(data) > self.max_datagram:
+                self._socket.sendto(datagram, self.address)
+                datagram = b''
+            datagram += data
+        if datagram:
+            self._socket.sendto(datagram, self.address)
+
+    def close(self):
+        self._socket.close()
+
+
+class GraphiteSink(BufferedSink):
+    """
+    Send Graphite plaintext protocol over a persistent TCP connection.
+    """
+
+    def __init__(self, host, port=2003, prefix='temper', timeout=10, **kwargs):
+        super(GraphiteSink, self).__init__(**kwargs)
+        self.address = (host, port)
+        self.prefix = prefix
+        self.timeout = timeout
+        self._socket = None
+
+    def format(self, reading, timestamp):
+        return graphite_lines(reading, timestamp, self.prefix)
+
+    def _send(self, lines):
+        if self._socket is None:
+            self._socket = socket.create_connection(self.address, self.timeout)
+        try:
+            self._socket.sendall(''.join(
+                line + '\n' for line in lines).encode('utf-8'))
+        except OSError:
+            # Reconnect on the next attempt
+            self.close()
+            raise
+
+    def close(self):
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
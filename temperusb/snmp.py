@@ -10,15 +10,18 @@
 import os
 import sys
 import syslog
-import threading
 import snmp_passpersist as snmp
 from temperusb.temper import TemperHandler, TemperDevice
+from temperusb.worker import WorkerHandler
 
 ERROR_TEMPERATURE = 9999
+REFRESH_INTERVAL = 5 # update every 5s
 
 
 def _unbuffered_handle(fd):
-    return os.fdopen(fd.fileno(), 'w', 0)
+    # Python 3 does not allow unbuffered text I/O, line buffering has the
+    # same effect for the line based pass_persist protocol.
+    return os.fdopen(fd.fileno(), 'w', 1, closefd=False)
 
 
 class LogWriter():
@@ -28,34 +31,35 @@ class LogWriter():
         syslog.syslog(prio, message)
 
 class Updater():
-    def __init__(self, pp, logger, testmode=False):
+    def __init__(self, pp, logger, testmode=False, handler_class=None):
         self.logger = logger
         self.pp = pp
         self.testmode = testmode
-        self.usb_lock = threading.Lock() # used to stop reinitialization interfering with update-thread
+        self.handler_class = handler_class or TemperHandler
+        self.th = None
         self._initialize()
 
     def _initialize(self):
-        with self.usb_lock:
-            try:
-                self.th = TemperHandler()
-                self.devs = self.th.get_devices()
-                self.logger.write_log('Found %i thermometer devices.' % len(self.devs))
-                for i, d in enumerate(self.devs):
-                    self.logger.write_log('Initial temperature of device #%i: %0.1f degree celsius' % (i, d.get_temperature()))
-            except Exception as e:
-                self.logger.write_log('Exception while initializing: %s' % str(e))
+        try:
+            self.th = self.handler_class()
+            devs = self.th.get_devices()
+            self.logger.write_log('Found %i thermometer devices.' % len(devs))
+            for i, d in enumerate(devs):
+                self.logger.write_log('Initial temperature of device #%i: %0.1f degree celsius' % (i, d.get_temperature()))
+        except Exception as e:
+            self.logger.write_log('Exception while initializing: %s' % str(e))
 
-    def _reinitialize(self):
-        # Tries to close all known devices and starts over.
+    def _reinitialize(self, devices=None):
+        # Re-enumerates the bus and sets up the given devices again.
+        # Devices are locked individually, so others keep working meanwhile.
         self.logger.write_log('Reinitializing devices')
-        with self.usb_lock:
-            for i,d in enumerate(self.devs):
-                try:
-                    d.close()
-                except Exception as e:
-                    self.logger.write_log('Exception closing device #%i: %s' % (i, str(e))) 
-        self._initialize()
+        if self.th is None:
+            self._initialize()
+            return
+        try:
+            self.th.rescan(replace=devices)
+        except Exception as e:
+            self.logger.write_log('Exception while reinitializing: %s' % str(e))
 
     def update(self):
         if self.testmode:
@@ -66,12 +70,19 @@ class Updater():
             self.pp.add_int('9.9.13.1.3.1.3.2', 98)
             self.pp.add_int('9.9.13.1.3.1.3.3', 99)
         else:
+            failed = []
             try:
-                with self.usb_lock:
-                    temperatures = [d.get_temperature() for d in self.devs]
-                    self.pp.add_int('318.1.1.1.2.2.2.0', int(max(temperatures)))
-                    for i, temperature in enumerate(temperatures[:3]): # use max. first 3 devices
-                        self.pp.add_int('9.9.13.1.3.1.3.%i' % (i+1), int(temperature))
+                devs = self.th.get_devices()
+                temperatures = []
+                for d in devs:
+                    try:
+                        temperatures.append(d.get_temperature())
+                    except Exception:
+                        failed.append(d)
+                        raise
+                self.pp.add_int('318.1.1.1.2.2.2.0', int(max(temperatures)))
+                for i, temperature in enumerate(temperatures[:3]): # use max. first 3 devices
+                    self.pp.add_int('9.9.13.1.3.1.3.%i' % (i+1), int(temperature))
             except Exception as e:
                 self.logger.write_log('Exception while updating data: %s' % str(e))
                 # Report an exceptionally large temperature to set off all alarms.
@@ -79,15 +90,26 @@ class Updater():
                 for oid in ('318.1.1.1.2.2.2.0', '9.9.13.1.3.1.3.1', '9.9.13.1.3.1.3.2', '9.9.13.1.3.1.3.3'):
                     self.pp.add_int(oid, ERROR_TEMPERATURE)
                 self.logger.write_log('Starting reinitialize after error on update')
-                self._reinitialize()
+                self._reinitialize(failed)
 
 
-def main():
+def run(handler_class=None, testmode=False, refresh=REFRESH_INTERVAL):
+    """
+    Serve the pass_persist protocol on stdin/stdout until stdin is closed.
+    """
     sys.stdout = _unbuffered_handle(sys.stdout)
     pp = snmp.PassPersist(".1.3.6.1.4.1")
     logger = LogWriter()
-    upd = Updater(pp, logger, testmode=('--testmode' in sys.argv))
-    pp.start(upd.update, 5) # update every 5s
+    upd = Updater(pp, logger, testmode=testmode, handler_class=handler_class)
+    pp.start(upd.update, refresh)
+
+
+def main():
+    handler_class = None
+    if '--isolate' in sys.argv:
+        # Run USB access in a worker process that is killed when it hangs
+        handler_class = WorkerHandler
+    run(handler_class, testmode=('--testmode' in sys.argv))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,233 @@
+# encoding: utf-8
+#
+# Load test for the SNMP pass_persist agent in temperusb.snmp.
+#
+# Copyright 2012-2020 Philipp Adelt <info@philipp.adelt.net> and contributors.
+#
+# This code is licensed under the GNU public license (GPL). See LICENSE.md for
+# details.
+#
+# Starts the agent in a subprocess with simulated devices (configurable read
+# latency and error rate) and plays snmpd: sends get/getnext requests over
+# the agent's stdin at a fixed rate and measures the time until the answer
+# arrives on its stdout. No snmpd or USB devices are needed:
+#
+#   python -m temperusb.snmp_loadtest --rate 200 --duration 30 --latency 0.5
+
+from __future__ import print_function, absolute_import
+import argparse
+import functools
+import math
+import queue
+import random
+import subprocess
+import sys
+import threading
+import time
+
+from .simulation import SimulatedDevice, SimulatedHandler
+
+BASE_OID = '.1.3.6.1.4.1'
+APC_OID = BASE_OID + '.318.1.1.1.2.2.2.0'
+CISCO_OID = BASE_OID + '.9.9.13.1.3.1.3'
+WALK_START = BASE_OID + '.9.9.13.1.3'
+
+
+def simulated_handler(devices=3, latency=0.0, error_rate=0.0):
+    """
+    Create the handler of the agent process with simulated devices.
+    """
+    return SimulatedHandler([
+        SimulatedDevice(ports='1.%d' % i, temperature=20.0 + i, latency=latency,
+                        error_rate=error_rate)
+        for i in range(devices)])
+
+
+def run_agent(args):
+    """
+    Serve the agent with simulated devices on stdin/stdout.
+    """
+    from . import snmp
+    handler_class = functools.partial(
+        simulated_handler, args.devices, args.latency, args.error_rate)
+    snmp.run(handler_class, refresh=args.refresh)
+
+
+def percentile(values, fraction):
+    """
+    Nearest-rank percentile of a list of values.
+    """
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    rank = max(math.ceil(fraction * len(values)) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+class Client(object):
+    """
+    Plays snmpd talking to a pass_persist agent subprocess.
+    """
+    def __init__(self, command, timeout=10.0):
+        self.timeout = timeout
+        self._process = subprocess.Popen(
+            command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            universal_newlines=True, bufsize=1)
+        self._lines = queue.Queue()
+        reader = threading.Thread(target=self._read_lines)
+        reader.daemon = True
+        reader.start()
+
+    def _read_lines(self):
+        for line in self._process.stdout:
+            self._lines.put(line.rstrip('\n'))
+        self._lines.put(None)
+
+    def _readline(self):
+        line = self._lines.get(timeout=self.timeout)
+        if line is None:
+            raise EOFError('Agent exited')
+        return line
+
+    def request(self, command, oid=None):
+        """
+        Send a request and return the response as a list of lines.
+        """
+        self._process.stdin.write(command + '\n')
+        if oid is not None:
+            self._process.stdin.write(oid + '\n')
+        self._process.stdin.flush()
+        first = self._readline()
+        if first in ('NONE', 'PONG'):
+            return [first]
+        return [first, self._readline(), self._readline()]
+
+    def close(self):
+        self._process.stdin.close()
+        try:
+            self._process.wait(self.timeout)
+        except subprocess.TimeoutExpired:
+            self._process.kill()
+            self._process.wait()
+
+
+def _next_request(walk_state):
+    """
+    Mix of what snmpd sends: gets of the APC and Cisco OIDs and walks of
+    the Cisco table with getnext.
+    """
+    choice = random.random()
+    if choice < 0.3:
+        return 'get', APC_OID
+    elif choice < 0.6:
+        return 'get', '%s.%d' % (CISCO_OID, random.randint(1, 3))
+    oid = walk_state.get('oid') or WALK_START
+    return 'getnext', oid
+
+
+def run_load(command, rate, duration, timeout=10.0, error_value=None):
+    """
+    Drive the agent started by <command> with <rate> requests per second
+    for <duration> seconds. Returns a dictionary of results.
+    """
+    from .snmp import ERROR_TEMPERATURE
+    if error_value is None:
+        error_value = ERROR_TEMPERATURE
+
+    client = Client(command, timeout)
+    latencies = []
+    counts = {'requests': 0, 'none': 0, 'error_values': 0, 'lag': 0.0}
+    walk_state = {}
+    try:
+        client.request('PING')
+        start = time.monotonic()
+        interval = 1.0 / rate
+        n = 0
+        while True:
+            due = start + n * interval
+            now = time.monotonic()
+            if due - start >= duration:
+                break
+            if due > now:
+                time.sleep(due - now)
+            else:
+                counts['lag'] = max(counts['lag'], now - due)
+            command_name, oid = _next_request(walk_state)
+            sent = time.monotonic()
+            response = client.request(command_name, oid)
+            latencies.append(time.monotonic() - sent)
+            counts['requests'] += 1
+            if response[0] == 'NONE':
+                counts['none'] += 1
+                walk_state['oid'] = None
+            else:
+                if command_name == 'getnext':
+                    walk_state['oid'] = response[0]
+                if response[2].strip() == str(error_value):
+                    counts['error_values'] += 1
+            n += 1
+        elapsed = time.monotonic() - start
+    finally:
+        client.close()
+
+    return {
+        'requests': counts['requests'],
+        'rate': counts['requests'] / elapsed if elapsed > 0 else 0.0,
+        'none': counts['none'],
+        'error_values': counts['error_values'],
+        'max_lag': counts['lag'],
+        'p50': percentile(latencies, 0.50),
+        'p90': percentile(latencies, 0.90),
+        'p99': percentile(latencies, 0.99),
+        'max': max(latencies) if latencies else float('nan'),
+    }
+
+
+def agent_command(devices=3, latency=0.0, error_rate=0.0, refresh=5.0):
+    """
+    Command line starting the agent with simulated devices.
+    """
+    return [
+        sys.executable, '-m', 'temperusb.snmp_loadtest', '--agent',
+        '--devices', str(devices), '--latency', str(latency),
+        '--error-rate', str(error_rate), '--refresh', str(refresh),
+    ]
+
+
+def parse_args():
+    descr = "Load test the temper-snmp pass_persist agent with simulated devices."
+
+    parser = argparse.ArgumentParser(description=descr)
+    parser.add_argument("--rate", type=float, default=100,
+                        help="Requests per second (default: %(default)s)")
+    parser.add_argument("--duration", type=float, default=10,
+                        help="Seconds to run (default: %(default)s)")
+    parser.add_argument("--devices", type=int, default=3,
+                        help="Number of simulated devices (default: %(default)s)")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="Seconds per simulated device read (default: %(default)s)")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="Probability of a simulated read error (default: %(default)s)")
+    parser.add_argument("--refresh", type=float, default=5.0,
+                        help="Agent update interval in seconds (default: %(default)s)")
+    parser.add_argument("--agent", action='store_true',
+                        help="Run as the agent under test (used internally)")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.agent:
+        run_agent(args)
+        return
+
+    command = agent_command(args.devices, args.latency, args.error_rate, args.refresh)
+    results = run_load(command, args.rate, args.duration)
+    print("%(requests)i requests at %(rate).1f/s, max lag behind schedule %(max_lag).3fs" % results)
+    print("latency p50 %.2fms p90 %.2fms p99 %.2fms max %.2fms" % tuple(
+        results[k] * 1000 for k in ('p50', 'p90', 'p99', 'max')))
+    print("%(none)i NONE responses, %(error_values)i error values" % results)
+
+
+if __name__ == '__main__':
+    main()
@@ -12,9 +12,14 @@ import usb
 import os
 import re
 import logging
+import statistics
 import struct
+import threading
+from contextlib import contextmanager
 
+from .calibration import parse_curve
 from .device_library import DEVICE_LIBRARY, TemperType, TemperConfig
+from .pubsub import Publisher
 
 VIDPIDS = [
     (0x0c45, 0x7401),
@@ -22,6 +27,7 @@ VIDPIDS = [
     (0x1a86, 0xe025),
 ]
 REQ_INT_LEN = 8
+MAX_SENSOR_COUNT = 8
 ENDPOINT = 0x82
 INTERFACE = 1
 CONFIG_NO = 1
@@ -29,12 +35,16 @@ TIMEOUT = 5000
 USB_PORTS_STR = r'^\s*(\d+)-(\d+(?:\.\d+)*)'
 CALIB_LINE_STR = USB_PORTS_STR +\
     r'\s*:\s*scale\s*=\s*([+|-]?\d*\.\d+)\s*,\s*offset\s*=\s*([+|-]?\d*\.\d+)'
+CURVE_LINE_STR = USB_PORTS_STR +\
+    r'\s+sensor\s+(\d+)\s+(temperature|humidity)\s*:\s*((?:points|poly)\s*=.*)$'
 USB_SYS_PREFIX = '/sys/bus/usb/devices/'
 COMMANDS = {
     'temp': b'\x01\x80\x33\x01\x00\x00\x00\x00',
     'ini1': b'\x01\x82\x77\x01\x00\x00\x00\x00',
     'ini2': b'\x01\x86\xff\x01\x00\x00\x00\x00',
 }
+AGGREGATES = ('median', 'mean', 'trimmed')
+TRIM_FRACTION = 0.1
 LOGGER = logging.getLogger(__name__)
 CONTRIBUTE_URL = "https://github.com/padelt/temper-python/issues"
 
@@ -79,11 +89,87 @@ def find_ports(device):
                 return str(matches.groups()[1])
 
 
+def aggregate_values(values, aggregate='median'):
+    """
+    Aggregate a list of samples into a single value.
+
+    'trimmed' discards TRIM_FRACTION of the samples at both ends (at least
+    one each if there are three or more samples) before averaging.
+    """
+    if aggregate == 'median':
+        return statistics.median(values)
+    elif aggregate == 'mean':
+        return statistics.mean(values)
+    elif aggregate == 'trimmed':
+        values = sorted(values)
+        trim = int(len(values) * TRIM_FRACTION)
+        if trim == 0 and len(values) >= 3:
+            trim = 1
+        if trim:
+            values = values[trim:-trim]
+        return statistics.mean(values)
+    else:
+        raise ValueError("Unknown aggregate %r" % aggregate)
+
+
+class ReadWriteLock(object):
+    """
+    A lock allowing many concurrent readers or a single writer. Waiting
+    writers take precedence over new readers.
+    """
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writer = False
+        self._writers_waiting = 0
+
+    @contextmanager
+    def read_locked(self):
+        with self._cond:
+            while self._writer or self._writers_waiting:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write_locked(self):
+        with self._cond:
+            self._writers_waiting += 1
+            while self._writer or self._readers:
+                self._cond.wait()
+            self._writers_waiting -= 1
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = False
+                self._cond.notify_all()
+
+
+def _usb_key(device):
+    """
+    Identify a USB device for the current enumeration.
+    """
+    return (device.bus, getattr(device, 'address', None))
+
+
 class TemperDevice(object):
     """
     A TEMPer USB thermometer.
+
+    All USB access goes through a per-device lock, so a device may be shared
+    between threads.
     """
     def __init__(self, device, sensor_count=1):
+        self._lock = threading.RLock()
+        self._persistent = False
         self.set_sensor_count(sensor_count)
 
         self._device = device
@@ -117,22 +203,38 @@ class TemperDevice(object):
             config = DEVICE_LIBRARY["generic_fm75"]
         self.temp_sens_offsets = config.temp_sens_offsets
         self.hum_sens_offsets = config.hum_sens_offsets
+        self.temp_sens_reports = config.temp_sens_reports
+        self.hum_sens_reports = config.hum_sens_reports
+        self.commands = config.commands
         self.type = config.type
 
         self.set_sensor_count(self.lookup_sensor_count())
         LOGGER.debug('Found device | Bus:{0} Ports:{1} SensorCount:{2}'.format(
             self._bus, self._ports, self._sensor_count))
 
-    def set_calibration_data(self, scale=None, offset=None):
+    def set_calibration_data(self, scale=None, offset=None, curves=None):
         """
         Set device calibration data based on settings in /etc/temper.conf.
+
+        Params:
+        - scale, offset: linear calibration of all temperature sensors
+        - curves: dictionary mapping (quantity, sensor) to a calibration
+          curve from temperusb.calibration, quantity being 'temperature' or
+          'humidity'. A curve is applied to the raw value of its sensor
+          instead of scale and offset.
         """
         if scale is not None and offset is not None:
             self._scale = scale
             self._offset = offset
+            self._curves = dict(curves or {})
+        elif scale is None and offset is None and curves is not None:
+            self._scale = 1.0
+            self._offset = 0.0
+            self._curves = dict(curves)
         elif scale is None and offset is None:
             self._scale = 1.0
             self._offset = 0.0
+            self._curves = {}
             try:
                 f = open('/etc/temper.conf', 'r')
             except IOError:
@@ -150,6 +252,14 @@ class TemperDevice(object):
                         if (str(ports) == str(self._ports)) and (str(bus) == str(self._bus)):
                             self._scale = scale
                             self._offset = offset
+                    matches = re.match(CURVE_LINE_STR, line)
+                    if matches:
+                        bus, ports, sensor, quantity, curve = matches.groups()
+                        if (str(ports) == str(self._ports)) and (str(bus) == str(self._bus)):
+                            try:
+                                self._curves[(quantity, int(sensor))] = parse_curve(curve)
+                            except ValueError as e:
+                                LOGGER.warning('Ignoring calibration line %r: %s', line, e)
         else:
             raise RuntimeError("Must set both scale and offset, or neither")
 
@@ -186,11 +296,10 @@ class TemperDevice(object):
 
         To do: revamp /etc/temper.conf file to include this data.
         """
-        # Currently this only supports 1 and 2 sensor models.
-        # If you have the 8 sensor model, please contribute to the
-        # discussion here: https://github.com/padelt/temper-python/issues
-        if count not in [1, 2, 3]:
-            raise ValueError('Only sensor_count of 1-3 supported')
+        # Devices with more than 3 sensors spread their values over several
+        # reports, see TemperConfig.
+        if count not in range(1, MAX_SENSOR_COUNT + 1):
+            raise ValueError('Only sensor_count of 1-%d supported' % MAX_SENSOR_COUNT)
 
         self._sensor_count = int(count)
 
@@ -216,73 +325,91 @@ class TemperDevice(object):
             return self._bus
         return ''
 
-    def get_data(self, reset_device=False):
+    def _open_session(self, reset_device=False):
         """
-        Get data from the USB device.
+        Prepare the USB device for a series of reports.
         """
-        try:
-            if reset_device:
-                self._device.reset()
-
-            # detach kernel driver from both interfaces if attached, so we can set_configuration()
-            for interface in [0,1]:
-                if self._device.is_kernel_driver_active(interface):
-                    LOGGER.debug('Detaching kernel driver for interface %d '
-                        'of %r on ports %r', interface, self._device, self._ports)
-                    self._device.detach_kernel_driver(interface)
-
-            self._device.set_configuration()
-
-            # Prevent kernel message:
-            # "usbfs: process <PID> (python) did not claim interface x before use"
-            # This will become unnecessary once pull-request #124 for
-            # PyUSB has been accepted and we depend on a fixed release
-            # of PyUSB.  Until then, and even with the fix applied, it
-            # does not hurt to explicitly claim the interface.
-            usb.util.claim_interface(self._device, INTERFACE)
-
-            # Turns out we don't actually need that ctrl_transfer.
-            # Disabling this reduces number of USBErrors from ~7/30 to 0!
-            #self._device.ctrl_transfer(bmRequestType=0x21, bRequest=0x09,
-            #    wValue=0x0201, wIndex=0x00, data_or_wLength='\x01\x01',
-            #    timeout=TIMEOUT)
-
-
-            # Magic: Our TEMPerV1.4 likes to be asked twice.  When
-            # only asked once, it get's stuck on the next access and
-            # requires a reset.
-            self._control_transfer(COMMANDS['temp'])
-            self._interrupt_read()
-
-            # Turns out a whole lot of that magic seems unnecessary.
-            #self._control_transfer(COMMANDS['ini1'])
-            #self._interrupt_read()
-            #self._control_transfer(COMMANDS['ini2'])
-            #self._interrupt_read()
-            #self._interrupt_read()
+        if reset_device:
+            self._device.reset()
 
-            # Get temperature
-            self._control_transfer(COMMANDS['temp'])
-            temp_data = self._interrupt_read()
+        # detach kernel driver from both interfaces if attached, so we can set_configuration()
+        for interface in [0,1]:
+            if self._device.is_kernel_driver_active(interface):
+                LOGGER.debug('Detaching kernel driver for interface %d '
+                    'of %r on ports %r', interface, self._device, self._ports)
+                self._device.detach_kernel_driver(interface)
 
-            # Get humidity
-            LOGGER.debug("ID='%s'" % self._device.product)
-            if self.hum_sens_offsets:
-                humidity_data = temp_data
-            else:
-                humidity_data = None
+        self._device.set_configuration()
+
+        # Prevent kernel message:
+        # "usbfs: process <PID> (python) did not claim interface x before use"
+        # This will become unnecessary once pull-request #124 for
+        # PyUSB has been accepted and we depend on a fixed release
+        # of PyUSB.  Until then, and even with the fix applied, it
+        # does not hurt to explicitly claim the interface.
+        usb.util.claim_interface(self._device, INTERFACE)
 
-            # Combine temperature and humidity data
-            data = {'temp_data': temp_data, 'humidity_data': humidity_data}
+        # Turns out we don't actually need that ctrl_transfer.
+        # Disabling this reduces number of USBErrors from ~7/30 to 0!
+        #self._device.ctrl_transfer(bmRequestType=0x21, bRequest=0x09,
+        #    wValue=0x0201, wIndex=0x00, data_or_wLength='\x01\x01',
+        #    timeout=TIMEOUT)
 
-            # Be a nice citizen and undo potential interface claiming.
-            # Also see: https://github.com/walac/pyusb/blob/master/docs/tutorial.rst#dont-be-selfish
-            usb.util.dispose_resources(self._device)
-            return data
+
+        # Magic: Our TEMPerV1.4 likes to be asked twice.  When
+        # only asked once, it get's stuck on the next access and
+        # requires a reset.
+        self._control_transfer(COMMANDS['temp'])
+        self._interrupt_read()
+
+        # Turns out a whole lot of that magic seems unnecessary.
+        #self._control_transfer(COMMANDS['ini1'])
+        #self._interrupt_read()
+        #self._control_transfer(COMMANDS['ini2'])
+        #self._interrupt_read()
+        #self._interrupt_read()
+
+    def _close_session(self):
+        """
+        Release the USB device after a series of reports.
+        """
+        # Be a nice citizen and undo potential interface claiming.
+        # Also see: https://github.com/walac/pyusb/blob/master/docs/tutorial.rst#dont-be-selfish
+        usb.util.dispose_resources(self._device)
+
+    def _read_reports(self):
+        """
+        Request and read the reports holding all sensor values from an open
+        session. Returns the list of reports.
+        """
+        reports = []
+        for command in self.commands:
+            if command is not None:
+                self._control_transfer(COMMANDS[command])
+            reports.append(self._interrupt_read())
+        return reports
+
+    def _run_session(self, func, reset_device=False):
+        """
+        Open a session, call <func> to read from the device and close the
+        session again. The session is retried once with a device reset on
+        USB errors. While the device is kept open (see open()), <func> is
+        called in the existing session.
+        """
+        try:
+            with self._lock:
+                if self._persistent:
+                    if reset_device:
+                        self._open_session(reset_device)
+                    return func()
+                self._open_session(reset_device)
+                result = func()
+                self._close_session()
+                return result
         except usb.USBError as err:
             if not reset_device:
                 LOGGER.warning("Encountered %s, resetting %r and trying again.", err, self._device)
-                return self.get_data(True)
+                return self._run_session(func, True)
 
             # Catch the permissions exception and add our message
             if "not permitted" in str(err):
@@ -293,6 +420,29 @@ class TemperDevice(object):
                 LOGGER.error(err)
                 raise
 
+    def get_data(self, reset_device=False):
+        """
+        Get data from the USB device.
+        """
+        def read():
+            # Get temperature
+            reports = self._read_reports()
+            temp_data = reports[0]
+
+            # Get humidity
+            LOGGER.debug("ID='%s'" % self._device.product)
+            if self.hum_sens_offsets:
+                humidity_data = temp_data
+            else:
+                humidity_data = None
+
+            # Combine temperature and humidity data. 'reports' holds all
+            # reports of devices spreading their values over several.
+            return {'temp_data': temp_data, 'humidity_data': humidity_data,
+                    'reports': reports}
+
+        return self._run_session(read, reset_device)
+
     def get_temperature(self, format='celsius', sensor=0):
         """
         Get device temperature reading.
@@ -308,15 +458,9 @@ class TemperDevice(object):
         else:
             raise ValueError("Unknown format")
 
-    def get_temperatures(self, sensors=None):
+    def _check_sensors(self, sensors):
         """
-        Get device temperature reading.
-
-        Params:
-        - sensors: optional list of sensors to get a reading for, examples:
-          [0,] - get reading for sensor 0
-          [0, 1,] - get reading for sensors 0 and 1
-          None - get readings for all sensors
+        Validate a list of sensors, defaulting to all sensors of the device.
         """
         _sensors = sensors
         if _sensors is None:
@@ -331,31 +475,79 @@ class TemperDevice(object):
                     list(range(0, self._sensor_count)),
                 )
             )
+        return _sensors
+
+    def _decode_temperature(self, reports, sensor):
+        """
+        Decode the calibrated temperature in degrees celsius of <sensor>
+        from the reports of one reading.
+        """
+        offset = self.lookup_offset(sensor)
+        data = reports[self.temp_sens_reports[sensor]]
+        if self.type == TemperType.SI7021:
+            celsius = struct.unpack_from('>h', data, offset)[0] * 175.72 / 65536 - 46.85
+        else: # fm75 (?) type device
+            celsius = struct.unpack_from('>h', data, offset)[0] / 256.0
+        curve = self._curves.get(('temperature', sensor))
+        if curve is not None:
+            return curve(celsius)
+        # Apply scaling and offset (if any)
+        return celsius * self._scale + self._offset
+
+    def _decode_humidity(self, reports, sensor):
+        """
+        Decode the relative humidity in percent of <sensor> from the reports
+        of one reading, or None if the sensor does not measure humidity.
+        """
+        offset = self.lookup_humidity_offset(sensor)
+        if offset is None:
+            return None
+        data = reports[self.hum_sens_reports[sensor]]
+        if self.type == TemperType.SI7021:
+            humidity = (struct.unpack_from('>H', data, offset)[0] * 125) / 65536 -6
+        else:  #fm75 (?) type device
+            humidity = (struct.unpack_from('>H', data, offset)[0] * 32) / 1000.0
+        curve = self._curves.get(('humidity', sensor))
+        if curve is not None:
+            return curve(humidity)
+        return humidity
+
+    def _temperature_result(self, sensor, celsius):
+        """
+        Build the result dictionary for a temperature reading.
+        """
+        return {
+            'ports': self.get_ports(),
+            'bus': self.get_bus(),
+            'sensor': sensor,
+            'temperature_f': celsius * 1.8 + 32.0,
+            'temperature_c': celsius,
+            'temperature_mc': celsius * 1000,
+            'temperature_k': celsius + 273.15,
+        }
+
+    def get_temperatures(self, sensors=None):
+        """
+        Get device temperature reading.
+
+        Params:
+        - sensors: optional list of sensors to get a reading for, examples:
+          [0,] - get reading for sensor 0
+          [0, 1,] - get reading for sensors 0 and 1
+          None - get readings for all sensors
+        """
+        _sensors = self._check_sensors(sensors)
 
         data = self.get_data()
-        data = data['temp_data']
+        data = data['reports']
 
         results = {}
 
         # Interpret device response
         for sensor in _sensors:
-            offset = self.lookup_offset(sensor)
-            if self.type == TemperType.SI7021: 
-                celsius = struct.unpack_from('>h', data, offset)[0] * 175.72 / 65536 - 46.85
-            else: # fm75 (?) type device
-                celsius = struct.unpack_from('>h', data, offset)[0] / 256.0
-            # Apply scaling and offset (if any)
-            celsius = celsius * self._scale + self._offset
+            celsius = self._decode_temperature(data, sensor)
             LOGGER.debug("T=%.5fC" % celsius)
-            results[sensor] = {
-                'ports': self.get_ports(),
-                'bus': self.get_bus(),
-                'sensor': sensor,
-                'temperature_f': celsius * 1.8 + 32.0,
-                'temperature_c': celsius,
-                'temperature_mc': celsius * 1000,
-                'temperature_k': celsius + 273.15,
-            }
+            results[sensor] = self._temperature_result(sensor, celsius)
 
         return results
 
@@ -369,32 +561,16 @@ class TemperDevice(object):
           [0, 1,] - get reading for sensors 0 and 1
           None - get readings for all sensors
         """
-        _sensors = sensors
-        if _sensors is None:
-            _sensors = list(range(0, self._sensor_count))
-
-        if not set(_sensors).issubset(list(range(0, self._sensor_count))):
-            raise ValueError(
-                'Some or all of the sensors in the list %s are out of range '
-                'given a sensor_count of %d.  Valid range: %s' % (
-                    _sensors,
-                    self._sensor_count,
-                    list(range(0, self._sensor_count)),
-                )
-            )
+        _sensors = self._check_sensors(sensors)
         data = self.get_data()
-        data = data['humidity_data']
+        data = data['reports']
         results = {}
 
         # Interpret device response
         for sensor in _sensors:
-            offset = self.lookup_humidity_offset(sensor)
-            if offset is None:
+            humidity = self._decode_humidity(data, sensor)
+            if humidity is None:
                 continue
-            if self.type == TemperType.SI7021:
-                humidity = (struct.unpack_from('>H', data, offset)[0] * 125) / 65536 -6
-            else:  #fm75 (?) type device
-                humidity = (struct.unpack_from('>H', data, offset)[0] * 32) / 1000.0
             LOGGER.debug("RH=%.5f%%" % humidity)
             results[sensor] = {
                 'ports': self.get_ports(),
@@ -405,6 +581,53 @@ class TemperDevice(object):
 
         return results
 
+    def get_readings(self, samples=1, aggregate='median', sensors=None):
+        """
+        Get aggregated temperature and humidity readings from several
+        reports taken within a single USB session.
+
+        Params:
+        - samples: number of reports to read from the device
+        - aggregate: 'median', 'mean' or 'trimmed' (mean after discarding
+          the most extreme values, see TRIM_FRACTION)
+        - sensors: optional list of sensors, as for get_temperatures()
+
+        Returns a dictionary per sensor with the keys of get_temperatures()
+        plus 'humidity_pc' for humidity sensors, the number of 'samples' and
+        the spread (max - min) and standard deviation of the raw samples.
+        """
+        _sensors = self._check_sensors(sensors)
+        if samples < 1:
+            raise ValueError('samples must be at least 1')
+        if aggregate not in AGGREGATES:
+            raise ValueError('Unknown aggregate %r, use one of %s' % (
+                aggregate, sorted(AGGREGATES)))
+
+        reports = self._run_session(
+            lambda: [self._read_reports() for _ in range(samples)])
+
+        results = {}
+        for sensor in _sensors:
+            temperatures = [self._decode_temperature(r, sensor) for r in reports]
+            celsius = aggregate_values(temperatures, aggregate)
+            LOGGER.debug("T=%.5fC (%s of %d)" % (celsius, aggregate, samples))
+            result = self._temperature_result(sensor, celsius)
+            result['samples'] = samples
+            result['temperature_c_spread'] = max(temperatures) - min(temperatures)
+            result['temperature_c_stdev'] = statistics.pstdev(temperatures)
+
+            if self.lookup_humidity_offset(sensor) is not None:
+                humidities = [self._decode_humidity(r, sensor) for r in reports]
+                humidity = aggregate_values(humidities, aggregate)
+                LOGGER.debug("RH=%.5f%% (%s of %d)" % (humidity, aggregate, samples))
+                result['humidity_pc'] = humidity
+                result['humidity_pc_spread'] = max(humidities) - min(humidities)
+                result['humidity_pc_stdev'] = statistics.pstdev(humidities)
+
+            results[sensor] = result
+
+        return results
+
     def _control_transfer(self, data):
         """
         Send device a control request with standard parameters and <data> as
@@ -422,25 +645,123 @@ class TemperDevice(object):
         LOGGER.debug('Read data: %r', ' '.join('{:02x}'.format(x) for x in data))
         return data
 
+    def open(self):
+        """
+        Keep the device claimed between readings until close(), which saves
+        the setup of a session on every reading.
+        """
+        with self._lock:
+            if not self._persistent:
+                try:
+                    self._open_session()
+                except usb.USBError as err:
+                    LOGGER.warning("Encountered %s, resetting %r and trying again.", err, self._device)
+                    self._open_session(True)
+                self._persistent = True
+
     def close(self):
-        """Does nothing in this device. Other device types may need to do cleanup here."""
-        pass
+        """
+        Release a device kept open by open(), after running USB access has
+        finished.
+        """
+        with self._lock:
+            if self._persistent:
+                self._persistent = False
+                self._close_session()
 
 
 class TemperHandler(object):
     """
     Handler for TEMPer USB thermometers.
+
+    The list of devices is guarded by a read/write lock: reading devices only
+    needs the read lock, and rescan() holds the write lock just long enough to
+    swap in the new list.
     """
 
     def __init__(self):
+        self._lock = ReadWriteLock()
+        self._rescan_lock = threading.Lock()
+        self._publisher = Publisher(self)
         self._devices = []
-        for vid, pid in VIDPIDS:
-            self._devices += [TemperDevice(device) for device in \
-                usb.core.find(find_all=True, idVendor=vid, idProduct=pid)]
+        self._keys = {}
+        self.rescan()
         LOGGER.info('Found {0} TEMPer devices'.format(len(self._devices)))
 
     def get_devices(self):
         """
         Get a list of all devices attached to this handler
         """
-        return self._devices
+        with self._lock.read_locked():
+            return list(self._devices)
+
+    def subscribe(self, callback, sensors=None, min_interval=5.0, devices=None,
+                  queue_size=16, policy='drop_oldest'):
+        """
+        Subscribe to readings from a single internal poll loop, so several
+        consumers share the USB transfers.
+
+        Params:
+        - callback: called as callback(device, readings) with readings as
+          returned by TemperDevice.get_readings(), from a thread of the
+          subscription
+        - sensors: optional list of sensors to deliver
+        - min_interval: minimum seconds between readings of a device
+        - devices: optional list of devices, defaults to all; matched by
+          bus and ports, so they are still delivered after a rescan()
+        - queue_size: maximum number of readings waiting for the callback
+        - policy: what to do when the queue is full, 'drop_oldest' or
+          'coalesce' (keep only the newest readings per device)
+
+        Returns a Subscription; call its unsubscribe() to stop. Devices are
+        only polled while somebody subscribed to them.
+        """
+        return self._publisher.subscribe(
+            callback, devices=devices, sensors=sensors,
+            min_interval=min_interval, queue_size=queue_size, policy=policy)
+
+    def rescan(self, replace=None):
+        """
+        Re-enumerate the USB bus.
+
+        Devices which are still present are kept as they are, devices which
+        disappeared are closed and new devices are added. Devices in the
+        optional list <replace> are closed and set up again even if they are
+        still present, e.g. after errors. Other devices can be read while
+        the rescan is in progress.
+        """
+        with self._rescan_lock:
+            return self._rescan(set(id(dev) for dev in (replace or [])))
+
+    def _rescan(self, replace):
+        with self._lock.read_locked():
+            known = dict((key, dev) for dev, key in self._keys.items())
+
+        devices = []
+        keys = {}
+        closing = []
+        for vid, pid in VIDPIDS:
+            for device in usb.core.find(find_all=True, idVendor=vid, idProduct=pid):
+                key = _usb_key(device)
+                dev = known.pop(key, None)
+                if dev is not None and id(dev) in replace:
+                    closing.append(dev)
+                    dev = None
+                if dev is None:
+                    dev = TemperDevice(device)
+                devices.append(dev)
+                keys[dev] = key
+        closing.extend(known.values())
+
+        with self._lock.write_locked():
+            self._devices = devices
+            self._keys = keys
+        self._publisher.devices_changed()
+
+        # Closing waits for reads in progress on that device only
+        for dev in closing:
+            try:
+                dev.close()
+            except Exception as e:
+                LOGGER.warning('Exception closing device %r: %s', dev, e)
+        return devices
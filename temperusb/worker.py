@@ -0,0 +1,282 @@
+# encoding: utf-8
+#
+# Run USB access in a supervised worker process.
+#
+# Copyright 2012-2020 Philipp Adelt <info@philipp.adelt.net> and contributors.
+#
+# This code is licensed under the GNU public license (GPL). See LICENSE.md for
+# details.
+#
+# libusb calls can hang well beyond TIMEOUT on misbehaving hubs, or crash the
+# process. The worker process keeps all devices open and streams readings
+# back over a pipe. If a read does not finish within its deadline, or the
+# worker dies, it is reaped and a new one is started on the next request, so
+# the caller's latency stays bounded. Devices are addressed by bus and ports,
+# which stay valid across worker restarts.
+#
+# Workers are started from a fresh process rather than forked from the
+# caller, which may be running other threads (like the pass_persist agent).
+
+import logging
+import multiprocessing
+import threading
+import time
+
+from .proxy import ProxyDevice, device_info
+from .temper import TemperHandler
+
+LOGGER = logging.getLogger(__name__)
+
+_CONTEXT = multiprocessing.get_context(
+    'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn')
+# Seconds to wait for a killed worker to exit. A worker stuck in the kernel,
+# e.g. in a usbfs ioctl, only exits once that returns, so it is abandoned
+# instead.
+KILL_TIMEOUT = 1.0
+
+
+def _device_key(device):
+    return (device.get_bus(), device.get_ports())
+
+
+def _worker_main(conn, handler_factory):
+    """
+    Main loop of the worker process.
+
+    Messages from the parent:
+    - ('read', request_id, keys): read the devices with these (bus, ports)
+    - ('close',): close all devices and exit
+    Messages to the parent:
+    - ('devices', [info, ...]) once all devices are open
+    - ('reading', request_id, key, readings, error) per device read
+    - ('done', request_id) after all requested devices were read
+    """
+    th = handler_factory()
+    devs = th.get_devices()
+    devs_by_key = dict((_device_key(dev), dev) for dev in devs)
+    for dev in devs:
+        try:
+            dev.open()
+        except Exception as e:
+            LOGGER.warning('Exception opening device %r: %s', dev, e)
+    conn.send(('devices', [device_info(dev) for dev in devs]))
+
+    try:
+        while True:
+            try:
+                message = conn.recv()
+            except EOFError:
+                break
+            if message[0] == 'close':
+                break
+            _, request_id, keys = message
+            for key in keys:
+                dev = devs_by_key.get(key)
+                if dev is None:
+                    conn.send(('reading', request_id, key, None,
+                               'No device on bus %s ports %s' % key))
+                    continue
+                try:
+                    readings = dev.get_readings()
+                    conn.send(('reading', request_id, key, readings, None))
+                except Exception as e:
+                    conn.send(('reading', request_id, key, None, str(e)))
+            conn.send(('done', request_id))
+    finally:
+        for dev in devs:
+            try:
+                dev.close()
+            except Exception as e:
+                LOGGER.warning('Exception closing device %r: %s', dev, e)
+
+
+class WorkerDevice(ProxyDevice):
+    """
+    Stand-in for a TemperDevice whose USB access runs in the worker process
+    of a WorkerHandler, addressed by its bus and ports.
+    """
+    def __init__(self, handler, info):
+        super(WorkerDevice, self).__init__(info)
+        self._handler = handler
+
+    def _read(self):
+        """
+        Read the device in the worker. Raises TimeoutError if the worker did
+        not answer in time and RuntimeError if reading the device failed, it
+        is gone or the worker died.
+        """
+        readings, errors = self._handler.read([self._key])
+        if self._key in errors:
+            raise RuntimeError('Bus %s ports %s: %s' % (self._key + (errors[self._key],)))
+        return readings[self._key]
+
+
+class WorkerHandler(object):
+    """
+    Handler for TEMPer USB thermometers running all USB access in a
+    supervised worker process.
+
+    Params:
+    - deadline: seconds the read of one device may take before the worker
+      is killed
+    - start_timeout: seconds the worker may take to find and open devices
+    - handler_factory: callable creating the handler in the worker process
+    """
+    def __init__(self, deadline=10.0, start_timeout=30.0,
+                 handler_factory=TemperHandler):
+        self.deadline = deadline
+        self.start_timeout = start_timeout
+        self._handler_factory = handler_factory
+        self._lock = threading.Lock()
+        self._process = None
+        self._conn = None
+        self._devices = []
+        self._request_id = 0
+        self.stats = {'starts': 0, 'kills': 0, 'crashes': 0, 'abandoned': 0}
+        with self._lock:
+            self._start()
+
+    def _start(self):
+        parent_conn, child_conn = _CONTEXT.Pipe()
+        process = _CONTEXT.Process(
+            target=_worker_main, args=(child_conn, self._handler_factory),
+            name='temper-worker')
+        process.daemon = True
+        process.start()
+        child_conn.close()
+        self._process = process
+        self._conn = parent_conn
+        self.stats['starts'] += 1
+
+        if not parent_conn.poll(self.start_timeout):
+            self._kill()
+            raise TimeoutError('Worker did not start within %ss' % self.start_timeout)
+        try:
+            message = parent_conn.recv()
+        except (EOFError, OSError):
+            self._reap()
+            raise RuntimeError('Worker died while starting')
+        self._devices = [WorkerDevice(self, info) for info in message[1]]
+        LOGGER.info('Worker %d found %d TEMPer devices',
+                    process.pid, len(self._devices))
+
+    def _kill(self):
+        LOGGER.error('Killing worker %d', self._process.pid)
+        self.stats['kills'] += 1
+        self._process.kill()
+        self._process.join(KILL_TIMEOUT)
+        if self._process.is_alive():
+            LOGGER.error('Worker %d did not exit, abandoning it', self._process.pid)
+            self.stats['abandoned'] += 1
+        self._conn.close()
+        self._process = None
+        self._conn = None
+
+    def _reap(self):
+        """
+        Clean up after a worker that died by itself.
+        """
+        self._process.join(self.deadline)
+        if self._process.is_alive():
+            self._kill()
+            return
+        LOGGER.error('Worker %d died with exit code %s',
+                     self._process.pid, self._process.exitcode)
+        self.stats['crashes'] += 1
+        self._conn.close()
+        self._process = None
+        self._conn = None
+
+    def _stop(self):
+        try:
+            self._conn.send(('close',))
+        except (OSError, ValueError):
+            pass
+        self._process.join(self.deadline)
+        if self._process.is_alive():
+            self._kill()
+        else:
+            self._conn.close()
+            self._process = None
+            self._conn = None
+
+    def read(self, keys=None):
+        """
+        Read the devices with the given (bus, ports) keys (default: all).
+        Returns a dictionary of their readings by key and a dictionary of
+        the error messages of devices that could not be read. Raises
+        TimeoutError if reading a device exceeded the deadline and
+        RuntimeError if the worker died, in both cases after reaping the
+        worker so the next read starts a new one.
+        """
+        with self._lock:
+            if self._process is None:
+                self._start()
+            if keys is None:
+                keys = [device._key for device in self._devices]
+            keys = list(keys)
+            self._request_id += 1
+            request_id = self._request_id
+
+            results = {}
+            errors = {}
+
+            def pending():
+                return [k for k in keys if k not in results and k not in errors]
+
+            try:
+                self._conn.send(('read', request_id, keys))
+            except OSError:
+                self._reap()
+                raise RuntimeError('Worker died before reading devices %s' % (keys,))
+            # Every device read gets its own deadline
+            deadline = time.monotonic() + self.deadline
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self._conn.poll(remaining):
+                    self._kill()
+                    raise TimeoutError('Reading devices %s took longer than %ss' % (
+                        pending(), self.deadline))
+                try:
+                    message = self._conn.recv()
+                except (EOFError, OSError):
+                    self._reap()
+                    raise RuntimeError('Worker died while reading devices %s' % (pending(),))
+                if message[1] != request_id:
+                    continue
+                if message[0] == 'done':
+                    break
+                _, _, key, readings, error = message
+                if error is None:
+                    results[key] = readings
+                else:
+                    errors[key] = error
+                deadline = time.monotonic() + self.deadline
+        return results, errors
+
+    def get_devices(self):
+        """
+        Get a list of all devices found by the current worker.
+        """
+        with self._lock:
+            if self._process is None:
+                self._start()
+            return list(self._devices)
+
+    def rescan(self, replace=None):
+        """
+        Restart the worker, which re-enumerates all devices.
+        """
+        with self._lock:
+            if self._process is not None:
+                self._stop()
+            self._start()
+            return list(self._devices)
+
+    def close(self):
+        """
+        Stop the worker process.
+        """
+        with self._lock:
+            if self._process is not None:
+                self._stop()
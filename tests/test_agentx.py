@@ -0,0 +1,268 @@
+"""
+pytests for temperusb.agentx
+"""
+
+import os
+import socket
+import struct
+import tempfile
+import threading
+import time
+
+import pytest
+
+from temperusb import agentx
+from temperusb.agentx import (
+    MibView, SubAgent, ReadingsCache, temperature_values,
+    APC_OID, APC_SUBTREE, CISCO_SUBTREE, CISCO_TEMPERATURE,
+    TYPE_INTEGER, TYPE_NO_SUCH_INSTANCE, TYPE_NO_SUCH_OBJECT,
+    TYPE_END_OF_MIB_VIEW,
+)
+from temperusb.simulation import SimulatedDevice, SimulatedHandler
+
+
+class Master(object):
+    """
+    Minimal stand-in for an AgentX master agent: accepts one subagent,
+    answers its Open and Register PDUs and sends it requests.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        self.server.listen(1)
+        self.server.settimeout(5)
+        self.conn = None
+        self.registered = []
+        self.packet_id = 0
+
+    def accept(self, session_id=42):
+        self.conn, _ = self.server.accept()
+        self.conn.settimeout(5)
+        while True:
+            pdu = agentx.read_pdu(self.conn)
+            if pdu.type == agentx.PDU_OPEN:
+                pdu = pdu._replace(session_id=session_id)
+            elif pdu.type == agentx.PDU_REGISTER:
+                subtree, _, _ = agentx.decode_oid(pdu.payload, 4)
+                self.registered.append(subtree)
+            self.conn.sendall(agentx.encode_response(pdu))
+            if len(self.registered) == 2:
+                return
+
+    def request(self, type, ranges, prefix=b''):
+        """
+        Send a request with a list of (start, end) ranges and return the
+        varbinds of the response.
+        """
+        self.packet_id += 1
+        payload = prefix + b''.join(
+            agentx.encode_oid(start) + agentx.encode_oid(end)
+            for start, end in ranges)
+        self.conn.sendall(agentx.encode_pdu(type, payload, 42, 1, self.packet_id))
+        pdu = agentx.read_pdu(self.conn)
+        assert pdu.type == agentx.PDU_RESPONSE
+        assert pdu.packet_id == self.packet_id
+        _, error, _ = struct.unpack_from('>IHH', pdu.payload, 0)
+        assert error == agentx.ERROR_NONE
+        varbinds = []
+        offset = 8
+        while offset < len(pdu.payload):
+            varbind, offset = agentx.decode_varbind(pdu.payload, offset)
+            varbinds.append(varbind)
+        return varbinds
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+        self.server.close()
+
+
+@pytest.fixture
+def served():
+    tmpdir = tempfile.mkdtemp()
+    path = os.path.join(tmpdir, 'master')
+    master = Master(path)
+    mib = MibView([APC_SUBTREE, CISCO_SUBTREE])
+    mib.update({
+        APC_OID: (TYPE_INTEGER, 24),
+        CISCO_TEMPERATURE + (1,): (TYPE_INTEGER, 21),
+        CISCO_TEMPERATURE + (3,): (TYPE_INTEGER, 24),
+    })
+    agent = SubAgent(mib, path)
+    thread = threading.Thread(target=agent.run, kwargs={'retry_interval': 0.05})
+    thread.daemon = True
+    thread.start()
+    master.accept()
+    yield master, mib, agent
+    agent.stop()
+    master.close()
+    thread.join(5)
+    os.unlink(path)
+    os.rmdir(tmpdir)
+
+
+def test_oid_roundtrip():
+    for oid in [(1, 3, 6, 1, 4, 1, 318), (1, 2, 3), ()]:
+        for bo in '<>':
+            data = agentx.encode_oid(oid, include=True, bo=bo)
+            assert agentx.decode_oid(data, 0, bo) == (oid, True, len(data))
+    # The 1.3.6.1.4 prefix is compressed
+    assert len(agentx.encode_oid((1, 3, 6, 1, 4, 1, 318))) == 4 + 2 * 4
+
+
+def test_registers_subtrees(served):
+    master, _, _ = served
+    assert master.registered == [APC_SUBTREE, CISCO_SUBTREE]
+
+
+def test_get(served):
+    master, _, _ = served
+    varbinds = master.request(agentx.PDU_GET, [
+        (APC_OID, ()),
+        (CISCO_TEMPERATURE + (2,), ()),
+        ((1, 3, 6, 1, 2, 1, 1, 1, 0), ()),
+    ])
+    assert varbinds == [
+        (APC_OID, TYPE_INTEGER, 24),
+        # Unavailable values are reported as such instead of a fake value
+        (CISCO_TEMPERATURE + (2,), TYPE_NO_SUCH_INSTANCE, None),
+        ((1, 3, 6, 1, 2, 1, 1, 1, 0), TYPE_NO_SUCH_OBJECT, None),
+    ]
+
+
+def test_getnext_walk(served):
+    master, _, _ = served
+    oid = CISCO_SUBTREE
+    walked = []
+    while True:
+        (varbind,) = master.request(agentx.PDU_GETNEXT, [(oid, CISCO_SUBTREE[:-1] + (4,))])
+        if varbind[1] == TYPE_END_OF_MIB_VIEW:
+            break
+        walked.append(varbind)
+        oid = varbind[0]
+    assert walked == [
+        (CISCO_TEMPERATURE + (1,), TYPE_INTEGER, 21),
+        (CISCO_TEMPERATURE + (3,), TYPE_INTEGER, 24),
+    ]
+
+
+def test_getbulk(served):
+    master, _, _ = served
+    varbinds = master.request(
+        agentx.PDU_GETBULK, [(APC_SUBTREE, ()), (CISCO_SUBTREE, ())],
+        prefix=struct.pack('>HH', 1, 3))
+    assert varbinds == [
+        # Non-repeater
+        (APC_OID, TYPE_INTEGER, 24),
+        # Repetitions until the end of the view
+        (CISCO_TEMPERATURE + (1,), TYPE_INTEGER, 21),
+        (CISCO_TEMPERATURE + (3,), TYPE_INTEGER, 24),
+        (APC_OID, TYPE_INTEGER, 24),
+    ]
+
+
+def test_malformed_pdu_answered_with_processing_error(served):
+    master, _, _ = served
+    # An OID header claiming more subidentifiers than the payload holds
+    payload = agentx.encode_oid(APC_OID)[:-4]
+    master.conn.sendall(agentx.encode_pdu(agentx.PDU_GET, payload, 42, 1, 99))
+    pdu = agentx.read_pdu(master.conn)
+    assert pdu.packet_id == 99
+    _, error, _ = struct.unpack_from('>IHH', pdu.payload, 0)
+    assert error == agentx.ERROR_PROCESSING
+
+    # The session keeps serving
+    (varbind,) = master.request(agentx.PDU_GET, [(APC_OID, ())])
+    assert varbind == (APC_OID, TYPE_INTEGER, 24)
+
+
+def test_update_while_serving(served):
+    master, mib, _ = served
+    mib.update({})
+    (varbind,) = master.request(agentx.PDU_GET, [(APC_OID, ())])
+    assert varbind == (APC_OID, TYPE_NO_SUCH_INSTANCE, None)
+
+
+def test_reconnects(served):
+    master, _, agent = served
+    master.conn.close()
+    master.registered = []
+    master.accept()
+    (varbind,) = master.request(agentx.PDU_GET, [(APC_OID, ())])
+    assert varbind == (APC_OID, TYPE_INTEGER, 24)
+
+
+def _device(temperature, sensors=1):
+    return SimulatedDevice(temperature=temperature, humidity=45.3, sensor_count=sensors)
+
+
+def test_temperature_values():
+    devs = [_device(21.5, sensors=2), _device(30.0), _device(25.0)]
+    readings = dict((dev, dev.get_readings()) for dev in devs[:2])
+    table = (1, 3, 6, 1, 4, 1, 99999, 1)
+    values = temperature_values(devs, readings, table)
+    assert values == {
+        APC_OID: (TYPE_INTEGER, 30),
+        CISCO_TEMPERATURE + (1,): (TYPE_INTEGER, 21),
+        CISCO_TEMPERATURE + (2,): (TYPE_INTEGER, 30),
+        table + (1, 1): (TYPE_INTEGER, 21500),
+        table + (2, 1): (TYPE_INTEGER, 453),
+        table + (1, 2): (TYPE_INTEGER, 22500),
+        table + (1, 3): (TYPE_INTEGER, 30000),
+        table + (2, 3): (TYPE_INTEGER, 453),
+    }
+
+
+class ReplugHandler(SimulatedHandler):
+    """
+    Handler whose rescan() replaces devices by working ones, like replugging
+    them, unless <repair> is false.
+    """
+    def __init__(self, temperatures, repair=True):
+        super(ReplugHandler, self).__init__([_device(t) for t in temperatures])
+        self.repair = repair
+        self.replaced = []
+
+    def rescan(self, replace=None):
+        for dev in replace or []:
+            self.replaced.append(dev)
+            new = _device(dev.temperature)
+            new.fail = dev.fail and not self.repair
+            self.devices[self.devices.index(dev)] = new
+        return super(ReplugHandler, self).rescan(replace)
+
+
+def test_readings_cache_expires():
+    th = ReplugHandler([20.0, 22.0], repair=False)
+    mib = MibView([APC_SUBTREE, CISCO_SUBTREE])
+    cache = ReadingsCache(th, mib, refresh=0.05, max_age=0.2)
+    try:
+        time.sleep(0.15)
+        assert mib.get(APC_OID) == (APC_OID, TYPE_INTEGER, 22)
+        th.devices[1].fail = True
+        time.sleep(0.4)
+        cache.refresh()
+        assert mib.get(APC_OID) == (APC_OID, TYPE_INTEGER, 20)
+        assert mib.get(CISCO_TEMPERATURE + (2,))[1] == TYPE_NO_SUCH_INSTANCE
+    finally:
+        cache.close()
+
+
+def test_readings_cache_rescans_failing_devices():
+    th = ReplugHandler([20.0, 22.0])
+    failing = th.devices[1]
+    failing.fail = True
+    mib = MibView([APC_SUBTREE, CISCO_SUBTREE])
+    cache = ReadingsCache(th, mib, refresh=0.05, max_age=0.2)
+    try:
+        time.sleep(0.1)
+        assert mib.get(CISCO_TEMPERATURE + (2,))[1] == TYPE_NO_SUCH_INSTANCE
+        time.sleep(0.15)
+        cache.refresh()
+        # The failing device was set up again and its readings are served
+        assert th.replaced == [failing]
+        time.sleep(0.1)
+        assert mib.get(CISCO_TEMPERATURE + (2,)) == (CISCO_TEMPERATURE + (2,), TYPE_INTEGER, 22)
+    finally:
+        cache.close()
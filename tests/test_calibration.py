@@ -0,0 +1,70 @@
+"""
+pytests for temperusb.calibration
+"""
+
+import io
+
+import pytest
+
+from temperusb.calibration import (
+    PiecewiseLinear, Polynomial, parse_curve, fit_polynomial, fit_points,
+    read_measurements, residuals,
+)
+
+
+def test_piecewise_linear():
+    curve = PiecewiseLinear([(10.0, 12.0), (0.0, 1.0), (20.0, 20.0)])
+    assert curve(0.0) == pytest.approx(1.0)
+    assert curve(5.0) == pytest.approx(6.5)
+    assert curve(10.0) == pytest.approx(12.0)
+    assert curve(15.0) == pytest.approx(16.0)
+    # Extrapolated with the outer segments
+    assert curve(-10.0) == pytest.approx(-10.0)
+    assert curve(30.0) == pytest.approx(28.0)
+    # A single point is an offset
+    assert PiecewiseLinear([(20.0, 21.5)])(30.0) == pytest.approx(31.5)
+    with pytest.raises(ValueError):
+        PiecewiseLinear([(1.0, 1.0), (1.0, 2.0)])
+
+
+def test_polynomial():
+    curve = Polynomial([1.0, 2.0, 0.5])
+    assert curve(0.0) == 1.0
+    assert curve(2.0) == pytest.approx(1.0 + 4.0 + 2.0)
+
+
+@pytest.mark.parametrize("text", [
+    "points = 0.4:0.0, 24.6:25.0, 98.1:100.0",
+    "poly = 1.2, 0.97, 0.0002",
+])
+def test_parse_describe_roundtrip(text):
+    curve = parse_curve(text)
+    again = parse_curve(curve.describe())
+    for x in (-5.0, 0.0, 24.6, 50.0, 120.0):
+        assert again(x) == curve(x)
+
+
+@pytest.mark.parametrize("text", ["points = ", "points = 1:2:3", "poly = a", "scale = 1.0"])
+def test_parse_invalid(text):
+    with pytest.raises(ValueError):
+        parse_curve(text)
+
+
+def test_fit_polynomial():
+    raw = [x * 5.0 for x in range(-4, 20)]
+    reference = [0.3 + 1.02 * x - 0.0004 * x * x for x in raw]
+    curve = fit_polynomial(raw, reference, degree=2)
+    assert curve.coefficients == pytest.approx([0.3, 1.02, -0.0004], abs=1e-9)
+    assert max(abs(e) for e in residuals(curve, raw, reference)) < 1e-9
+    with pytest.raises(ValueError):
+        fit_polynomial([1.0, 1.0, 2.0], [1.0, 1.0, 2.0], degree=2)
+
+
+def test_fit_points_averages_repeats():
+    curve = fit_points([0.0, 10.0, 10.0], [1.0, 11.0, 12.0])
+    assert curve.points == [(0.0, 1.0), (10.0, 11.5)]
+
+
+def test_read_measurements():
+    f = io.StringIO("raw,reference\n0.5,0.0\n\n25.1, 25.0\n")
+    assert read_measurements(f) == ([0.5, 25.1], [0.0, 25.0])
@@ -0,0 +1,80 @@
+"""
+pytests for temperusb.capture
+"""
+
+import io
+
+import pytest
+from unittest.mock import MagicMock, Mock
+
+import temperusb
+from temperusb.calibration import parse_curve
+from temperusb.capture import CaptureWriter, FLAG_WARMUP, read_capture, replay
+
+REPORTS = [
+    b"\x00\x00\x00\x00\x00\x00",  # warm-up
+    b"\x00\x00\x20\x1A\x0C\x0C",  # 32.1C, 98.7% (fm75)
+    b"\x00\x00\x00\x00\x00\x00",  # warm-up
+    b"\x00\x00\x1A\x20\x0B\x0B",  # 26.1C, 90.6% (fm75)
+]
+
+
+def _capture():
+    usbdev = Mock(bus=1, port_number="1.3", product="TEMPerHumiV1.1")
+    usbdev.is_kernel_driver_active = MagicMock(return_value=False)
+    usbdev.read = Mock(side_effect=REPORTS)
+    dev = temperusb.TemperDevice(usbdev)
+    dev.set_calibration_data(scale=1.0, offset=-0.5)
+
+    f = io.BytesIO()
+    writer = CaptureWriter(f)
+    writer.attach(dev)
+    live = [dev.get_readings(), dev.get_readings()]
+    f.seek(0)
+    return f, live
+
+
+def test_capture_roundtrip():
+    f, _ = _capture()
+    devices, reports = read_capture(f)
+    assert len(devices) == 1
+    assert devices[0].product == "TEMPerHumiV1.1"
+    assert (devices[0].bus, devices[0].ports) == ("1", "1.3")
+    assert devices[0].offset == -0.5
+    assert [r.data for r in reports] == REPORTS
+    assert [r.flags & FLAG_WARMUP for r in reports] == [FLAG_WARMUP, 0, FLAG_WARMUP, 0]
+
+
+def test_replay_matches_live_readings():
+    f, live = _capture()
+    replayed = []
+    stats = replay(f, callback=lambda report, dev, readings: replayed.append(readings))
+    assert stats['reports'] == 2
+    assert replayed == live
+
+
+def test_read_capture_rejects_garbage():
+    with pytest.raises(ValueError):
+        read_capture(io.BytesIO(b"not a capture"))
+    f, _ = _capture()
+    with pytest.raises(ValueError):
+        read_capture(io.BytesIO(f.getvalue()[:-3]))
+
+
+def test_replay_applies_calibration_curves():
+    usbdev = Mock(bus=1, port_number="1.3", product="TEMPerHumiV1.1")
+    usbdev.is_kernel_driver_active = MagicMock(return_value=False)
+    usbdev.read = Mock(side_effect=REPORTS)
+    dev = temperusb.TemperDevice(usbdev)
+    dev.set_calibration_data(curves={
+        ("temperature", 0): parse_curve("points = 0.0:1.0, 50.0:50.0"),
+        ("humidity", 0): parse_curve("poly = 2.0, 1.0"),
+    })
+
+    f = io.BytesIO()
+    CaptureWriter(f).attach(dev)
+    live = [dev.get_readings(), dev.get_readings()]
+    f.seek(0)
+    replayed = []
+    replay(f, callback=lambda report, dev, readings: replayed.append(readings))
+    assert replayed == live
@@ -0,0 +1,177 @@
+"""
+pytests for temperusb.federation
+"""
+
+import http.server
+import json
+import threading
+import time
+
+import pytest
+
+from temperusb.federation import ReadingsServer, Collector
+from temperusb.simulation import SimulatedDevice, SimulatedHandler
+
+
+def _handler(temperature, ports=(1, 2)):
+    return SimulatedHandler([
+        SimulatedDevice(1, '1.%d' % port, temperature, humidity=40.0, sensor_count=2)
+        for port in ports])
+
+
+@pytest.fixture
+def servers():
+    servers = []
+    for i in range(3):
+        server = ReadingsServer(_handler(20.0 + i), ('127.0.0.1', 0), refresh=0.05, name='pi%d' % i)
+        server.start()
+        servers.append(server)
+    time.sleep(0.1)
+    yield servers
+    for server in servers:
+        server.close()
+
+
+def _hosts(servers):
+    return ['127.0.0.1:%d' % server.address[1] for server in servers]
+
+
+def test_merged_readings(servers):
+    hosts = _hosts(servers)
+    collector = Collector(hosts)
+    try:
+        assert collector.refresh() == 3
+        readings = collector.get_readings()
+        assert len(readings) == 3 * 2 * 2
+        for i, host in enumerate(hosts):
+            reading = readings[(host, 1, '1.2', 1)]
+            assert reading['temperature_c'] == 21.0 + i
+            assert 0 <= reading['age'] < 1
+        status = collector.host_status()
+        assert [status[host]['name'] for host in hosts] == ['pi0', 'pi1', 'pi2']
+        assert not any(s['stale'] for s in status.values())
+    finally:
+        collector.close()
+
+
+def test_connections_reused(servers):
+    collector = Collector(_hosts(servers))
+    try:
+        for _ in range(5):
+            assert collector.refresh() == 3
+        assert collector.stats['connects'] == 3
+        assert collector.stats['fetches'] == 15
+    finally:
+        collector.close()
+
+
+def test_handler_api(servers):
+    hosts = _hosts(servers)
+    collector = Collector(hosts)
+    try:
+        devs = collector.rescan()
+        assert len(devs) == 6
+        dev = [d for d in devs if d.get_host() == hosts[2] and d.get_ports() == '1.1'][0]
+        assert dev.get_sensor_count() == 2
+        assert dev.get_temperature() == 22.0
+        assert dev.get_temperature(sensor=1) == 23.0
+        assert list(dev.get_humidity()) == [0]
+    finally:
+        collector.close()
+
+
+def test_stale_host(servers):
+    hosts = _hosts(servers)
+    collector = Collector(hosts, timeout=1.0, max_age=0.2)
+    try:
+        collector.refresh()
+        devs = collector.get_devices()
+        servers[1].close()
+        time.sleep(0.3)
+        assert collector.refresh() == 2
+        status = collector.host_status()
+        assert status[hosts[1]]['stale']
+        assert status[hosts[1]]['error']
+        assert not status[hosts[0]]['stale']
+        assert not any(key[0] == hosts[1] for key in collector.get_readings())
+        assert any(key[0] == hosts[1] for key in collector.get_readings(include_stale=True))
+        with pytest.raises(RuntimeError):
+            [d for d in devs if d.get_host() == hosts[1]][0].get_temperature()
+    finally:
+        collector.close()
+
+
+def test_failing_device_expires(servers):
+    hosts = _hosts(servers)
+    collector = Collector(hosts)
+    try:
+        servers[0]._handler.devices[0].fail = True
+        # The server keeps no readings older than three refreshes
+        time.sleep(0.3)
+        info = servers[0].snapshot()['devices'][0]
+        assert info['error'] and info['age'] > 0.15
+        collector.refresh()
+        dev = [d for d in collector.get_devices()
+               if d.get_host() == hosts[0] and d.get_ports() == '1.1'][0]
+        with pytest.raises(RuntimeError):
+            dev.get_temperature()
+    finally:
+        collector.close()
+
+
+def test_old_readings_expire_on_collector():
+    th = _handler(20.0, ports=(1,))
+    server = ReadingsServer(th, ('127.0.0.1', 0), refresh=0.05, max_age=60)
+    server.start()
+    time.sleep(0.1)
+    host = '127.0.0.1:%d' % server.address[1]
+    collector = Collector([host], max_age=0.2)
+    try:
+        th.devices[0].fail = True
+        collector.refresh()
+        (dev,) = collector.get_devices()
+        time.sleep(0.3)
+        collector.refresh()
+        # The host is current, but the readings it serves are not
+        assert not collector.host_status()[host]['stale']
+        assert not collector.get_readings()
+        assert collector.get_readings(include_stale=True)
+        with pytest.raises(RuntimeError):
+            dev.get_temperature()
+    finally:
+        collector.close()
+        server.close()
+
+
+class _BrokenHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = json.dumps({'error': 'misconfigured'}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_unexpected_document(servers):
+    broken = http.server.HTTPServer(('127.0.0.1', 0), _BrokenHandler)
+    thread = threading.Thread(target=broken.serve_forever)
+    thread.daemon = True
+    thread.start()
+    broken_host = '127.0.0.1:%d' % broken.server_port
+    hosts = _hosts(servers) + [broken_host]
+    collector = Collector(hosts)
+    try:
+        # The other hosts are still fetched
+        assert collector.refresh() == 3
+        status = collector.host_status()
+        assert 'devices' in status[broken_host]['error']
+        assert status[broken_host]['stale']
+        assert len(collector.get_readings()) == 3 * 2 * 2
+        assert collector.stats['errors'] == 1
+    finally:
+        collector.close()
+        broken.shutdown()
+        broken.server_close()
@@ -0,0 +1,51 @@
+"""
+pytests for temperusb.filters
+"""
+
+import pytest
+
+from temperusb.filters import Deadband, DeadbandFilter
+
+
+def _reading(temperature, humidity=None, sensor=0):
+    reading = {'bus': 1, 'ports': '1.3', 'sensor': sensor, 'temperature_c': temperature}
+    if humidity is not None:
+        reading['humidity_pc'] = humidity
+    return reading
+
+
+def test_absolute_deadband():
+    f = DeadbandFilter(temperature=Deadband(absolute=0.5), humidity=Deadband(absolute=2))
+    assert len(f.filter([_reading(20.0, 40.0)], now=0)) == 1
+    assert f.filter([_reading(20.4, 41.0)], now=1) == []
+    # Compared against the last emitted value, not the last seen one
+    assert f.filter([_reading(20.2, 41.9)], now=2) == []
+    assert len(f.filter([_reading(20.6, 40.0)], now=3)) == 1
+    assert len(f.filter([_reading(20.6, 37.5)], now=4)) == 1
+    assert f.stats == {'emitted': 3, 'suppressed': 2}
+
+
+def test_percent_deadband_and_heartbeat():
+    f = DeadbandFilter(temperature=Deadband(percent=5), heartbeat=60)
+    f.filter([_reading(20.0)], now=0)
+    assert f.filter([_reading(20.9)], now=30) == []
+    assert len(f.filter([_reading(21.1)], now=31)) == 1
+    assert f.filter([_reading(21.1)], now=90) == []
+    assert len(f.filter([_reading(21.1)], now=91)) == 1
+
+
+def test_per_sensor_deadband():
+    f = DeadbandFilter(
+        temperature=Deadband(absolute=1),
+        sensors={(1, '1.3', 1): {'temperature': Deadband(absolute=0.1)}},
+    )
+    f.filter([_reading(20.0, sensor=0), _reading(20.0, sensor=1)], now=0)
+    emitted = f.filter([_reading(20.5, sensor=0), _reading(20.5, sensor=1)], now=1)
+    assert [r['sensor'] for r in emitted] == [1]
+
+
+def test_deadband_requires_one_kind():
+    with pytest.raises(ValueError):
+        Deadband()
+    with pytest.raises(ValueError):
+        Deadband(absolute=1, percent=1)
@@ -0,0 +1,182 @@
+"""
+pytests for temperusb.pubsub
+"""
+
+import threading
+import time
+
+import pytest
+from unittest.mock import MagicMock, Mock, patch
+
+import temperusb
+from temperusb.pubsub import Publisher
+from temperusb.simulation import SimulatedDevice, SimulatedHandler
+
+
+class CountingDevice(SimulatedDevice):
+    """
+    Reads 20 + the number of its reads degrees celsius, so every reading
+    can be told apart.
+    """
+    def _read(self):
+        self.temperature = 21.0 + self.reads
+        return super(CountingDevice, self)._read()
+
+
+def _handler(count=2):
+    return SimulatedHandler(CountingDevice(ports='1.%d' % i, sensor_count=2) for i in range(count))
+
+
+class Collector(object):
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.received = []
+
+    def __call__(self, device, readings):
+        time.sleep(self.delay)
+        self.received.append((device, readings))
+
+
+def test_one_read_serves_all_subscribers():
+    th = _handler()
+    publisher = Publisher(th)
+    fast, slow = Collector(), Collector()
+    sub_fast = publisher.subscribe(fast, min_interval=0.05)
+    sub_slow = publisher.subscribe(slow, min_interval=0.1, sensors=[1])
+    time.sleep(0.52)
+    sub_fast.unsubscribe()
+    sub_slow.unsubscribe()
+
+    for dev in th.devices:
+        fast_readings = [r for d, r in fast.received if d is dev]
+        slow_readings = [r for d, r in slow.received if d is dev]
+        # The fast subscriber got every read of the device
+        assert len(fast_readings) == dev.reads
+        assert 5 <= dev.reads <= 12
+        # The slow one every second read, with only the sensor it asked for
+        assert abs(len(slow_readings) - dev.reads / 2) <= 1
+        assert all(list(r) == [1] for r in slow_readings)
+
+
+def test_unsubscribe_stops_polling():
+    th = _handler()
+    publisher = Publisher(th)
+    sub_all = publisher.subscribe(Collector(), min_interval=0.02)
+    sub_one = publisher.subscribe(Collector(), min_interval=0.02, devices=[th.devices[0]])
+    time.sleep(0.1)
+    sub_all.unsubscribe()
+    reads = [dev.reads for dev in th.devices]
+    time.sleep(0.1)
+    # Device 1 has no subscribers left, device 0 is still polled
+    assert th.devices[1].reads == reads[1]
+    assert th.devices[0].reads > reads[0]
+
+    sub_one.unsubscribe()
+    time.sleep(0.05)
+    assert publisher._thread is None
+    reads = [dev.reads for dev in th.devices]
+    time.sleep(0.1)
+    assert [dev.reads for dev in th.devices] == reads
+
+
+@pytest.mark.parametrize("policy", ["drop_oldest", "coalesce"])
+def test_slow_subscriber_does_not_stall(policy):
+    th = _handler(count=1)
+    publisher = Publisher(th)
+    gate = threading.Event()
+    received = []
+
+    def blocked(device, readings):
+        gate.wait()
+        received.append(readings[0]['temperature_c'])
+
+    fast = Collector()
+    sub_blocked = publisher.subscribe(blocked, min_interval=0.01, queue_size=3, policy=policy)
+    sub_fast = publisher.subscribe(fast, min_interval=0.01)
+    time.sleep(0.2)
+    reads = th.devices[0].reads
+    gate.set()
+    time.sleep(0.05)
+    sub_blocked.unsubscribe()
+    sub_fast.unsubscribe()
+
+    # The poll loop kept going while one subscriber was blocked
+    assert reads >= 10
+    assert len(fast.received) >= reads
+    assert sub_blocked.dropped > 0
+    # The backlog of the blocked subscriber was bounded: after the reading it
+    # was blocked on, it continued with one of the newest readings
+    kept = 1 if policy == "coalesce" else 3
+    assert received[0] == 21.0
+    assert received[1] >= 20.0 + reads - kept
+    assert received == sorted(received)
+
+
+def test_invalid_subscription():
+    publisher = Publisher(_handler())
+    with pytest.raises(ValueError):
+        publisher.subscribe(Collector(), policy="newest")
+    assert publisher._thread is None
+
+
+def test_handler_subscribe():
+    with patch("usb.core.find", return_value=[]):
+        th = temperusb.TemperHandler()
+    th._devices = [CountingDevice()]
+    collector = Collector()
+    sub = th.subscribe(collector, min_interval=0.02)
+    time.sleep(0.05)
+    sub.unsubscribe()
+    assert collector.received[0][0] is th._devices[0]
+
+
+def _fake_usb_device(port):
+    usbdev = Mock(bus=1, address=port, port_number='1.%d' % port, product="TEMPerV1.2")
+    usbdev.is_kernel_driver_active = MagicMock(return_value=False)
+    usbdev.read = Mock(return_value=b"\x00\x00\x20\x1A")
+    return usbdev
+
+
+def test_handler_rescan_wakes_publisher():
+    """
+    Devices added by a rescan are polled for subscriptions made while the
+    handler had no devices.
+    """
+    found = []
+
+    def match_pids(find_all, idVendor, idProduct):
+        return found if (idVendor, idProduct) == (0x0C45, 0x7401) else []
+
+    with patch("usb.core.find", side_effect=match_pids):
+        th = temperusb.TemperHandler()
+        collector = Collector()
+        sub = th.subscribe(collector, min_interval=60)
+        time.sleep(0.05)
+        found = [_fake_usb_device(1)]
+        th.rescan()
+        time.sleep(0.1)
+        sub.unsubscribe()
+    assert len(collector.received) == 1
+    assert 'temperature_c' in collector.received[0][1][0]
+
+
+def test_subscribed_devices_survive_rescan():
+    usbdevs = [_fake_usb_device(port) for port in (1, 2)]
+
+    def match_pids(find_all, idVendor, idProduct):
+        return usbdevs if (idVendor, idProduct) == (0x0C45, 0x7401) else []
+
+    with patch("usb.core.find", side_effect=match_pids):
+        th = temperusb.TemperHandler()
+        first, second = th.get_devices()
+        collector = Collector()
+        sub = th.subscribe(collector, min_interval=0.02, devices=[second])
+        time.sleep(0.05)
+        replaced = th.rescan(replace=[second])[1]
+        received = len(collector.received)
+        time.sleep(0.1)
+        sub.unsubscribe()
+    assert replaced is not second
+    assert received > 0
+    later = collector.received[received:]
+    assert later and all(device is replaced for device, _ in later)
@@ -0,0 +1,185 @@
+"""
+pytests for temperusb.sampler
+"""
+
+import threading
+import time
+
+import pytest
+
+from temperusb.sampler import FixedRateSampler, PollScheduler, hub_key, measure_max_rate
+from temperusb.simulation import SimulatedDevice
+
+
+class FakeClock(object):
+    """
+    Simulated monotonic time for samplers, running separately in every
+    thread, so sampling threads behave as if they ran in parallel on an idle
+    machine. Waiting returns True once <duration> seconds have passed.
+    """
+    def __init__(self, duration):
+        self.start = 1000.0
+        self.end = self.start + duration
+        self._local = threading.local()
+
+    def __call__(self):
+        return getattr(self._local, 'now', self.start)
+
+    def sleep(self, seconds):
+        self._local.now = self() + seconds
+
+    def wait(self, timeout):
+        self.sleep(timeout)
+        return self() >= self.end
+
+
+def _simulate(sampler):
+    sampler.start()
+    # The sampling threads end with the simulated time
+    sampler.stop()
+
+
+class FakeDevice(SimulatedDevice):
+    """
+    Simulated device recording when it was read, on <clock> if given.
+    """
+    def __init__(self, delay=0.0, value=21.0, bus=1, ports='1', clock=None):
+        super(FakeDevice, self).__init__(
+            bus, ports, value, latency=delay, sleep=clock.sleep if clock else time.sleep)
+        self.clock = clock or time.monotonic
+        self.periods = []
+
+    def _read(self):
+        start = self.clock()
+        readings = super(FakeDevice, self)._read()
+        self.periods.append((start, self.clock()))
+        return readings
+
+
+def test_fixed_rate_sampler_keeps_grid():
+    samples = []
+    lock = threading.Lock()
+
+    def callback(sample):
+        with lock:
+            samples.append(sample)
+
+    clock = FakeClock(0.2)
+    devs = [FakeDevice(delay=0.005, clock=clock), FakeDevice(delay=0.001, clock=clock)]
+    sampler = FixedRateSampler(devs, 0.02, callback, clock=clock, wait=clock.wait)
+    _simulate(sampler)
+
+    for index in range(len(devs)):
+        dev_samples = [s for s in samples if s.device == index]
+        assert len(dev_samples) == 10
+        assert sampler.stats[index]['samples'] == len(dev_samples)
+        for s in dev_samples:
+            # Acquisition time is the transfer midpoint
+            assert s.timestamp == pytest.approx(
+                clock.start + s.tick * 0.02 + devs[index].latency / 2)
+            assert s.duration == pytest.approx(devs[index].latency)
+            assert s.readings[0]['temperature_c'] == devs[index].temperature
+            assert s.error is None
+        # Ticks are consecutive on the grid: no drift, nothing missed
+        assert [s.tick for s in dev_samples] == list(range(len(dev_samples)))
+
+
+def test_fixed_rate_sampler_reports_missed_ticks():
+    samples = []
+    clock = FakeClock(0.3)
+    sampler = FixedRateSampler([FakeDevice(delay=0.05, clock=clock)], 0.02, samples.append,
+                               clock=clock, wait=clock.wait)
+    _simulate(sampler)
+
+    # Every read takes 2.5 ticks, so the two ticks after each one are missed
+    assert [s.tick for s in samples] == [0, 3, 6, 9, 12]
+    assert [s.missed for s in samples] == [0, 2, 2, 2, 2]
+    assert sampler.stats[0]['missed'] == 10
+    # Ticks missed after the last sample are only counted in the stats
+    assert 0 < sum(s.missed for s in samples) <= sampler.stats[0]['missed']
+    for previous, current in zip(samples, samples[1:]):
+        assert current.tick == previous.tick + current.missed + 1
+
+
+def test_fixed_rate_sampler_records_errors():
+    def failing_read(device):
+        raise IOError("device gone")
+
+    samples = []
+    sampler = FixedRateSampler([FakeDevice()], 0.02, samples.append, read=failing_read)
+    sampler.run(0.05)
+
+    assert samples
+    assert all(isinstance(s.error, IOError) and s.readings is None for s in samples)
+    assert sampler.stats[0]['errors'] == len(samples)
+
+
+def test_measure_max_rate():
+    dev = FakeDevice(delay=0.01)
+    rate = measure_max_rate(dev, samples=5)
+    assert dev.reads == 5
+    assert 0 < rate <= 100
+    with pytest.raises(ValueError):
+        measure_max_rate(dev, samples=0)
+
+
+def test_hub_key():
+    assert hub_key(FakeDevice(bus=1, ports='1.4.2')) == (1, '1.4')
+    assert hub_key(FakeDevice(bus=2, ports='3')) == (2, '')
+
+
+def test_poll_scheduler_staggers_and_groups():
+    clock = FakeClock(0.5)
+    hub = [FakeDevice(delay=0.01, bus=1, ports='1.%d' % p, clock=clock) for p in (1, 2, 3)]
+    other = FakeDevice(delay=0.01, bus=2, ports='1.1', clock=clock)
+    slow = FakeDevice(delay=0.01, bus=1, ports='2', clock=clock)
+    devs = hub + [other, slow]
+    samples = []
+    lock = threading.Lock()
+
+    def callback(sample):
+        with lock:
+            samples.append(sample)
+
+    scheduler = PollScheduler(devs, 0.09, callback, intervals={4: 0.18},
+                              clock=clock, wait=clock.wait)
+    assert sorted(scheduler.groups.values()) == [[0, 1, 2], [3], [4]]
+    _simulate(scheduler)
+
+    # Devices on the same hub never overlap
+    periods = sorted(p for d in hub for p in d.periods)
+    for (_, end), (start, _) in zip(periods, periods[1:]):
+        assert start >= end
+    # ... and are spread evenly over the interval
+    first = [min(s.timestamp for s in samples if s.device == i) for i in range(3)]
+    offsets = [t - scheduler._start for t in first]
+    for position, offset in enumerate(offsets):
+        assert offset == pytest.approx(0.03 * position + 0.005)
+    # Another bus runs in parallel to the hub
+    assert other.periods[0][0] < hub[0].periods[0][1]
+    # Each device keeps its own interval
+    assert [d.reads for d in hub] == [6, 6, 5]
+    assert slow.reads == 3
+    assert all(s.missed == 0 for s in samples)
+
+
+def test_sampler_survives_callback_errors():
+    samples = []
+
+    def callback(sample):
+        samples.append(sample)
+        raise ValueError("broken consumer")
+
+    sampler = FixedRateSampler([FakeDevice()], 0.02, callback)
+    sampler.run(0.15)
+
+    assert len(samples) > 2
+
+
+def test_poll_scheduler_custom_group():
+    devs = [FakeDevice(bus=1, ports='1.1'), FakeDevice(bus=1, ports='2'), FakeDevice(bus=2)]
+    samples = []
+    scheduler = PollScheduler(devs, 0.05, samples.append, group=lambda d: d.get_bus())
+    assert sorted(scheduler.groups.values()) == [[0, 1], [2]]
+    scheduler.run(0.1)
+    assert set(s.device for s in samples) == {0, 1, 2}
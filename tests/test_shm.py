@@ -0,0 +1,103 @@
+"""
+pytests for temperusb.shm
+"""
+
+import threading
+
+import pytest
+
+from temperusb.shm import ShmPublisher, ShmReader
+
+
+def _readings(value):
+    return [
+        {'bus': 1, 'ports': '1.3', 'sensor': s, 'temperature_c': value + s}
+        for s in range(3)
+    ] + [{'bus': 1, 'ports': '1.4', 'sensor': 0, 'temperature_c': value, 'humidity_pc': 40.0}]
+
+
+def test_publish_and_read(tmp_path):
+    path = str(tmp_path / 'temperusb')
+    publisher = ShmPublisher(path, slots=8)
+    reader = ShmReader(path)
+    assert reader.read() == []
+
+    publisher.publish(_readings(20.0), timestamp=123.0)
+    readings = reader.read()
+    assert len(readings) == 4
+    assert readings[2] == {'bus': 1, 'ports': '1.3', 'sensor': 2,
+                           'temperature_c': 22.0, 'timestamp': 123.0}
+    assert reader.get(1, '1.4')['humidity_pc'] == 40.0
+    assert 'humidity_pc' not in reader.get(1, '1.3', 1)
+    assert reader.get(2, '1.3') is None
+    assert reader.version() == 2
+
+    publisher.publish(_readings(21.0)[:1])
+    assert len(reader.read()) == 1
+    publisher.close()
+    reader.close()
+
+
+def test_slots_are_bounded(tmp_path):
+    path = str(tmp_path / 'temperusb')
+    publisher = ShmPublisher(path, slots=2)
+    publisher.publish(_readings(20.0))
+    assert len(ShmReader(path).read()) == 2
+
+
+def test_reader_follows_publisher_restarts(tmp_path):
+    path = str(tmp_path / 'temperusb')
+    reading = {'bus': 1, 'ports': '1.3', 'sensor': 0, 'temperature_c': 20.0}
+    publisher = ShmPublisher(path, slots=64)
+    publisher.publish([reading] * 60)
+    reader = ShmReader(path)
+    assert len(reader.read()) == 60
+    publisher.close()
+
+    # A new publisher with more slots
+    publisher = ShmPublisher(path, slots=128)
+    publisher.publish([reading] * 100)
+    assert len(reader.read()) == 100
+    assert reader.slots == 128
+    publisher.close()
+
+    # and one with fewer, which leaves the file as large as it was
+    publisher = ShmPublisher(path, slots=16)
+    publisher.publish([reading] * 10)
+    assert len(reader.read()) == 10
+    assert reader.slots == 16
+    publisher.close()
+    reader.close()
+
+
+def test_readers_see_consistent_snapshots(tmp_path):
+    path = str(tmp_path / 'temperusb')
+    publisher = ShmPublisher(path, slots=8)
+    publisher.publish(_readings(0.0))
+    reader = ShmReader(path)
+    stop = threading.Event()
+
+    def write():
+        value = 0.0
+        while not stop.is_set():
+            value += 1
+            publisher.publish(_readings(value))
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    try:
+        for _ in range(2000):
+            readings = reader.read()
+            base = readings[0]['temperature_c']
+            assert [r['temperature_c'] for r in readings] == \
+                [base, base + 1, base + 2, base]
+    finally:
+        stop.set()
+        writer.join()
+
+
+def test_reader_rejects_other_files(tmp_path):
+    path = tmp_path / 'other'
+    path.write_bytes(b'\x00' * 64)
+    with pytest.raises(ValueError):
+        ShmReader(str(path))
@@ -0,0 +1,180 @@
+"""
+pytests for temperusb.sinks, run against local stand-in servers.
+"""
+
+import http.server
+import socket
+import socketserver
+import threading
+
+from temperusb.sinks import (
+    GraphiteSink, InfluxHTTPSink, InfluxUDPSink, graphite_lines, influx_line,
+)
+
+READINGS = [
+    {'bus': 1, 'ports': '1.3', 'sensor': 0, 'temperature_c': 21.5, 'humidity_pc': 40.0},
+    {'bus': 1, 'ports': '1.3', 'sensor': 1, 'temperature_c': 22.0},
+]
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class _InfluxHandler(http.server.BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.received.extend(body.decode('utf-8').splitlines())
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def _start_influx(port=0):
+    server = http.server.HTTPServer(('127.0.0.1', port), _InfluxHandler)
+    server.received = []
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def test_formats():
+    assert influx_line(READINGS[0], 2.5) == \
+        'temper,bus=1,ports=1.3,sensor=0 temperature_c=21.5,humidity_pc=40.0 2500000000'
+    assert influx_line({'ports': 'a b', 'sensor': 0}, 1) is None
+    assert graphite_lines(READINGS[1], 2.5) == \
+        ['temper.bus1.port1_3.sensor1.temperature_c 22.0 2']
+
+
+def test_influx_http_batches():
+    server = _start_influx()
+    try:
+        sink = InfluxHTTPSink('http://127.0.0.1:%d/write?db=temper' % server.server_port,
+                              batch_size=4, flush_interval=0.05)
+        sink.start()
+        sink.write(READINGS, timestamp=1)
+        sink.write(READINGS, timestamp=2)
+        sink.stop()
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert len(server.received) == 4
+    assert sink.stats['sent'] == 4
+
+
+def test_influx_http_spools_when_unreachable(tmp_path):
+    port = _free_port()
+    url = 'http://127.0.0.1:%d/write' % port
+    sink = InfluxHTTPSink(url, spool_dir=str(tmp_path), timeout=1)
+    sink.write(READINGS, timestamp=1)
+    assert not sink.flush()
+    assert sink.stats['spooled'] == 2
+    spooled = open(sink.spool_path).read().splitlines()
+    assert len(spooled) == 2
+
+    # Endpoint comes back: backlog is drained before new data
+    server = _start_influx(port)
+    try:
+        sink.write(READINGS[:1], timestamp=2)
+        assert sink.flush()
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert server.received == spooled + [influx_line(READINGS[0], 2)]
+    assert not (tmp_path / 'influxhttpsink.spool').exists()
+
+
+def test_failed_batch_kept_without_spool():
+    sink = InfluxHTTPSink('http://127.0.0.1:1/', batch_size=2, max_buffer=5)
+    failures = [IOError("network down")]
+    sent = []
+
+    def send(lines):
+        if failures:
+            raise failures.pop()
+        sent.extend(lines)
+
+    sink._send = send
+    sink.write(READINGS, timestamp=1)
+    sink.write(READINGS, timestamp=2)
+    assert not sink.flush()
+    assert sink.stats['dropped'] == 0
+    assert len(sink._buffer) == 4
+
+    # The failed batch is sent first once the endpoint is back
+    assert sink.flush()
+    assert sent == [influx_line(r, t) for t in (1, 2) for r in READINGS]
+
+
+def test_failed_batch_overflowing_buffer_drops_oldest():
+    sink = InfluxHTTPSink('http://127.0.0.1:1/', batch_size=2, max_buffer=3)
+
+    def send(lines):
+        # New readings arrive while the send is failing
+        sink.write(READINGS, timestamp=2)
+        raise IOError("network down")
+
+    sink._send = send
+    sink.write(READINGS, timestamp=1)
+    assert not sink.flush()
+    assert sink.stats['dropped'] == 1
+    assert list(sink._buffer) == [influx_line(READINGS[1], 1)] + [
+        influx_line(r, 2) for r in READINGS]
+
+
+def test_bounded_buffer_drops_oldest():
+    sink = InfluxHTTPSink('http://127.0.0.1:1/', max_buffer=3)
+    sink.write(READINGS, timestamp=1)
+    sink.write(READINGS, timestamp=2)
+    assert sink.stats['dropped'] == 1
+    assert list(sink._buffer)[0] == influx_line(READINGS[1], 1)
+
+
+def test_influx_udp():
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.bind(('127.0.0.1', 0))
+    receiver.settimeout(5)
+    try:
+        sink = InfluxUDPSink('127.0.0.1', receiver.getsockname()[1], max_datagram=80)
+        sink.write(READINGS, timestamp=1)
+        assert sink.flush()
+        sink.close()
+        lines = []
+        while len(lines) < 2:
+            lines.extend(receiver.recv(2048).decode('utf-8').splitlines())
+    finally:
+        receiver.close()
+    assert lines == [influx_line(r, 1) for r in READINGS]
+
+
+def test_graphite():
+    received = []
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                received.append(line.decode('utf-8').rstrip('\n'))
+
+    server = socketserver.TCPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.handle_request)
+    thread.start()
+    try:
+        sink = GraphiteSink('127.0.0.1', server.server_address[1], prefix='rack')
+        sink.write(READINGS, timestamp=1)
+        sink.write(READINGS[1:], timestamp=2)
+        assert sink.flush()
+        sink.close()
+        thread.join(5)
+    finally:
+        server.server_close()
+    assert received == [
+        'rack.bus1.port1_3.sensor0.temperature_c 21.5 1',
+        'rack.bus1.port1_3.sensor0.humidity_pc 40.0 1',
+        'rack.bus1.port1_3.sensor1.temperature_c 22.0 1',
+        'rack.bus1.port1_3.sensor1.temperature_c 22.0 2',
+    ]
@@ -0,0 +1,56 @@
+"""
+pytests for temperusb.snmp
+"""
+
+import sys
+
+import pytest
+from unittest.mock import Mock, patch
+
+pytest.importorskip("snmp_passpersist")
+
+from temperusb import snmp
+
+
+def test_updater_rescans_only_failed_devices():
+    good = Mock()
+    good.get_temperature = Mock(return_value=21.0)
+    bad = Mock()
+    bad.get_temperature = Mock(side_effect=IOError("device gone"))
+    handler = Mock()
+    handler.get_devices = Mock(return_value=[good, bad])
+    pp = Mock()
+
+    with patch("temperusb.snmp.TemperHandler", return_value=handler):
+        bad.get_temperature.side_effect = [20.0, IOError("device gone")]
+        upd = snmp.Updater(pp, Mock())
+        upd.update()
+
+    pp.add_int.assert_any_call('318.1.1.1.2.2.2.0', snmp.ERROR_TEMPERATURE)
+    handler.rescan.assert_called_once_with(replace=[bad])
+
+    handler.get_devices.return_value = [good]
+    pp.reset_mock()
+    upd.update()
+    pp.add_int.assert_any_call('318.1.1.1.2.2.2.0', 21)
+    pp.add_int.assert_any_call('9.9.13.1.3.1.3.1', 21)
+
+
+def test_loadtest_against_agent():
+    """
+    Drive the real pass_persist loop with simulated devices.
+    """
+    from temperusb.snmp_loadtest import agent_command, run_load
+
+    results = run_load(agent_command(devices=2, latency=0.01, error_rate=1.0, refresh=0.2),
+                       rate=100, duration=0.5)
+    assert results['requests'] == 50
+    assert results['p50'] <= results['p99'] <= results['max']
+    # Every device read fails, so all values answered are error values
+    assert results['error_values'] == results['requests'] - results['none']
+    assert results['error_values'] > 0
+
+
+def test_unbuffered_handle():
+    handle = snmp._unbuffered_handle(sys.stdout)
+    assert handle.line_buffering
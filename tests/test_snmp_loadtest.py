@@ -0,0 +1,26 @@
+"""
+pytests for temperusb.snmp_loadtest
+"""
+
+import pytest
+
+from temperusb.snmp_loadtest import percentile
+
+
+@pytest.mark.parametrize(
+    ["values", "fraction", "expected"],
+    [
+        [[3, 1, 2, 4], 0.5, 2],
+        [[3, 1, 2, 4], 0.99, 4],
+        [range(1, 7), 0.5, 3],
+        [range(1, 11), 0.5, 5],
+        [range(1, 11), 0.9, 9],
+        [range(1, 11), 0.99, 10],
+        [range(1, 101), 0.5, 50],
+        [range(1, 101), 0.9, 90],
+        [range(1, 101), 0.99, 99],
+        [[7], 0.0, 7],
+    ],
+)
+def test_percentile(values, fraction, expected):
+    assert percentile(values, fraction) == expected
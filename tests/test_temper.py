@@ -6,11 +6,14 @@ pytest --cov=temperusb --cov-report term-missing
 """
 
 import os
+import threading
+import time
 import pytest
 import usb
-from unittest.mock import MagicMock, patch, Mock
+from unittest.mock import MagicMock, patch, Mock, mock_open
 
 import temperusb
+from temperusb.device_library import DEVICE_LIBRARY, TemperConfig
 from temperusb.temper import TIMEOUT
 
 
@@ -203,3 +206,192 @@ def test_TemperDevice(
         for i, humidity in enumerate(humidity_out_expected):
             results_h = dev.get_humidity(None)
             assert results_h[i]["humidity_pc"] == pytest.approx(humidity, 0.1)
+
+
+def _make_device(productname, reports):
+    """
+    Build a TemperDevice on top of a faked usb device which returns the
+    given raw <reports> from consecutive interrupt reads.
+    """
+    usbdev = Mock(bus="fakebus", product=productname)
+    usbdev.is_kernel_driver_active = MagicMock(return_value=False)
+    usbdev.read = Mock(side_effect=list(reports))
+    return temperusb.TemperDevice(usbdev)
+
+
+@pytest.mark.parametrize(
+    ["aggregate", "temperature_expected", "humidity_expected"],
+    [
+        ["median", 0x201A / 256.0, 0x0C0C * 0.032],
+        ["mean", (0x201A + 0x10 / 5) / 256.0, (0x0C0C + 1 / 5) * 0.032],
+        ["trimmed", 0x201A / 256.0, 0x0C0C * 0.032],
+    ],
+)
+def test_get_readings(aggregate, temperature_expected, humidity_expected):
+    """
+    Several reports are taken in one session and aggregated.
+    """
+    warmup = b"\x00\x00\x00\x00\x00\x00"
+    report = b"\x00\x00\x20\x1A\x0C\x0C"  # 32.1C, 98.7% (fm75)
+    outlier = b"\x00\x00\x20\x2A\x0C\x0D"  # 32.2C, 98.7% (fm75)
+    dev = _make_device(
+        "TEMPerHumiV1.1", [warmup, report, report, outlier, report, report])
+
+    results = dev.get_readings(samples=5, aggregate=aggregate)
+
+    # One warm-up read plus one read per sample, but only one session
+    assert dev._device.read.call_count == 6
+    assert dev._device.set_configuration.call_count == 1
+    assert results[0]["samples"] == 5
+    assert results[0]["temperature_c"] == pytest.approx(temperature_expected, abs=0.001)
+    assert results[0]["humidity_pc"] == pytest.approx(humidity_expected, abs=0.001)
+    assert results[0]["temperature_c_spread"] == pytest.approx(0x10 / 256.0)
+    assert results[0]["humidity_pc_spread"] == pytest.approx(0.032)
+
+
+def test_get_readings_invalid_arguments():
+    dev = _make_device("TEMPerV1.2", [])
+    with pytest.raises(ValueError):
+        dev.get_readings(samples=0)
+    with pytest.raises(ValueError):
+        dev.get_readings(aggregate="mode")
+
+
+def _fake_usb_device(productname, bus, address):
+    usbdev = Mock(bus=bus, address=address, product=productname)
+    usbdev.is_kernel_driver_active = MagicMock(return_value=False)
+    usbdev.read = Mock(return_value=b"\x00\x00\x20\x1A")
+    return usbdev
+
+
+def test_device_lock_serializes_sessions():
+    """
+    Concurrent readers of one device never overlap their USB sessions.
+    """
+    active = []
+    overlaps = []
+    dev = _make_device("TEMPerV1.2", [])
+
+    def slow_read(*args, **kwargs):
+        active.append(1)
+        if len(active) > 1:
+            overlaps.append(len(active))
+        time.sleep(0.001)
+        active.pop()
+        return b"\x00\x00\x20\x1A"
+
+    dev._device.read = Mock(side_effect=slow_read)
+    threads = [threading.Thread(target=dev.get_temperatures) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert not overlaps
+    assert dev._device.read.call_count == 16
+
+
+def test_handler_rescan():
+    """
+    Rescanning keeps present devices, drops removed ones and sets up
+    replaced and new ones.
+    """
+    usbdevs = [_fake_usb_device("TEMPerV1.2", 1, address) for address in (2, 3, 4)]
+    found = usbdevs[:2]
+
+    def match_pids(find_all, idVendor, idProduct):
+        return found if (idVendor, idProduct) == (0x0C45, 0x7401) else []
+
+    with patch("usb.core.find", side_effect=match_pids):
+        th = temperusb.TemperHandler()
+        first, second = th.get_devices()
+
+        found = usbdevs[1:]
+        devs = th.rescan()
+        assert devs[0] is second
+        assert devs[1]._device is usbdevs[2]
+
+        devs = th.rescan(replace=[second])
+        assert devs[0] is not second
+        assert devs[0]._device is usbdevs[1]
+        assert devs[1] is th.get_devices()[1]
+
+
+def test_multi_report_device():
+    """
+    An 8 sensor device spreading its values over three reports is read in
+    one session with a single command.
+    """
+    config = TemperConfig(
+        temp_sens_offsets=[2, 4, 6, 2, 4, 6, 2, 4],
+        commands=['temp', None, None],
+        temp_sens_reports=[0, 0, 0, 1, 1, 1, 2, 2],
+    )
+    temperatures = [10.0, 11.5, 12.25, -3.0, 20.0, 21.0, 22.0, 23.5]
+    raw = [int(t * 256) & 0xffff for t in temperatures]
+    reports = [
+        b"\x00\x00" + b"".join(r.to_bytes(2, "big") for r in raw[0:3]),
+        b"\x00\x00" + b"".join(r.to_bytes(2, "big") for r in raw[3:6]),
+        b"\x00\x00" + b"".join(r.to_bytes(2, "big") for r in raw[6:8]),
+    ]
+    with patch.dict(DEVICE_LIBRARY, {"TEMPer8_sim": config}):
+        dev = _make_device("TEMPer8_sim", [b"\x00" * 8] + reports)
+    assert dev.get_sensor_count() == 8
+
+    results = dev.get_temperatures()
+
+    assert dev._device.set_configuration.call_count == 1
+    # Warm-up plus one command for all three reports
+    assert dev._device.ctrl_transfer.call_count == 2
+    assert dev._device.read.call_count == 4
+    assert [results[i]["temperature_c"] for i in range(8)] == temperatures
+
+
+def test_sensor_count_limits():
+    dev = _make_device("TEMPerV1.2", [])
+    dev.set_sensor_count(8)
+    with pytest.raises(ValueError):
+        dev.set_sensor_count(9)
+    with pytest.raises(ValueError):
+        dev.set_sensor_count(0)
+
+
+def test_device_kept_open():
+    """
+    An opened device reuses its session until it is closed.
+    """
+    dev = _make_device("TEMPerV1.2", [b"\x00\x00\x20\x1A"] * 5)
+    dev.open()
+    dev.get_temperatures()
+    dev.get_temperatures()
+    assert dev._device.set_configuration.call_count == 1
+    assert dev._device.read.call_count == 3
+    with patch("usb.util.dispose_resources") as dispose:
+        dev.close()
+    dispose.assert_called_once_with(dev._device)
+    dev.get_temperatures()
+    assert dev._device.set_configuration.call_count == 2
+
+
+def test_calibration_curves_from_config():
+    """
+    Per-sensor curves from /etc/temper.conf replace scale and offset and
+    also apply to humidity.
+    """
+    config = (
+        "1-1.3: scale = 2.0, offset = 1.0\n"
+        "1-1.3 sensor 0 temperature: points = 0.0:1.0, 40.0:41.0\n"
+        "1-1.3 sensor 0 humidity: poly = -1.0, 1.0\n"
+        "1-1.4 sensor 0 humidity: poly = 5.0\n"
+    )
+    report = b"\x00\x00\x20\x1A\x0C\x0C"  # 32.1C, 98.7% (fm75)
+    usbdev = Mock(bus=1, port_number="1.3", product="TEMPerHumiV1.1")
+    usbdev.is_kernel_driver_active = MagicMock(return_value=False)
+    usbdev.read = Mock(side_effect=[report, report])
+    with patch("temperusb.temper.open", mock_open(read_data=config), create=True):
+        dev = temperusb.TemperDevice(usbdev)
+
+    assert dev._scale == 2.0
+    assert sorted(dev._curves) == [("humidity", 0), ("temperature", 0)]
+    results = dev.get_readings()
+    assert results[0]["temperature_c"] == pytest.approx(0x201A / 256.0 + 1.0)
+    assert results[0]["humidity_pc"] == pytest.approx(0x0C0C * 0.032 - 1.0)
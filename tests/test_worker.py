@@ -0,0 +1,184 @@
+"""
+pytests for temperusb.worker
+"""
+
+import functools
+import os
+import time
+
+import pytest
+
+from temperusb.simulation import SimulatedDevice, SimulatedHandler
+from temperusb.worker import WorkerHandler
+
+
+class FakeDevice(SimulatedDevice):
+    """
+    Simulated device that hangs or crashes the worker while the files
+    <hang_flag> or <crash_flag> exist, and tells which process read it.
+    """
+    def __init__(self, index, hang_flag=None, crash_flag=None, delay=0.0):
+        super(FakeDevice, self).__init__(
+            1, '1.%d' % index, 20.0 + index, product='TEMPerV1.2', latency=delay)
+        self.hang_flag = hang_flag
+        self.crash_flag = crash_flag
+
+    def _read(self):
+        if self.hang_flag and os.path.exists(self.hang_flag):
+            time.sleep(60)
+        if self.crash_flag and os.path.exists(self.crash_flag):
+            # Like a segfault in libusb: no exception, no cleanup
+            os._exit(1)
+        readings = super(FakeDevice, self)._read()
+        readings[0].update(opened=self.opened, pid=os.getpid())
+        return readings
+
+
+class FakeHandler(SimulatedHandler):
+    def __init__(self, hang_flag=None, crash_flag=None, unplug_flag=None):
+        devices = [FakeDevice(0), FakeDevice(1, hang_flag, crash_flag)]
+        if unplug_flag and os.path.exists(unplug_flag):
+            # Enumerated in another order, with device 0 gone
+            devices = [FakeDevice(2), FakeDevice(1)]
+        super(FakeHandler, self).__init__(devices)
+
+
+def test_worker_reads_in_subprocess():
+    wh = WorkerHandler(handler_factory=FakeHandler)
+    try:
+        devs = wh.get_devices()
+        assert [d.get_ports() for d in devs] == ['1.0', '1.1']
+        readings = devs[1].get_readings()
+        assert readings[0]['temperature_c'] == 21.0
+        # Devices stay open in the worker between reads
+        assert readings[0]['opened']
+        assert readings[0]['pid'] != os.getpid()
+        assert devs[0].get_temperature('fahrenheit') == pytest.approx(68.0)
+        readings, errors = wh.read()
+        assert sorted(readings) == [(1, '1.0'), (1, '1.1')]
+        assert not errors
+    finally:
+        wh.close()
+
+
+def test_watchdog_kills_hanging_worker(tmp_path):
+    hang_flag = str(tmp_path / 'hang')
+    wh = WorkerHandler(deadline=0.5,
+                       handler_factory=functools.partial(FakeHandler, hang_flag))
+    try:
+        devs = wh.get_devices()
+        first_pid = devs[0].get_readings()[0]['pid']
+
+        open(hang_flag, 'w').close()
+        start = time.monotonic()
+        with pytest.raises(TimeoutError):
+            devs[1].get_readings()
+        assert time.monotonic() - start < 5
+        assert wh.stats['kills'] == 1
+
+        # The next read is served by a fresh worker
+        os.remove(hang_flag)
+        readings = devs[1].get_readings()
+        assert readings[0]['temperature_c'] == 21.0
+        assert readings[0]['pid'] != first_pid
+        assert wh.stats['starts'] == 2
+    finally:
+        wh.close()
+
+
+def test_worker_crash_starts_new_worker(tmp_path):
+    crash_flag = str(tmp_path / 'crash')
+    wh = WorkerHandler(deadline=5,
+                       handler_factory=functools.partial(FakeHandler, crash_flag=crash_flag))
+    try:
+        devs = wh.get_devices()
+        first_pid = devs[1].get_readings()[0]['pid']
+
+        open(crash_flag, 'w').close()
+        with pytest.raises(RuntimeError):
+            devs[1].get_readings()
+        assert wh.stats['crashes'] == 1
+
+        os.remove(crash_flag)
+        readings = devs[1].get_readings()
+        assert readings[0]['temperature_c'] == 21.0
+        assert readings[0]['pid'] != first_pid
+        assert wh.stats['starts'] == 2
+    finally:
+        wh.close()
+
+
+def test_worker_abandons_unkillable_worker(tmp_path, monkeypatch):
+    hang_flag = str(tmp_path / 'hang')
+    wh = WorkerHandler(deadline=0.5,
+                       handler_factory=functools.partial(FakeHandler, hang_flag))
+    stuck = wh._process
+    try:
+        devs = wh.get_devices()
+        # Like a worker blocked in the kernel, it does not exit when killed
+        monkeypatch.setattr(type(stuck), 'kill', lambda self: None)
+        open(hang_flag, 'w').close()
+        start = time.monotonic()
+        with pytest.raises(TimeoutError):
+            devs[1].get_readings()
+        assert time.monotonic() - start < 5
+        assert wh.stats['abandoned'] == 1
+        assert stuck.is_alive()
+
+        monkeypatch.undo()
+        os.remove(hang_flag)
+        assert devs[0].get_readings()[0]['temperature_c'] == 20.0
+        assert wh.stats['starts'] == 2
+    finally:
+        wh.close()
+        stuck.kill()
+        stuck.join()
+
+
+def test_read_returns_errors_with_readings():
+    wh = WorkerHandler(handler_factory=FakeHandler)
+    try:
+        readings, errors = wh.read([(1, '1.0'), (1, '1.7'), (1, '1.1')])
+        # The device that could not be read does not cost the others
+        assert sorted(readings) == [(1, '1.0'), (1, '1.1')]
+        assert list(errors) == [(1, '1.7')]
+    finally:
+        wh.close()
+
+
+class SlowHandler(SimulatedHandler):
+    def __init__(self):
+        super(SlowHandler, self).__init__(FakeDevice(i, delay=0.3) for i in range(3))
+
+
+def test_deadline_applies_per_device():
+    wh = WorkerHandler(deadline=0.5, handler_factory=SlowHandler)
+    try:
+        # Reading all devices takes longer than one deadline
+        readings, _ = wh.read()
+        assert len(readings) == 3
+        assert wh.stats['kills'] == 0
+    finally:
+        wh.close()
+
+
+def test_handles_survive_reenumeration(tmp_path):
+    hang_flag = str(tmp_path / 'hang')
+    unplug_flag = str(tmp_path / 'unplug')
+    wh = WorkerHandler(deadline=0.5, handler_factory=functools.partial(
+        FakeHandler, hang_flag, unplug_flag=unplug_flag))
+    try:
+        devs = wh.get_devices()
+        open(hang_flag, 'w').close()
+        with pytest.raises(TimeoutError):
+            devs[1].get_readings()
+        os.remove(hang_flag)
+
+        # The new worker enumerates devices differently
+        open(unplug_flag, 'w').close()
+        assert devs[1].get_readings()[0]['temperature_c'] == 21.0
+        with pytest.raises(RuntimeError):
+            devs[0].get_readings()
+        assert [d.get_ports() for d in wh.get_devices()] == ['1.2', '1.1']
+    finally:
+        wh.close()